@@ -0,0 +1,176 @@
+"""
+Module: account
+Purpose: Holds the state that belongs to one FSR user: the access token, the
+         incidents being handled and the responder settings. The single user
+         configured in .env uses the default account, and the multi-account
+         engine (see async_engine) creates one account per entry in ACCOUNTS_FILE.
+"""
+
+import json
+import os
+import oauth_handler
+import settings
+from incident_store import IncidentStore
+
+
+class AccountError(Exception):
+    """Raised when the accounts file is missing or invalid."""
+    pass
+
+
+class Account:
+    """
+    State and settings for one FSR user.
+
+    Responder settings left as None fall back to the values in .env.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        fsr_username: str = None,
+        fsr_password: str = None,
+        pushover_user_keys: tuple = None,
+        responding_user_name: str = None,
+        responding_msg: str = None
+    ):
+        """
+        Args:
+            name (str): A short name for the account, used in logs and file names.
+            fsr_username (str): The FSR user name.
+            fsr_password (str): The FSR password.
+            pushover_user_keys (tuple): Pushover user keys to notify, or None for
+                PUSHOVER_USER_KEY and PUSHOVER_RECIPIENTS.
+            responding_user_name (str): FSR user name to watch for responding, or None for RESPONDING_USER_NAME.
+            responding_msg (str): Message to send when responding, or None for RESPONDING_MSG.
+        """
+        self.name = name
+        self.pushover_user_keys = tuple(pushover_user_keys) if pushover_user_keys else None
+        self.responding_user_name = responding_user_name
+        self.responding_msg = responding_msg
+        self.store = IncidentStore()
+        self.tokens: oauth_handler.TokenManager = None
+        if fsr_username:
+            current = settings.get()
+            self.tokens = oauth_handler.TokenManager(
+                fsr_username,
+                fsr_password,
+                _account_path(current.token_cache_path, name),
+                current.oauth_refresh_ahead
+            )
+
+    def get_token(self, force_update: bool = False) -> str:
+        """
+        Retrieve a valid access token for this account.
+
+        Args:
+            force_update (bool): If True, forces the retrieval of a new token.
+
+        Returns:
+            str: A valid access token.
+
+        Raises:
+            OAuthError: If token generation fails.
+        """
+        if self.tokens is None:
+            return oauth_handler.get_token(force_update)
+        return self.tokens.get_token(force_update)
+
+    def user_keys(self) -> tuple:
+        """
+        Get the Pushover user keys to notify for this account.
+
+        Returns:
+            tuple: The user keys.
+        """
+        if self.pushover_user_keys:
+            return self.pushover_user_keys
+        current = settings.get()
+        return (current.pushover_user_key,) + current.pushover_recipients
+
+    def file_path(self, path: str) -> str:
+        """
+        Get the path of a per-account file, e.g. state.json becomes state.<name>.json.
+        The default account uses the path as it is.
+
+        Args:
+            path (str): The configured path, or "" if the file is disabled.
+
+        Returns:
+            str: The path for this account, or "" if the file is disabled.
+        """
+        if self is default:
+            return path
+        return _account_path(path, self.name)
+
+    def responder(self) -> tuple:
+        """
+        Get the FSR user name to watch and the message to send when they respond.
+
+        Returns:
+            tuple: (user name, message)
+        """
+        current = settings.get()
+        return (
+            self.responding_user_name or current.responding_user_name,
+            self.responding_msg or current.responding_msg
+        )
+
+
+def load_accounts(path: str) -> list:
+    """
+    Load the accounts from a JSON file.
+
+    The file holds a list of objects with the keys "name", "fsr_username" and
+    "fsr_password", and optionally "pushover_user_key" (one key or a list of
+    keys), "responding_user_name" and "responding_msg".
+
+    Args:
+        path (str): The path of the accounts file.
+
+    Returns:
+        list: The accounts.
+
+    Raises:
+        AccountError: If the file can not be read or an entry is invalid.
+    """
+    try:
+        with open(path, encoding="utf-8") as f:
+            entries = json.load(f)
+    except (OSError, ValueError) as e:
+        raise AccountError(f"Could not read {path}: {e}")
+    if not isinstance(entries, list) or not entries:
+        raise AccountError(f"{path} must hold a non-empty list of accounts")
+
+    accounts, names = [], set()
+    for i, entry in enumerate(entries):
+        if not isinstance(entry, dict):
+            raise AccountError(f"Account {i + 1} in {path} must be an object")
+        missing = [key for key in ("name", "fsr_username", "fsr_password") if not entry.get(key)]
+        if missing:
+            raise AccountError(f"Account {i + 1} in {path} is missing {', '.join(missing)}")
+        if entry["name"] in names:
+            raise AccountError(f"Account name {entry['name']} is used more than once in {path}")
+        names.add(entry["name"])
+        user_keys = entry.get("pushover_user_key")
+        if isinstance(user_keys, str):
+            user_keys = (user_keys,)
+        accounts.append(Account(
+            entry["name"],
+            entry["fsr_username"],
+            entry["fsr_password"],
+            user_keys,
+            entry.get("responding_user_name"),
+            entry.get("responding_msg")
+        ))
+    return accounts
+
+
+def _account_path(path: str, name: str) -> str:
+    if not path:
+        return ""
+    base, ext = os.path.splitext(path)
+    return f"{base}.{name}{ext}"
+
+
+default = Account("default")
@@ -0,0 +1,610 @@
+"""
+Module: analytics
+Purpose: Keeps statistics over the whole incident history up to date as
+         frames arrive: time to acknowledge per member, turnout per incident
+         and the busiest hours. Every incident and acknowledgement is appended
+         to column files (one array of fixed size values per field), and the
+         totals per member and per hour are kept in a small summary file, so a
+         report over years of history reads the summary instead of the raw
+         incident logs. Reports over a time range read only the columns.
+
+Usage:
+    python analytics.py report [--since <ISO date>] [--top <N>]
+    python analytics.py rebuild                         (recompute from the incident archive)
+"""
+
+import argparse
+import array
+import bisect
+import datetime
+import json
+import os
+import sys
+import threading
+import time
+import lease
+import log_writer
+import metrics
+import settings
+
+MODULE_NAME = "Analytics"
+
+# Format version of the summary, a directory with another version is rebuilt.
+VERSION = 1
+SUMMARY_FILE = "summary.json"
+
+# The column files and the array typecode of their values. Values are stored
+# little-endian, in the order the incidents and acknowledgements happened.
+COLUMNS = {
+    "incident_id": "q",
+    "incident_start": "d",
+    "incident_turnout": "H",
+    "ack_time": "d",
+    "ack_member": "I",
+    "ack_seconds": "f",
+}
+INCIDENT_COLUMNS = ("incident_id", "incident_start", "incident_turnout")
+ACK_COLUMNS = ("ack_time", "ack_member", "ack_seconds")
+
+# Upper bounds in seconds of the time to acknowledge buckets, the last bucket has no bound.
+ACK_BUCKETS = [15, 30, 45, 60, 90, 120, 180, 240, 300, 420, 600, 900, 1800, 3600]
+# Turnouts from this number up are counted together.
+MAX_TURNOUT = 30
+# An incident takes acknowledgements for this long after it started. A frame for
+# the same id after that starts a new incident.
+OPEN_SECONDS = 24 * 3600
+STATUS_ACKNOWLEDGED = "acknowledged"
+
+_lock = threading.Lock()
+_path: str = ""
+_summary: dict = None
+_member_index: dict = {}
+# Values not written to the column files yet, by column.
+_pending: dict = {}
+# Turnouts to write over rows that may already be on disk: row -> turnout.
+_turnout_updates: dict = {}
+# Incidents still taking acknowledgements: (account, id) -> [row, started_at, turnout, members].
+_open: dict = {}
+_thread: threading.Thread = None
+_stop = threading.Event()
+_counters: dict = {"incidents": 0, "acknowledgements": 0, "flushes": 0}
+
+
+class AnalyticsError(Exception):
+    """Raised when the analytics files can not be read."""
+    pass
+
+
+class Aggregates:
+    """
+    The statistics answered by a report: time to acknowledge per member, incidents
+    by turnout and by weekday and hour.
+    """
+
+    def __init__(self, members: list = None, member_stats: list = None, hours: list = None, turnout: list = None):
+        """
+        Args:
+            members (list): Member names, a member's number is its index.
+            member_stats (list): Per member [acknowledgements, total seconds, bucket counts].
+            hours (list): Incidents per weekday (Monday first) and hour, 7 * 24 counts.
+            turnout (list): Incidents per turnout, MAX_TURNOUT + 1 counts.
+        """
+        self.members = members if members is not None else []
+        self.member_stats = member_stats if member_stats is not None else []
+        self.hours = hours if hours is not None else [0] * (7 * 24)
+        self.turnout = turnout if turnout is not None else [0] * (MAX_TURNOUT + 1)
+
+    def add_incident(self, started_at: float) -> None:
+        started = datetime.datetime.fromtimestamp(started_at)
+        self.hours[started.weekday() * 24 + started.hour] += 1
+        self.turnout[0] += 1
+
+    def change_turnout(self, old: int, new: int) -> None:
+        self.turnout[min(old, MAX_TURNOUT)] -= 1
+        self.turnout[min(new, MAX_TURNOUT)] += 1
+
+    def add_ack(self, member: int, seconds: float) -> None:
+        while len(self.member_stats) <= member:
+            self.member_stats.append([0, 0.0, [0] * (len(ACK_BUCKETS) + 1)])
+        stats = self.member_stats[member]
+        stats[0] += 1
+        stats[1] += seconds
+        stats[2][bisect.bisect_left(ACK_BUCKETS, seconds)] += 1
+
+    @property
+    def incidents(self) -> int:
+        return sum(self.turnout)
+
+
+def start() -> None:
+    """
+    Load the analytics files from ANALYTICS_PATH and write the new values every
+    ANALYTICS_FLUSH_INTERVAL seconds in a background thread.
+    """
+    global _thread
+    load()
+    if not _path or (_thread and _thread.is_alive()):
+        return
+    _stop.clear()
+    _thread = threading.Thread(target=_flush_loop, name="analytics", daemon=True)
+    _thread.start()
+
+
+def stop() -> None:
+    """
+    Stop the background thread and write what is not written yet.
+    """
+    _stop.set()
+    if _thread:
+        _thread.join(timeout=5)
+    _safe_flush()
+
+
+def load(path: str = None) -> None:
+    """
+    Load the summary and the open incidents, dropping values not written yet. Called
+    at startup and when taking over from another process that wrote the files.
+
+    Args:
+        path (str): The analytics directory. Defaults to ANALYTICS_PATH, empty disables the analytics.
+    """
+    global _path, _summary
+    path = settings.get().analytics_path if path is None else path
+    summary = _empty_summary()
+    if path:
+        try:
+            summary = _read_summary(path) or summary
+            _truncate_columns(path, summary["rows"])
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            _to_error("Load the analytics", e, path)
+            summary = _empty_summary()
+    with _lock:
+        _path, _summary = path, summary
+        _member_index.clear()
+        _member_index.update({name: index for index, name in enumerate(summary["members"])})
+        _pending.clear()
+        _pending.update({name: array.array(typecode) for name, typecode in COLUMNS.items()})
+        _turnout_updates.clear()
+        _open.clear()
+        for account_name, incident_id, row, started_at, turnout, members in summary["open"]:
+            _open[(account_name, incident_id)] = [row, started_at, turnout, set(members)]
+
+
+def incident_started(account_name: str, incident_id, started_at: float = None) -> None:
+    """
+    Count a new incident. An incident that is already open is not counted again.
+
+    Args:
+        account_name (str): The account the incident belongs to.
+        incident_id: The FSR incident id.
+        started_at (float): Epoch time the incident was first received. Defaults to now.
+    """
+    if _summary is None or not _path:
+        return
+    started_at = time.time() if started_at is None else started_at
+    try:
+        numeric_id = int(incident_id)
+    except (TypeError, ValueError):
+        return
+    key = (account_name, numeric_id)
+    with _lock:
+        entry = _open.get(key)
+        if entry is not None and started_at - entry[1] < OPEN_SECONDS:
+            return
+        row = _summary["rows"]["incidents"] + len(_pending["incident_id"])
+        _pending["incident_id"].append(numeric_id)
+        _pending["incident_start"].append(started_at)
+        _pending["incident_turnout"].append(0)
+        _open[key] = [row, started_at, 0, set()]
+        _aggregates().add_incident(started_at)
+        _counters["incidents"] += 1
+
+
+def acknowledged(account_name: str, incident_id, user_names: list, at: float = None) -> None:
+    """
+    Count members that acknowledged an incident, with their time to acknowledge.
+    A member is counted once per incident.
+
+    Args:
+        account_name (str): The account the incident belongs to.
+        incident_id: The FSR incident id.
+        user_names (list): The members that acknowledged.
+        at (float): Epoch time of the frame. Defaults to now.
+    """
+    if _summary is None or not _path:
+        return
+    at = time.time() if at is None else at
+    try:
+        key = (account_name, int(incident_id))
+    except (TypeError, ValueError):
+        return
+    with _lock:
+        entry = _open.get(key)
+        if entry is None:
+            return
+        row, started_at, turnout, members = entry
+        aggregates = _aggregates()
+        for user_name in user_names:
+            if user_name in members:
+                continue
+            members.add(user_name)
+            member = _member(account_name, user_name)
+            seconds = max(0.0, at - started_at)
+            _pending["ack_time"].append(at)
+            _pending["ack_member"].append(member)
+            _pending["ack_seconds"].append(seconds)
+            aggregates.add_ack(member, seconds)
+            _counters["acknowledgements"] += 1
+        if len(members) != turnout:
+            aggregates.change_turnout(turnout, len(members))
+            entry[2] = len(members)
+            _turnout_updates[row] = min(len(members), 65535)
+
+
+def flush() -> bool:
+    """
+    Append the new values to the column files and write the summary. A process
+    standing by for another one (see the lease module) does not write.
+
+    Returns:
+        bool: True if anything was written.
+    """
+    if not _path or not lease.is_active():
+        return False
+    with _lock:
+        if not any(_pending[name] for name in COLUMNS) and not _turnout_updates:
+            return False
+        pending = {name: _pending[name] for name in COLUMNS}
+        _pending.update({name: array.array(typecode) for name, typecode in COLUMNS.items()})
+        updates = dict(_turnout_updates)
+        _turnout_updates.clear()
+        now = time.time()
+        for key in [key for key, entry in _open.items() if now - entry[1] >= OPEN_SECONDS]:
+            del _open[key]
+        summary = dict(_summary)
+        summary["rows"] = {
+            "incidents": _summary["rows"]["incidents"] + len(pending["incident_id"]),
+            "acks": _summary["rows"]["acks"] + len(pending["ack_time"]),
+        }
+        summary["open"] = [
+            [account_name, incident_id, row, started_at, turnout, sorted(members)]
+            for (account_name, incident_id), (row, started_at, turnout, members) in _open.items()
+        ]
+        data = json.dumps(summary, separators=(",", ":"), ensure_ascii=False)
+        _summary["rows"] = summary["rows"]
+
+    log_writer.ensure_dir(_path)
+    for name, values in pending.items():
+        if values:
+            with open(_column_path(_path, name), "ab") as f:
+                _little_endian(values).tofile(f)
+    if updates:
+        turnout = array.array(COLUMNS["incident_turnout"], [0])
+        with open(_column_path(_path, "incident_turnout"), "r+b") as f:
+            for row, value in sorted(updates.items()):
+                turnout[0] = value
+                f.seek(row * turnout.itemsize)
+                _little_endian(turnout).tofile(f)
+    # The summary is written last, its row counts mark how much of the columns is valid.
+    tmp = os.path.join(_path, f"{SUMMARY_FILE}.tmp")
+    with open(tmp, "w", encoding="utf-8") as f:
+        f.write(data)
+    os.replace(tmp, os.path.join(_path, SUMMARY_FILE))
+    with _lock:
+        _counters["flushes"] += 1
+    return True
+
+
+def report_data(path: str, since: datetime.datetime = None) -> Aggregates:
+    """
+    Get the statistics over the full history, or since a point in time.
+
+    The full history comes from the summary. A time range is computed from the
+    columns, finding its start with a binary search on the times.
+
+    Args:
+        path (str): The analytics directory.
+        since (datetime.datetime): Only count incidents and acknowledgements from this time on.
+
+    Returns:
+        Aggregates: The statistics.
+
+    Raises:
+        AnalyticsError: If the files can not be read.
+    """
+    try:
+        summary = _read_summary(path)
+        if summary is None:
+            raise AnalyticsError(f"No analytics in {path}, run: python analytics.py rebuild")
+        if since is None:
+            return Aggregates(summary["members"], summary["member_stats"], summary["hours"], summary["turnout"])
+        columns = {name: _read_column(path, name, summary["rows"]) for name in COLUMNS}
+    except (OSError, ValueError, KeyError, TypeError) as e:
+        raise AnalyticsError(f"Could not read {path}: {e}")
+
+    cutoff = since.timestamp()
+    result = Aggregates(summary["members"])
+    first = bisect.bisect_left(columns["incident_start"], cutoff)
+    for started_at, turnout in zip(columns["incident_start"][first:], columns["incident_turnout"][first:]):
+        result.add_incident(started_at)
+        result.change_turnout(0, turnout)
+    first = bisect.bisect_left(columns["ack_time"], cutoff)
+    for member, seconds in zip(columns["ack_member"][first:], columns["ack_seconds"][first:]):
+        result.add_ack(member, seconds)
+    return result
+
+
+def rebuild(path: str) -> int:
+    """
+    Recompute the analytics from the incident archive, replacing the files in path.
+    Frames are handled like incident_handler does, with the time they were received.
+
+    Args:
+        path (str): The analytics directory.
+
+    Returns:
+        int: The number of frames read.
+    """
+    import incident_archive
+    from incident_store import IncidentStore
+
+    for name in list(COLUMNS) + [SUMMARY_FILE]:
+        file_path = _column_path(path, name) if name in COLUMNS else os.path.join(path, name)
+        if os.path.exists(file_path):
+            os.remove(file_path)
+    load(path)
+    store = IncidentStore()
+    count = 0
+    for received_at, frame in incident_archive.all_frames():
+        message = frame.get("message") if isinstance(frame, dict) else None
+        if not isinstance(message, dict) or message.get("id") is None:
+            continue
+        count += 1
+        incident_id = message.get("id")
+        now = datetime.datetime.fromtimestamp(received_at)
+        store.expire(now)
+        if incident_id not in store:
+            store.add(incident_id, now)
+            incident_started("default", incident_id, received_at)
+        delta = store.update_responses(incident_id, message.get("incident_responses") or [])
+        names = [user_name for user_name, (old, new) in delta.items() if new == STATUS_ACKNOWLEDGED]
+        added = store.add_responders(incident_id, names)
+        if added:
+            acknowledged("default", incident_id, added, received_at)
+    flush()
+    return count
+
+
+def stats() -> dict:
+    """
+    Get the analytics counters.
+
+    Returns:
+        dict: Incidents and acknowledgements counted and flushes since the start,
+              plus the rows on disk and the open incidents.
+    """
+    with _lock:
+        snapshot = dict(_counters)
+        snapshot["rows"] = 0 if _summary is None else _summary["rows"]["incidents"]
+        snapshot["open"] = len(_open)
+    return snapshot
+
+
+def _aggregates() -> Aggregates:
+    """
+    The summary's statistics as Aggregates, sharing the summary's lists. Call with _lock held.
+    """
+    return Aggregates(_summary["members"], _summary["member_stats"], _summary["hours"], _summary["turnout"])
+
+
+def _member(account_name: str, user_name: str) -> int:
+    """
+    Get the number of a member, adding the member if it is new. Call with _lock held.
+    Members of other accounts than the default one are named account/user.
+    """
+    name = user_name if account_name == "default" else f"{account_name}/{user_name}"
+    index = _member_index.get(name)
+    if index is None:
+        index = _member_index[name] = len(_summary["members"])
+        _summary["members"].append(name)
+    return index
+
+
+def _empty_summary() -> dict:
+    return {
+        "version": VERSION,
+        "rows": {"incidents": 0, "acks": 0},
+        "members": [],
+        "member_stats": [],
+        "hours": [0] * (7 * 24),
+        "turnout": [0] * (MAX_TURNOUT + 1),
+        "open": [],
+    }
+
+
+def _read_summary(path: str) -> dict:
+    """
+    Read the summary file.
+
+    Returns:
+        dict: The summary, or None if there is none or it has another version.
+    """
+    summary_path = os.path.join(path, SUMMARY_FILE)
+    if not os.path.exists(summary_path):
+        return None
+    with open(summary_path, encoding="utf-8") as f:
+        summary = json.load(f)
+    if summary.get("version") != VERSION:
+        _to_terminal(f"Ignoring {summary_path} with unknown version {summary.get('version')}")
+        return None
+    return summary
+
+
+def _column_path(path: str, name: str) -> str:
+    return os.path.join(path, f"{name}.bin")
+
+
+def _read_column(path: str, name: str, rows: dict) -> array.array:
+    """
+    Read the valid rows of a column file.
+    """
+    values = array.array(COLUMNS[name])
+    count = rows["incidents"] if name in INCIDENT_COLUMNS else rows["acks"]
+    if count:
+        with open(_column_path(path, name), "rb") as f:
+            values.fromfile(f, count)
+    return _little_endian(values)
+
+
+def _truncate_columns(path: str, rows: dict) -> None:
+    """
+    Cut values written after the last summary off the column files, e.g. after a crash
+    between writing the columns and the summary.
+    """
+    for name, typecode in COLUMNS.items():
+        column_path = _column_path(path, name)
+        if not os.path.exists(column_path):
+            continue
+        size = (rows["incidents"] if name in INCIDENT_COLUMNS else rows["acks"]) * array.array(typecode).itemsize
+        if os.path.getsize(column_path) > size:
+            with open(column_path, "r+b") as f:
+                f.truncate(size)
+
+
+def _little_endian(values: array.array) -> array.array:
+    """
+    Convert between the byte order of this machine and the little-endian files.
+    """
+    if sys.byteorder == "big":
+        values = array.array(values.typecode, values)
+        values.byteswap()
+    return values
+
+
+def _flush_loop() -> None:
+    while not _stop.wait(settings.get().analytics_flush_interval):
+        _safe_flush()
+
+
+def _safe_flush() -> None:
+    try:
+        flush()
+    except Exception as e:
+        _to_error("Write the analytics", e, _path)
+
+
+def _to_terminal(msg: str) -> None:
+    """
+    Log a message to the terminal using the writer module.
+
+    Args:
+        msg (str): The message to log.
+    """
+    log_writer.to_terminal(MODULE_NAME, msg)
+
+
+def _to_error(tried_to: str, err_msg: object, obj: object) -> None:
+    """
+    Log an error using the writer module.
+
+    Args:
+        tried_to (str): Description of the operation attempted.
+        err_msg (object): The exception, or an error message.
+        obj (object): The context or data related to the error.
+    """
+    log_writer.to_error(MODULE_NAME, tried_to, err_msg, obj)
+
+
+def _median(buckets: list) -> str:
+    """
+    Get the time to acknowledge bucket that holds the median, e.g. "<=60s".
+    """
+    total = sum(buckets)
+    seen = 0
+    for index, count in enumerate(buckets):
+        seen += count
+        if total and seen * 2 >= total:
+            return f"<={ACK_BUCKETS[index]}s" if index < len(ACK_BUCKETS) else f">{ACK_BUCKETS[-1]}s"
+    return ""
+
+
+def _print_report(data: Aggregates, top: int) -> None:
+    incidents = data.incidents
+    print(f"Incidents: {incidents}")
+    print("\nTime to acknowledge per member")
+    print(f"{'Member':<30} {'Acks':>6} {'Mean':>8} {'Median':>8}")
+    ranked = sorted(
+        ((name, stats) for name, stats in zip(data.members, data.member_stats) if stats[0]),
+        key=lambda item: -item[1][0]
+    )
+    for name, (count, seconds, buckets) in ranked[:top]:
+        print(f"{name:<30} {count:>6} {seconds / count:>7.0f}s {_median(buckets):>8}")
+
+    print("\nTurnout per incident")
+    if incidents:
+        mean = sum(turnout * count for turnout, count in enumerate(data.turnout)) / incidents
+        print(f"Mean {mean:.1f} members")
+    for turnout, count in enumerate(data.turnout):
+        if count:
+            label = f"{turnout}+" if turnout == MAX_TURNOUT else str(turnout)
+            print(f"{label:>4} {count:>7} {count / incidents * 100:>5.1f}%")
+
+    print("\nBusiest hours")
+    by_hour = [sum(data.hours[day * 24 + hour] for day in range(7)) for hour in range(24)]
+    for hour in sorted(range(24), key=lambda hour: -by_hour[hour])[:top]:
+        if by_hour[hour]:
+            print(f"{hour:02d}:00-{hour:02d}:59 {by_hour[hour]:>7}")
+    days = ["Mon", "Tue", "Wed", "Thu", "Fri", "Sat", "Sun"]
+    print("\n    " + "".join(f"{hour:>5}" for hour in range(24)))
+    for day in range(7):
+        print(f"{days[day]} " + "".join(f"{data.hours[day * 24 + hour]:>5}" for hour in range(24)))
+
+
+def _collect_metrics() -> list:
+    """
+    Report the analytics counters to the metrics module.
+
+    Returns:
+        list: Metric samples, see metrics.register_collector.
+    """
+    stats_now = stats()
+    return [
+        ("fsr_analytics_incidents_total", "counter", "Incidents counted since the start", {}, stats_now["incidents"]),
+        ("fsr_analytics_acknowledgements_total", "counter", "Acknowledgements counted since the start", {},
+         stats_now["acknowledgements"]),
+        ("fsr_analytics_rows", "gauge", "Incidents in the analytics files", {}, stats_now["rows"]),
+    ]
+
+
+def main(args: list) -> None:
+    parser = argparse.ArgumentParser(prog="analytics.py", description="Response statistics over the incident history.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    report = commands.add_parser("report", help="Print the statistics")
+    report.add_argument("--since", type=datetime.datetime.fromisoformat, help="Only count from this ISO date or date-time")
+    report.add_argument("--top", type=int, default=20, help="Number of members and hours to list")
+    commands.add_parser("rebuild", help="Recompute the statistics from the incident archive")
+    options = parser.parse_args(args)
+
+    path = settings.get().analytics_path
+    if not path:
+        raise SystemExit("ANALYTICS_PATH is not set")
+    if options.command == "rebuild":
+        start = time.perf_counter()
+        count = rebuild(path)
+        log_writer.shutdown()
+        print(f"Read {count} frame(s) in {time.perf_counter() - start:.1f} s", file=sys.stderr)
+        return
+    start = time.perf_counter()
+    try:
+        data = report_data(path, options.since)
+    except AnalyticsError as e:
+        raise SystemExit(str(e))
+    _print_report(data, options.top)
+    print(f"\nComputed in {(time.perf_counter() - start) * 1000:.1f} ms", file=sys.stderr)
+
+
+metrics.register_collector(_collect_metrics)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -1,11 +1,89 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import account
+import analytics
+import async_engine
+import error_digest
+import frames
 import fsr_handler
+import geo_index
+import incident_archive
+import incident_handler
+import incident_snapshot
+import lease
+import liveness
+import log_writer
+import metrics
+import oauth_handler
+import profiler
+import receipts
+import redundancy
+import request_handler
+import session_pool
+import settings
+import sinks
 
 
 def main() -> None:
-    fsr_handler.run()
+    try:
+        settings.load()
+    except settings.SettingsError as e:
+        raise SystemExit(f"Invalid configuration in .env: {e}")
+    settings.install_reload_handler()
+    profiler.install_signal_handlers()
+    current = settings.get()
+    try:
+        frames.set_backend(current.json_backend)
+    except frames.FrameError as e:
+        raise SystemExit(f"Invalid configuration in .env: {e}")
+    metrics.start_server(current.metrics_host, current.metrics_port)
+    session_pool.start_warmup([request_handler.PUSHOVER_ENDPOINT])
+    accounts = None
+    if current.accounts_file:
+        try:
+            accounts = account.load_accounts(current.accounts_file)
+        except account.AccountError as e:
+            raise SystemExit(f"Invalid accounts file: {e}")
+    if current.geo_data_path:
+        try:
+            geo_index.load(current.geo_data_path)
+        except geo_index.GeoError as e:
+            raise SystemExit(f"Invalid map data: {e}")
+    try:
+        redundancy.start()
+    except lease.LeaseError as e:
+        raise SystemExit(f"Invalid configuration in .env: {e}")
+    request_handler.start_dispatcher()
+    sinks.start_sinks()
+    incident_archive.start_maintenance()
+    incident_snapshot.start(accounts or [account.default])
+    analytics.start()
+    try:
+        if accounts:
+            async_engine.run(accounts)
+        elif current.redundant_connections > 1:
+            oauth_handler.start_refresher()
+            async_engine.run([account.default])
+        else:
+            oauth_handler.start_refresher()
+            fsr_handler.run()
+    finally:
+        profiler.stop()
+        liveness.stop()
+        incident_snapshot.stop()
+        analytics.stop()
+        redundancy.stop()
+        incident_archive.stop_maintenance()
+        oauth_handler.stop_refresher()
+        incident_handler.flush_events()
+        sinks.stop_sinks()
+        error_digest.stop()
+        receipts.stop()
+        request_handler.stop_dispatcher()
+        session_pool.stop_warmup()
+        metrics.stop_server()
+        log_writer.shutdown()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,362 @@
+"""
+Module: async_engine
+Purpose: Serves many FSR accounts from one process. Every account gets its own
+         WebSocket connection, access token, incident store and responder
+         settings, and all of them run in a single asyncio event loop. The HTTP
+         session pool and the notification dispatcher are shared.
+
+         Needs the websockets package (pip install websockets).
+"""
+
+import asyncio
+import concurrent.futures
+import signal
+import requests
+import frames
+import fsr_handler
+import incident_handler
+import liveness
+import log_writer
+import metrics
+import oauth_handler
+import reconnect
+import redundancy
+import request_handler
+import settings
+from account import Account
+
+try:
+    import websockets
+except ImportError:
+    websockets = None
+
+MODULE_NAME = "Async Engine"
+
+_connections: list = []
+# One incident worker thread per account, so a slow outbox commit or render never
+# blocks the event loop, and each account's incidents are still handled in order.
+_workers: dict = {}
+
+
+class AccountConnection:
+    """Connection state for one account."""
+
+    def __init__(self, account: Account, label: str = None):
+        """
+        Args:
+            account (Account): The account to connect.
+            label (str): Name of the connection in logs and metrics. Defaults to the
+                account name, redundant connections are numbered, e.g. name#2.
+        """
+        current = settings.get()
+        self.account = account
+        self.label = label or account.name
+        self.force_update = False
+        self.alive_counter = 0
+        self.reconnect = reconnect.ReconnectEngine(
+            current.reconnect_min_delay,
+            current.reconnect_max_delay,
+            current.reconnect_auth_delay
+        )
+        self.liveness = liveness.Liveness(self.label, self.reconnect)
+
+
+def run(accounts: list) -> None:
+    """
+    Connect every account and handle their messages until interrupted.
+
+    Args:
+        accounts (list): The accounts to serve.
+    """
+    if websockets is None:
+        raise SystemExit("Serving several accounts needs the websockets package: pip install websockets")
+    try:
+        asyncio.run(_main(accounts))
+    except KeyboardInterrupt:
+        pass
+
+
+async def serve(accounts: list, stop: asyncio.Event) -> None:
+    """
+    Connect every account and handle their messages until stop is set.
+
+    With REDUNDANT_CONNECTIONS above 1 every account gets that many connections,
+    and the redundancy module drops the copies of the frames.
+
+    Args:
+        accounts (list): The accounts to serve.
+        stop (asyncio.Event): Set to disconnect and return.
+    """
+    copies = settings.get().redundant_connections
+    connections = []
+    for account in accounts:
+        if copies == 1:
+            connections.append(AccountConnection(account))
+        else:
+            connections.extend(AccountConnection(account, f"{account.name}#{i + 1}") for i in range(copies))
+    _connections[:] = connections
+    for account in accounts:
+        _workers[account.name] = concurrent.futures.ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix=f"incidents-{account.name}"
+        )
+    liveness.track([connection.liveness for connection in connections])
+    tasks = [asyncio.create_task(_run_connection(connection, stop)) for connection in connections]
+    for account in accounts:
+        if account.tokens is not None:
+            tasks.append(asyncio.create_task(_refresh_token(account, stop)))
+    _to_terminal(f"Serving {len(accounts)} account(s) over {len(connections)} connection(s)")
+    try:
+        await stop.wait()
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        # Let the incidents already received finish, without blocking the loop.
+        await asyncio.get_running_loop().run_in_executor(None, _stop_workers)
+
+
+def _stop_workers() -> None:
+    for worker in list(_workers.values()):
+        worker.shutdown(wait=True)
+    _workers.clear()
+
+
+def connections() -> list:
+    """
+    Get the connections currently being served.
+
+    Returns:
+        list: The AccountConnection objects.
+    """
+    return list(_connections)
+
+
+async def _main(accounts: list) -> None:
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, getattr(signal, "SIGTERM", None)):
+        if sig is None:
+            continue
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except NotImplementedError:
+            # Not supported on Windows, KeyboardInterrupt still stops asyncio.run.
+            pass
+    await serve(accounts, stop)
+
+
+async def _run_connection(connection: AccountConnection, stop: asyncio.Event) -> None:
+    """
+    Keep one account connected, reconnecting with backoff, until stop is set.
+
+    Args:
+        connection (AccountConnection): The connection to run.
+        stop (asyncio.Event): Set to stop.
+    """
+    loop = asyncio.get_running_loop()
+    while not stop.is_set():
+        connection.reconnect.connecting()
+        try:
+            token = await loop.run_in_executor(None, connection.account.get_token, connection.force_update)
+            connection.force_update = False
+        except oauth_handler.OAuthError as e:
+            await _wait_for_reconnect(connection, reconnect.AUTH, f"Could not get access token: {str(e)}", stop)
+            continue
+        except requests.RequestException as e:
+            await _wait_for_reconnect(connection, reconnect.NETWORK, f"Could not reach FSR for a token: {str(e)}", stop)
+            continue
+
+        try:
+            async with websockets.connect(
+                f"{settings.get().fsr_cable_url}?access_token={token}",
+                ping_interval=None,
+                open_timeout=10,
+                close_timeout=2,
+                max_size=None
+            ) as ws:
+                _to_terminal("WebSocket connected", connection)
+                connection.liveness.connected()
+                await ws.send(fsr_handler.SUBSCRIBE_MESSAGE)
+                await _receive(connection, ws)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            _to_terminal(f"WebSocket error {str(e)}", connection)
+        connection.liveness.disconnected()
+        connection.reconnect.connection_lost()
+        kind = reconnect.AUTH if connection.force_update else reconnect.NETWORK
+        await _wait_for_reconnect(connection, kind, "Connection lost", stop)
+
+
+async def _receive(connection: AccountConnection, ws) -> None:
+    """
+    Handle messages until the connection closes, or until no frame has arrived for
+    WATCHDOG_PING_TIMEOUT seconds, which means the connection is dead.
+
+    Args:
+        connection (AccountConnection): The connection.
+        ws: The open WebSocket.
+    """
+    while True:
+        timeout = settings.get().watchdog_ping_timeout
+        try:
+            message = await asyncio.wait_for(ws.recv(), timeout if timeout > 0 else None)
+        except asyncio.TimeoutError:
+            connection.liveness.force_reconnect(connection.liveness.silent_for())
+            return
+        except websockets.ConnectionClosedOK:
+            return
+        _handle_message(connection, message)
+
+
+async def _wait_for_reconnect(connection: AccountConnection, kind: str, reason: str, stop: asyncio.Event) -> None:
+    delay = connection.reconnect.failure(kind)
+    _to_terminal(f"{reason} - attempting to establish new connection in {delay:.1f} s", connection)
+    await _sleep(delay, stop)
+
+
+async def _refresh_token(account: Account, stop: asyncio.Event) -> None:
+    """
+    Refresh the account's token ahead of its expiry, until stop is set.
+
+    Args:
+        account (Account): The account.
+        stop (asyncio.Event): Set to stop.
+    """
+    loop = asyncio.get_running_loop()
+    while not stop.is_set():
+        delay = account.tokens.seconds_until_refresh()
+        if delay > 0:
+            await _sleep(delay, stop)
+            continue
+        await loop.run_in_executor(None, account.tokens.refresh)
+        # Never refresh more often than this, even if the token lifetime is short.
+        await _sleep(oauth_handler.REFRESH_RETRY_DELAY, stop)
+
+
+async def _sleep(delay: float, stop: asyncio.Event) -> None:
+    try:
+        await asyncio.wait_for(stop.wait(), delay)
+    except asyncio.TimeoutError:
+        pass
+
+
+def _handle_message(connection: AccountConnection, message: str) -> None:
+    """
+    Handle one message from FSR for an account, like fsr_handler.on_message does
+    for the single account.
+
+    Args:
+        connection (AccountConnection): The connection the message arrived on.
+        message (str): The received message in JSON format.
+    """
+    metrics.start_trace()
+    try:
+        with metrics.timed("parse"):
+            kind, msg = frames.classify(message)
+        connection.liveness.frame(kind)
+        metrics.inc("fsr_messages_total", help="Messages received from FSR by type", type=kind)
+        if kind == frames.INCIDENT and not redundancy.admit(connection, connection.account, message, msg):
+            return
+        _HANDLERS.get(kind, _on_incident)(connection, msg)
+    except Exception as e:
+        log_writer.to_error(MODULE_NAME, "Handle a new message", e, connection.label)
+
+
+def _on_ping(connection: AccountConnection, msg: dict) -> None:
+    connection.alive_counter -= 1
+    if connection.alive_counter <= 0:
+        _to_terminal("Alive ping", connection)
+        connection.alive_counter = 999
+
+
+def _on_welcome(connection: AccountConnection, msg: dict) -> None:
+    pass
+
+
+def _on_confirm_subscription(connection: AccountConnection, msg: dict) -> None:
+    blind = connection.reconnect.subscribed()
+    _to_terminal(f"New connection established (blind for {blind:.1f} s)", connection)
+    connection.alive_counter = 0
+
+
+def _on_disconnect(connection: AccountConnection, msg: dict) -> None:
+    if msg.get("reason") != "unauthorized":
+        _on_incident(connection, msg)
+        return
+    connection.force_update = True
+    request_handler.push_to_pushover_admin(
+        f"Connection for {connection.account.name} was closed because the user was not authorized", "default"
+    )
+
+
+def _on_incident(connection: AccountConnection, msg: dict) -> None:
+    worker = _workers.get(connection.account.name)
+    if worker is None:
+        _handle_incident(connection, msg, metrics.trace_started_at())
+        return
+    worker.submit(_handle_incident, connection, msg, metrics.trace_started_at())
+
+
+def _handle_incident(connection: AccountConnection, msg: dict, received_at: float) -> None:
+    """
+    Handle an incident on the account's worker thread. Storing its notifications
+    in the outbox waits for the commit, which must not hold up the event loop
+    and with it the pings and the liveness watchdog of every account.
+
+    Args:
+        connection (AccountConnection): The connection the incident arrived on.
+        msg (dict): The incident message.
+        received_at (float): When the frame was received, see metrics.start_trace.
+    """
+    metrics.start_trace(received_at)
+    try:
+        incident_handler.handle_incident(msg, connection.account)
+    except Exception as e:
+        log_writer.to_error(MODULE_NAME, "Handle a new message", e, connection.label)
+
+
+# Handler per message kind, see frames.classify and fsr_handler._HANDLERS.
+_HANDLERS = {
+    frames.PING: _on_ping,
+    frames.WELCOME: _on_welcome,
+    frames.CONFIRM_SUBSCRIPTION: _on_confirm_subscription,
+    frames.DISCONNECT: _on_disconnect,
+    frames.INCIDENT: _on_incident,
+}
+
+
+def _to_terminal(msg: str, connection: AccountConnection = None) -> None:
+    """
+    Log a message to the terminal using the writer module.
+
+    Args:
+        msg (str): The message to log.
+        connection (AccountConnection): The connection the message is about, if any.
+    """
+    module = MODULE_NAME if connection is None else f"{MODULE_NAME} {connection.label}"
+    log_writer.to_terminal(module, msg)
+
+
+def _collect_metrics() -> list:
+    """
+    Report the reconnect counters of every account to the metrics module.
+
+    Returns:
+        list: Metric samples, see metrics.register_collector.
+    """
+    samples = []
+    for connection in list(_connections):
+        stats = connection.reconnect.stats()
+        labels = {"account": connection.label}
+        samples.extend([
+            ("fsr_account_reconnects_total", "counter", "Reconnects per account", labels, stats["reconnects"]),
+            ("fsr_account_subscribed", "gauge", "1 if the account's subscription is confirmed", labels,
+             stats["state"] == reconnect.STATE_SUBSCRIBED),
+            ("fsr_account_blind_seconds_total", "counter", "Time without a confirmed subscription per account", labels,
+             stats["blind_seconds_total"]),
+        ])
+    return samples
+
+
+metrics.register_collector(_collect_metrics)
@@ -0,0 +1,194 @@
+"""
+Module: benchmarks.accounts
+Purpose: Measures memory and CPU per account when async_engine serves many FSR
+         accounts from one event loop. A local fake FSR cable server answers
+         the subscription and sends pings like FSR does, so the benchmark runs
+         fully offline. Every account count is measured in a fresh process.
+
+Run from the repository root, e.g.:
+    python -m benchmarks.accounts
+    python -m benchmarks.accounts --accounts 1 10 50 100 500 --window 20
+"""
+
+import argparse
+import asyncio
+import contextlib
+import json
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+
+BENCHMARK_ENV = {
+    "FSR_USERNAME": "benchmark",
+    "FSR_PASSWORD": "benchmark",
+    "ENABLE_PUSHOVER": "0",
+    "ENABLE_ADMIN": "0",
+    "ENABLE_RESPONDING": "0",
+    "PUSHOVER_TOKEN": "benchmark",
+    "PUSHOVER_USER_KEY": "benchmark",
+    "PUSHOVER_HEADER": "benchmark",
+    "HTTP_WARMUP_INTERVAL": "0",
+    "TOKEN_CACHE_PATH": "",
+    "METRICS_PORT": "0",
+}
+
+
+def _fake_fsr(port_queue: multiprocessing.Queue, ping_interval: float) -> None:
+    """
+    Run a fake FSR cable server until the process is terminated.
+
+    Args:
+        port_queue (multiprocessing.Queue): Receives the port the server listens on.
+        ping_interval (float): Seconds between pings on every connection.
+    """
+    import websockets
+
+    async def handler(ws):
+        try:
+            await ws.send(json.dumps({"type": "welcome"}))
+            await ws.recv()
+            await ws.send(json.dumps({"type": "confirm_subscription"}))
+            while True:
+                await asyncio.sleep(ping_interval)
+                await ws.send(json.dumps({"type": "ping", "message": int(time.time())}))
+        except websockets.ConnectionClosed:
+            pass
+
+    async def main():
+        async with websockets.serve(handler, "127.0.0.1", 0, ping_interval=None) as server:
+            port_queue.put(list(server.sockets)[0].getsockname()[1])
+            await asyncio.Future()
+
+    asyncio.run(main())
+
+
+def _measure(accounts: int, url: str, window: float, result_queue: multiprocessing.Queue) -> None:
+    """
+    Serve a number of accounts for a fixed window and report the cost.
+
+    Args:
+        accounts (int): Number of accounts to serve.
+        url (str): The fake cable server URL.
+        window (float): Seconds to measure after every account is subscribed.
+        result_queue (multiprocessing.Queue): Receives the result dict.
+    """
+    for key, value in BENCHMARK_ENV.items():
+        os.environ.setdefault(key, value)
+    os.environ["FSR_CABLE_URL"] = url
+
+    import account
+    import async_engine
+    import reconnect
+
+    account_list = []
+    for i in range(accounts):
+        entry = account.Account(f"bench{i}", f"user{i}", "benchmark")
+        # Pre-seed the tokens so no account tries to log in to the real FSR.
+        entry.tokens.access_token = f"token{i}"
+        entry.tokens.expires_at = time.time() + 86400
+        account_list.append(entry)
+
+    rss_before = _rss()
+
+    async def main():
+        stop = asyncio.Event()
+        task = asyncio.create_task(async_engine.serve(account_list, stop))
+        start = time.perf_counter()
+        while sum(c.reconnect.state == reconnect.STATE_SUBSCRIBED for c in async_engine.connections()) < accounts:
+            await asyncio.sleep(0.05)
+        subscribed = time.perf_counter() - start
+        cpu_start = time.process_time()
+        await asyncio.sleep(window)
+        cpu = time.process_time() - cpu_start
+        rss = _rss()
+        stop.set()
+        await task
+        return subscribed, cpu, rss
+
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        subscribed, cpu, rss = asyncio.run(main())
+    result_queue.put({
+        "accounts": accounts,
+        "subscribe_seconds": subscribed,
+        "cpu_seconds": cpu,
+        "rss_growth": rss - rss_before,
+    })
+
+
+def run(account_counts: list, window: float, ping_interval: float) -> list:
+    """
+    Measure every account count, each in its own process.
+
+    Args:
+        account_counts (list): The numbers of accounts to measure.
+        window (float): Seconds to measure for each count.
+        ping_interval (float): Seconds between pings from the fake server.
+
+    Returns:
+        list: One result dict per account count.
+    """
+    port_queue = multiprocessing.Queue()
+    server = multiprocessing.Process(target=_fake_fsr, args=(port_queue, ping_interval), daemon=True)
+    server.start()
+    url = f"ws://127.0.0.1:{port_queue.get(timeout=10)}/cable"
+    results = []
+    try:
+        for accounts in account_counts:
+            result_queue = multiprocessing.Queue()
+            worker = multiprocessing.Process(target=_measure, args=(accounts, url, window, result_queue))
+            worker.start()
+            results.append(result_queue.get())
+            worker.join()
+    finally:
+        server.terminate()
+        server.join()
+    return results
+
+
+def report(results: list, window: float) -> None:
+    """
+    Print the results.
+
+    Args:
+        results (list): The results from run.
+        window (float): The measured window in seconds.
+    """
+    print(f"{'Accounts':>8}  {'Subscribe':>10}  {'RSS growth':>11}  {'RSS/account':>12}  "
+          f"{'CPU':>7}  {'CPU/account':>12}")
+    for result in results:
+        accounts = result["accounts"]
+        cpu_share = result["cpu_seconds"] / window * 100
+        print(f"{accounts:>8}  {result['subscribe_seconds']:>8.3f} s  "
+              f"{result['rss_growth'] / 1024:>7,.0f} KiB  {result['rss_growth'] / 1024 / accounts:>8,.1f} KiB  "
+              f"{cpu_share:>6.2f}%  {cpu_share / accounts:>11.4f}%")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Measure the cost per account of the asyncio engine.")
+    parser.add_argument("--accounts", type=int, nargs="+", default=[1, 10, 50, 100], help="Account counts to measure")
+    parser.add_argument("--window", type=float, default=10.0, help="Seconds to measure for each count")
+    parser.add_argument("--ping-interval", type=float, default=3.0, help="Seconds between pings from the fake server")
+    args = parser.parse_args()
+
+    # Logs written by the engine go to a scratch directory, not the real log folders.
+    sys.path.insert(0, os.getcwd())
+    with tempfile.TemporaryDirectory() as scratch:
+        os.chdir(scratch)
+        report(run(args.accounts, args.window, args.ping_interval), args.window)
+
+
+def _rss() -> int:
+    """
+    Get the resident memory of this process in bytes (Linux only, 0 elsewhere).
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        return 0
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,137 @@
+"""
+Module: benchmarks.analytics
+Purpose: Compares answering the response statistics from the analytics files
+         with recomputing them from the raw incident archive, as the history
+         grows. A synthetic archive of several years is written to a scratch
+         folder, the statistics are rebuilt from it (a full rescan) and then
+         reported over the full history and over the last 30 days.
+
+Run from the repository root, e.g.:
+    python -m benchmarks.analytics
+    python -m benchmarks.analytics --years 1 5 --incidents-per-day 20
+"""
+
+import argparse
+import contextlib
+import datetime
+import os
+import random
+import sys
+import tempfile
+import time
+
+BENCHMARK_ENV = {
+    "FSR_USERNAME": "benchmark",
+    "FSR_PASSWORD": "benchmark",
+    "ENABLE_PUSHOVER": "0",
+    "ENABLE_ADMIN": "0",
+    "ENABLE_RESPONDING": "0",
+    "TOKEN_CACHE_PATH": "",
+    "METRICS_PORT": "0",
+}
+
+MEMBERS = 60
+UPDATES = 6
+STATUSES = ["acknowledged", "rejected", "absent"]
+
+
+def write_archive(years: int, per_day: int, seed: int) -> int:
+    """
+    Write a synthetic incident archive to the Incident folder of the working directory.
+
+    Every incident gets UPDATES frames over its first minutes, with more members
+    answering in every frame.
+
+    Returns:
+        int: The number of frames written.
+    """
+    import incident_archive
+
+    rng = random.Random(seed)
+    first_day = datetime.date.today() - datetime.timedelta(days=365 * years)
+    frames = 0
+    incident_id = 1000000
+    for offset in range(365 * years):
+        day = first_day + datetime.timedelta(days=offset)
+        midnight = datetime.datetime.combine(day, datetime.time()).timestamp()
+        records = []
+        for start in sorted(rng.uniform(0, 86000) for _ in range(rng.randint(per_day // 2, per_day * 3 // 2))):
+            incident_id += 1
+            answers = {}
+            for update in range(UPDATES):
+                for member in rng.sample(range(MEMBERS), 4):
+                    answers.setdefault(f"user{member}", rng.choice(STATUSES))
+                frame = {
+                    "identifier": "{\"channel\":\"IncidentNotificationsChannel\"}",
+                    "message": {
+                        "id": incident_id,
+                        "body": "Benchmark incident",
+                        "incident_responses": [{"user_name": name, "status": status} for name, status in answers.items()],
+                    },
+                }
+                records.append((day.isoformat(), midnight + start + update * rng.uniform(10, 60), frame))
+        records.sort(key=lambda record: record[1])
+        incident_archive.write(records)
+        frames += len(records)
+    incident_archive.close()
+    return frames
+
+
+def run(years: int, per_day: int) -> dict:
+    """
+    Write an archive of a number of years, rebuild the statistics and time the reports.
+
+    Returns:
+        dict: The results.
+    """
+    import analytics
+
+    frames = write_archive(years, per_day, years)
+
+    start = time.perf_counter()
+    analytics.rebuild("Analytics")
+    rescan = time.perf_counter() - start
+
+    start = time.perf_counter()
+    full = analytics.report_data("Analytics")
+    report_full = time.perf_counter() - start
+
+    start = time.perf_counter()
+    analytics.report_data("Analytics", datetime.datetime.now() - datetime.timedelta(days=30))
+    report_month = time.perf_counter() - start
+
+    size = sum(os.path.getsize(os.path.join("Analytics", name)) for name in os.listdir("Analytics"))
+    return {
+        "years": years,
+        "frames": frames,
+        "incidents": full.incidents,
+        "rescan": rescan,
+        "report_full": report_full,
+        "report_month": report_month,
+        "size": size,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Time the analytics reports against a rescan of the archive.")
+    parser.add_argument("--years", type=int, nargs="+", default=[1, 3], help="Years of history to measure")
+    parser.add_argument("--incidents-per-day", type=int, default=10, help="Average incidents per day")
+    args = parser.parse_args()
+
+    for key, value in BENCHMARK_ENV.items():
+        os.environ.setdefault(key, value)
+    # The archive and the analytics files are written to scratch directories.
+    sys.path.insert(0, os.getcwd())
+    print(f"{'Years':>5} {'Frames':>9} {'Incidents':>9} {'Rescan':>9} {'Report':>9} {'30 days':>9} {'Files':>9}")
+    for years in args.years:
+        with tempfile.TemporaryDirectory() as scratch:
+            os.chdir(scratch)
+            with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+                result = run(years, args.incidents_per_day)
+            print(f"{result['years']:>5} {result['frames']:>9} {result['incidents']:>9} "
+                  f"{result['rescan']:>8.2f}s {result['report_full'] * 1000:>7.1f}ms "
+                  f"{result['report_month'] * 1000:>7.1f}ms {result['size'] / 1024:>6.0f}KiB")
+
+
+if __name__ == "__main__":
+    main()
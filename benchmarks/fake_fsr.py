@@ -0,0 +1,431 @@
+"""
+Module: benchmarks.fake_fsr
+Purpose: A local stand-in for FSR with the OAuth token route and the
+         ActionCable /cable WebSocket. It answers the subscription like FSR
+         does, pings every connection, and plays a scripted scenario of ping
+         floods, incident floods, dropped connections, expired logins and
+         half-open sockets. Used by benchmarks.fsr_load, and can be run by
+         itself to point a real instance at it with FSR_TOKEN_URL and
+         FSR_CABLE_URL.
+
+A script is a comma separated list of steps:
+    incidents:N@R   Send N incident frames at R frames per second (R 0 = as fast as possible)
+    pings:N@R       Send N ping frames at R frames per second
+    drop            Abort every connection without a close frame
+    expire          Revoke every access token and disconnect with reason unauthorized
+    halfopen        Stop sending to and reading from every connection, but keep the sockets open
+    sleep:S         Wait S seconds
+Before a step sends frames it waits until a connection is subscribed, and after
+drop, expire and halfopen it measures how long the client takes to subscribe again.
+
+Run from the repository root, e.g.:
+    python -m benchmarks.fake_fsr --scenario flood
+    python -m benchmarks.fake_fsr --script "incidents:100@10,drop,incidents:100@10" --cable-port 8765 --token-port 8766
+"""
+
+import argparse
+import asyncio
+import json
+import secrets
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+import websockets
+
+SCENARIOS = {
+    "idle": "sleep:10",
+    "pings": "pings:50000@0",
+    "flood": "incidents:20000@5000",
+    "drops": "incidents:2000@1000,drop,incidents:2000@1000,drop,incidents:2000@1000",
+    "expiry": "incidents:500@500,expire,incidents:500@500,expire,incidents:500@500",
+    "halfopen": "incidents:500@500,halfopen,incidents:500@500",
+    "chaos": "pings:5000@0,incidents:3000@1500,drop,incidents:3000@1500,expire,incidents:1000@1000,halfopen,incidents:1000@1000",
+}
+
+SEND_STEPS = ("incidents", "pings")
+DISRUPT_STEPS = ("drop", "expire", "halfopen")
+
+IDENTIFIER = json.dumps({"channel": "IncidentNotificationsChannel"})
+# Incidents in flight at the same time, incident frames are updates of these.
+INCIDENTS_IN_FLIGHT = 50
+RESPONDERS = 5
+STATUSES = ["acknowledged", "rejected", "absent"]
+
+
+class ScriptError(Exception):
+    """Raised when a scenario script can not be parsed."""
+    pass
+
+
+def parse_script(script: str) -> list:
+    """
+    Parse a scenario script, see the module docstring.
+
+    Args:
+        script (str): The script, e.g. "incidents:1000@500,drop".
+
+    Returns:
+        list: Steps as dicts with "step", "kind", "count", "rate" and "seconds".
+
+    Raises:
+        ScriptError: If a step is unknown or its numbers are invalid.
+    """
+    steps = []
+    for text in (part.strip() for part in script.split(",")):
+        if not text:
+            continue
+        kind, _, args = text.partition(":")
+        step = {"step": text, "kind": kind, "count": 0, "rate": 0.0, "seconds": 0.0}
+        try:
+            if kind in SEND_STEPS:
+                count, _, rate = args.partition("@")
+                step["count"], step["rate"] = int(count), float(rate or 0)
+            elif kind == "sleep":
+                step["seconds"] = float(args)
+            elif kind not in DISRUPT_STEPS or args:
+                raise ScriptError(f"Unknown step {text}")
+        except ValueError:
+            raise ScriptError(f"Invalid numbers in step {text}")
+        steps.append(step)
+    return steps
+
+
+def incident_frame(sequence: int) -> str:
+    """
+    Build an incident frame. Every frame is an update of one of the incidents in
+    flight, and carries its sequence number so a client can tell which frames arrived.
+
+    Args:
+        sequence (int): The number of the frame.
+
+    Returns:
+        str: The frame as JSON.
+    """
+    incident = sequence % INCIDENTS_IN_FLIGHT
+    return json.dumps({
+        "identifier": IDENTIFIER,
+        "sequence": sequence,
+        "message": {
+            "id": 900000 + incident,
+            "body": f"Load test incident {incident} - Brand i bygning",
+            "location": f"Vej {incident}, 1234 By",
+            "address": {"latitude": 55.0 + incident / 1000, "longitude": 12.0},
+            "incident_responses": [
+                {"user_name": f"user{responder}", "status": STATUSES[(sequence // INCIDENTS_IN_FLIGHT + responder) % 3]}
+                for responder in range(RESPONDERS)
+            ],
+        },
+    }, separators=(",", ":"))
+
+
+class _TokenRoute(BaseHTTPRequestHandler):
+    """Answers POST /oauth/token like FSR does, with tokens issued by the FakeFSR."""
+
+    protocol_version = "HTTP/1.1"
+    fake = None
+
+    def do_POST(self):
+        form = parse_qs(self.rfile.read(int(self.headers.get("Content-Length", 0))).decode())
+        grant = form.get("grant_type", [""])[0]
+        if grant == "password" or (grant == "refresh_token" and self.fake.knows_refresh(form.get("refresh_token", [""])[0])):
+            status, body = 200, self.fake.issue_token()
+        else:
+            status, body = 401, {"error": "invalid_grant"}
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeFSR:
+    """
+    The fake FSR server. Run it with serve, which plays the script once and
+    returns what happened per step.
+    """
+
+    def __init__(self, script: str, ping_interval: float = 3.0, token_lifetime: float = 7200.0,
+                 expected_connections: int = 1, reconnect_timeout: float = 60.0):
+        """
+        Args:
+            script (str): The scenario script, see the module docstring.
+            ping_interval (float): Seconds between the pings sent to every connection.
+            token_lifetime (float): Seconds an issued access token is valid for.
+            expected_connections (int): Subscriptions to wait for before the script starts,
+                and after a disruption.
+            reconnect_timeout (float): Max seconds to wait for the client to subscribe.
+
+        Raises:
+            ScriptError: If the script can not be parsed.
+        """
+        self.steps = parse_script(script)
+        self.ping_interval = ping_interval
+        self.token_lifetime = token_lifetime
+        self.expected_connections = expected_connections
+        self.reconnect_timeout = reconnect_timeout
+        self.token_url = ""
+        self.cable_url = ""
+        self._lock = threading.Lock()
+        self._tokens: set = set()
+        self._refresh_tokens: set = set()
+        self._subscribed: set = set()
+        self._muted: set = set()
+        self._changed: asyncio.Event = None
+        self._sequence = 0
+        self._subscribed_at = 0.0
+        self.counters = {"connections": 0, "subscriptions": 0, "rejected": 0, "tokens": 0, "pings": 0}
+
+    def issue_token(self) -> dict:
+        """
+        Issue a new access token, called by the token route.
+
+        Returns:
+            dict: The token response.
+        """
+        access_token, refresh_token = secrets.token_hex(16), secrets.token_hex(16)
+        with self._lock:
+            self._tokens.add(access_token)
+            self._refresh_tokens.add(refresh_token)
+            self.counters["tokens"] += 1
+        return {
+            "access_token": access_token,
+            "refresh_token": refresh_token,
+            "token_type": "Bearer",
+            "expires_in": self.token_lifetime,
+            "created_at": int(time.time()),
+        }
+
+    def knows_refresh(self, refresh_token: str) -> bool:
+        with self._lock:
+            return refresh_token in self._refresh_tokens
+
+    async def serve(self, host: str = "127.0.0.1", cable_port: int = 0, token_port: int = 0, ready=None) -> list:
+        """
+        Start the token route and the cable server, play the script and stop.
+
+        Args:
+            host (str): Interface to listen on.
+            cable_port (int): Port of the cable server, 0 for any free port.
+            token_port (int): Port of the token route, 0 for any free port.
+            ready: Called with (token_url, cable_url) once both listen.
+
+        Returns:
+            list: One result dict per step, see _play.
+        """
+        self._changed = asyncio.Event()
+        token_server = ThreadingHTTPServer((host, token_port), type("TokenRoute", (_TokenRoute,), {"fake": self}))
+        token_server.daemon_threads = True
+        threading.Thread(target=token_server.serve_forever, name="fake-fsr-token", daemon=True).start()
+        try:
+            async with websockets.serve(self._handle, host, cable_port, ping_interval=None, max_size=None) as server:
+                self.token_url = f"http://{host}:{token_server.server_port}/oauth/token"
+                self.cable_url = f"ws://{host}:{list(server.sockets)[0].getsockname()[1]}/cable"
+                if ready is not None:
+                    ready(self.token_url, self.cable_url)
+                pinger = asyncio.create_task(self._ping_loop())
+                try:
+                    return await self._play()
+                finally:
+                    pinger.cancel()
+                    for ws in list(self._subscribed) + list(self._muted):
+                        ws.transport.abort()
+        finally:
+            token_server.shutdown()
+
+    async def _handle(self, ws) -> None:
+        """
+        Serve one connection: check the token, confirm the subscription and keep reading.
+        """
+        self.counters["connections"] += 1
+        token = parse_qs(urlsplit(ws.request.path).query).get("access_token", [""])[0]
+        with self._lock:
+            authorized = token in self._tokens
+        try:
+            if not authorized:
+                self.counters["rejected"] += 1
+                await ws.send(json.dumps({"type": "disconnect", "reason": "unauthorized", "reconnect": False}))
+                await ws.close()
+                return
+            await ws.send(json.dumps({"type": "welcome"}))
+            command = json.loads(await ws.recv())
+            if command.get("command") != "subscribe":
+                return
+            await ws.send(json.dumps({"identifier": command.get("identifier"), "type": "confirm_subscription"}))
+            self._subscribed.add(ws)
+            self._subscribed_at = time.monotonic()
+            self.counters["subscriptions"] += 1
+            self._changed.set()
+            async for _ in ws:
+                pass
+        except websockets.ConnectionClosed:
+            pass
+        finally:
+            self._subscribed.discard(ws)
+            self._changed.set()
+
+    async def _ping_loop(self) -> None:
+        while True:
+            await asyncio.sleep(self.ping_interval)
+            await self._broadcast(json.dumps({"type": "ping", "message": int(time.time())}))
+            self.counters["pings"] += 1
+
+    async def _broadcast(self, frame: str) -> bool:
+        """
+        Send a frame to every subscribed connection.
+
+        Returns:
+            bool: True if at least one connection got it.
+        """
+        sent = False
+        for ws in list(self._subscribed):
+            try:
+                await ws.send(frame)
+                sent = True
+            except websockets.ConnectionClosed:
+                self._subscribed.discard(ws)
+        return sent
+
+    async def _wait_subscribed(self, count: int, start: float = None) -> float:
+        """
+        Wait until count connections are subscribed.
+
+        Args:
+            count (int): The number of subscriptions to wait for.
+            start (float): time.monotonic() to measure from. Defaults to now.
+
+        Returns:
+            float: Seconds from start to the last subscription, or None if reconnect_timeout passed first.
+        """
+        start = time.monotonic() if start is None else start
+        while len(self._subscribed) < count:
+            left = self.reconnect_timeout - (time.monotonic() - start)
+            if left <= 0:
+                return None
+            self._changed.clear()
+            try:
+                await asyncio.wait_for(self._changed.wait(), left)
+            except asyncio.TimeoutError:
+                pass
+        return max(0.0, self._subscribed_at - start)
+
+    async def _play(self) -> list:
+        """
+        Play the steps of the script.
+
+        Returns:
+            list: Per step the step text and kind, its start and end (time.time()),
+                  the frames sent and not sent for lack of a connection, the range of
+                  sequence numbers used, and for disruptions the seconds until the
+                  client subscribed again (None if it did not).
+        """
+        await self._wait_subscribed(self.expected_connections)
+        results = []
+        for step in self.steps:
+            result = dict(step, start=time.time(), sent=0, unsent=0, first=self._sequence, reconnect=None)
+            if step["kind"] in SEND_STEPS:
+                await self._wait_subscribed(1)
+                await self._send_step(step, result)
+            elif step["kind"] == "sleep":
+                await asyncio.sleep(step["seconds"])
+            else:
+                disrupted_at = time.monotonic()
+                await self._disrupt(step["kind"])
+                result["reconnect"] = await self._wait_subscribed(self.expected_connections, disrupted_at)
+            result["end"] = time.time()
+            result["last"] = self._sequence
+            results.append(result)
+        return results
+
+    async def _send_step(self, step: dict, result: dict) -> None:
+        start = time.monotonic()
+        for i in range(step["count"]):
+            if step["rate"]:
+                delay = start + i / step["rate"] - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            elif i % 100 == 0:
+                # Let the connection handlers run during a flood as fast as possible.
+                await asyncio.sleep(0)
+            if step["kind"] == "incidents":
+                frame = incident_frame(self._sequence)
+                self._sequence += 1
+            else:
+                frame = json.dumps({"type": "ping", "message": int(time.time())})
+            if await self._broadcast(frame):
+                result["sent"] += 1
+            else:
+                result["unsent"] += 1
+
+    async def _disrupt(self, kind: str) -> None:
+        connections = list(self._subscribed)
+        self._subscribed.clear()
+        if kind == "drop":
+            for ws in connections:
+                ws.transport.abort()
+        elif kind == "expire":
+            with self._lock:
+                self._tokens.clear()
+            for ws in connections:
+                try:
+                    await ws.send(json.dumps({"type": "disconnect", "reason": "unauthorized", "reconnect": False}))
+                except websockets.ConnectionClosed:
+                    continue
+                # The close handshake runs in the background, the client may reconnect meanwhile.
+                asyncio.create_task(ws.close())
+        else:
+            for ws in connections:
+                ws.transport.pause_reading()
+                self._muted.add(ws)
+
+
+def report(results: list) -> None:
+    """
+    Print what the server did per step.
+
+    Args:
+        results (list): The results from FakeFSR.serve.
+    """
+    print(f"{'Step':<24} {'Seconds':>8} {'Sent':>8} {'Unsent':>7} {'Sent/s':>9} {'Reconnect':>10}")
+    for result in results:
+        seconds = result["end"] - result["start"]
+        rate = f"{result['sent'] / seconds:>9,.0f}" if result["kind"] in SEND_STEPS and seconds > 0 else f"{'':>9}"
+        reconnect = "" if result["kind"] not in DISRUPT_STEPS else (
+            "never" if result["reconnect"] is None else f"{result['reconnect']:.3f} s"
+        )
+        print(f"{result['step']:<24} {seconds:>8.2f} {result['sent']:>8} {result['unsent']:>7} {rate} {reconnect:>10}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Run a local fake FSR that plays a scenario.")
+    parser.add_argument("--scenario", choices=sorted(SCENARIOS), default="chaos", help="A built in scenario")
+    parser.add_argument("--script", help="A scenario script, overrides --scenario")
+    parser.add_argument("--host", default="127.0.0.1", help="Interface to listen on")
+    parser.add_argument("--cable-port", type=int, default=0, help="Port of the cable server (default any free port)")
+    parser.add_argument("--token-port", type=int, default=0, help="Port of the token route (default any free port)")
+    parser.add_argument("--ping-interval", type=float, default=3.0, help="Seconds between pings")
+    parser.add_argument("--connections", type=int, default=1, help="Subscriptions to wait for, e.g. REDUNDANT_CONNECTIONS")
+    args = parser.parse_args()
+
+    try:
+        fake = FakeFSR(args.script or SCENARIOS[args.scenario], args.ping_interval,
+                       expected_connections=args.connections, reconnect_timeout=3600)
+    except ScriptError as e:
+        raise SystemExit(str(e))
+
+    def ready(token_url, cable_url):
+        print(f"FSR_TOKEN_URL={token_url}\nFSR_CABLE_URL={cable_url}\nWaiting for {args.connections} subscription(s)...")
+
+    try:
+        report(asyncio.run(fake.serve(args.host, args.cable_port, args.token_port, ready)))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
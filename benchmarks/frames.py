@@ -0,0 +1,99 @@
+"""
+Module: benchmarks.frames
+Purpose: Micro-benchmark of the CPU cost of decoding one frame from the FSR
+         cable per frame type: a full json.loads followed by the if-chain the
+         message handlers used before, compared with frames.classify and the
+         handler table, with the json and the orjson backend.
+
+Run from the repository root:
+    python -m benchmarks.frames
+"""
+
+import json
+import time
+import frames
+
+ITERATIONS = 20000
+RESPONDER_COUNTS = [10, 100]
+
+
+def _compact(obj: object) -> str:
+    return json.dumps(obj, separators=(",", ":"), ensure_ascii=False)
+
+
+def _samples() -> list:
+    """
+    Build one frame of every type, written the way the ActionCable server writes them.
+    """
+    identifier = _compact({"channel": "IncidentNotificationsChannel"})
+    samples = [
+        ("ping", _compact({"type": "ping", "message": 1792321123})),
+        ("welcome", _compact({"type": "welcome"})),
+        ("confirm", _compact({"identifier": identifier, "type": "confirm_subscription"})),
+        ("disconnect", _compact({"type": "disconnect", "reason": "unauthorized", "reconnect": False})),
+    ]
+    for responders in RESPONDER_COUNTS:
+        samples.append((f"incident/{responders}", _compact({
+            "identifier": identifier,
+            "message": {
+                "id": 123456,
+                "body": "Brand i bygning - Vej 12, 1234 By",
+                "location": "Vej 12, 1234 By",
+                "address": {"latitude": 55.68, "longitude": 12.57},
+                "incident_responses": [
+                    {"user_name": f"user{i}", "status": "acknowledged" if i % 3 else "rejected"}
+                    for i in range(responders)
+                ],
+            },
+        })))
+    return samples
+
+
+def _if_chain(message: str) -> str:
+    """
+    Decode a frame the way the message handlers did before frames.classify.
+    """
+    msg = json.loads(message)
+    kind = msg.get("type") or "incident"
+    if msg.get("type") == "ping":
+        return kind
+    if msg.get("type") in ["ping", "welcome"]:
+        return kind
+    if msg.get("type") == "confirm_subscription":
+        return kind
+    if msg.get("type") == "disconnect" and msg.get("reason") == "unauthorized":
+        return kind
+    return kind
+
+
+def _classify(message: str) -> str:
+    """
+    Decode a frame the way the message handlers do now.
+    """
+    kind, msg = frames.classify(message)
+    return kind
+
+
+def _time(decode, message: str) -> float:
+    start = time.process_time()
+    for _ in range(ITERATIONS):
+        decode(message)
+    return (time.process_time() - start) / ITERATIONS * 1e6
+
+
+def main() -> None:
+    backends = [frames.BACKEND_JSON] + ([frames.BACKEND_ORJSON] if frames.orjson is not None else [])
+    columns = "".join(f"{'classify ' + name + ' us':>20}" for name in backends)
+    print(f"{'frame':>14} {'bytes':>7} {'if-chain us':>12}{columns}")
+    for name, message in _samples():
+        row = f"{name:>14} {len(message):>7} {_time(_if_chain, message):>12.3f}"
+        for backend in backends:
+            frames.set_backend(backend)
+            row += f"{_time(_classify, message):>20.3f}"
+        print(row)
+    if frames.orjson is None:
+        print("orjson is not installed, pip install orjson to compare it")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,206 @@
+"""
+Module: benchmarks.fsr_load
+Purpose: Load test of the FSR WebSocket path. A fake FSR (benchmarks.fake_fsr)
+         plays a scenario in its own process, while this process runs the real
+         client, fsr_handler or async_engine, against it through FSR_TOKEN_URL
+         and FSR_CABLE_URL. Reports per step the frames handled per second, the
+         incident frames sent but never handled, and how long the client took
+         to subscribe again after a dropped connection, an expired login or a
+         half-open socket.
+
+Run from the repository root, e.g.:
+    python -m benchmarks.fsr_load --scenario chaos
+    python -m benchmarks.fsr_load --scenario flood --engine async --connections 2
+    python -m benchmarks.fsr_load --script "incidents:5000@0,drop,incidents:5000@0"
+"""
+
+import argparse
+import asyncio
+import contextlib
+import multiprocessing
+import os
+import sys
+import tempfile
+import threading
+import time
+
+from benchmarks.fake_fsr import DISRUPT_STEPS, SCENARIOS, FakeFSR, ScriptError, parse_script
+
+# The client must never reach the real services, so configure it before the
+# client modules load their settings. FSR_TOKEN_URL and FSR_CABLE_URL are set
+# to the fake FSR once it listens.
+BENCHMARK_ENV = {
+    "FSR_USERNAME": "benchmark",
+    "FSR_PASSWORD": "benchmark",
+    "ENABLE_PUSHOVER": "0",
+    "ENABLE_ADMIN": "0",
+    "ENABLE_RESPONDING": "0",
+    "PUSHOVER_TOKEN": "benchmark",
+    "PUSHOVER_USER_KEY": "benchmark",
+    "PUSHOVER_HEADER": "benchmark",
+    "HTTP_WARMUP_INTERVAL": "0",
+    "TOKEN_CACHE_PATH": "",
+    "METRICS_PORT": "0",
+    "OUTBOX_PATH": "",
+    # Find half-open sockets within seconds, not the default 30.
+    "WATCHDOG_PING_TIMEOUT": "3",
+    "RECONNECT_MAX_DELAY": "5",
+}
+
+# Seconds without a new frame before the client is considered done after the script.
+SETTLE_SECONDS = 1.0
+
+
+def _serve(script: str, ping_interval: float, connections: int, urls: multiprocessing.Queue,
+           results: multiprocessing.Queue) -> None:
+    """
+    Run the fake FSR in its own process, so it does not compete with the client for the GIL.
+    """
+    fake = FakeFSR(script, ping_interval, expected_connections=connections)
+    results.put(asyncio.run(fake.serve(ready=lambda token_url, cable_url: urls.put((token_url, cable_url)))))
+
+
+def run(script: str, engine: str, connections: int, ping_interval: float) -> dict:
+    """
+    Play a script against the real client.
+
+    Args:
+        script (str): The scenario script, see benchmarks.fake_fsr.
+        engine (str): "sync" for fsr_handler, "async" for async_engine.
+        connections (int): REDUNDANT_CONNECTIONS, above 1 needs the async engine.
+        ping_interval (float): Seconds between pings from the fake FSR.
+
+    Returns:
+        dict: "steps" from the fake FSR, "handled" (sequence -> time.time()) and
+              "frames" (list of (time.time(), kind)) from the client.
+    """
+    urls, results = multiprocessing.Queue(), multiprocessing.Queue()
+    server = multiprocessing.Process(target=_serve, args=(script, ping_interval, connections, urls, results), daemon=True)
+    server.start()
+    token_url, cable_url = urls.get(timeout=10)
+
+    for key, value in BENCHMARK_ENV.items():
+        os.environ.setdefault(key, value)
+    os.environ["FSR_TOKEN_URL"] = token_url
+    os.environ["FSR_CABLE_URL"] = cable_url
+    os.environ["REDUNDANT_CONNECTIONS"] = str(connections)
+
+    import account
+    import async_engine
+    import frames
+    import fsr_handler
+    import incident_handler
+    import log_writer
+    import request_handler
+
+    handled: dict = {}
+    received: list = []
+    classify = frames.classify
+    handle_incident = incident_handler.handle_incident
+
+    def counting_classify(message):
+        result = classify(message)
+        received.append((time.time(), result[0]))
+        return result
+
+    def counting_handle_incident(wrapper, account=None):
+        handled.setdefault(wrapper.get("sequence"), time.time())
+        handle_incident(wrapper, account)
+
+    frames.classify = counting_classify
+    incident_handler.handle_incident = counting_handle_incident
+    request_handler.start_dispatcher()
+
+    loop, stop = None, None
+    if engine == "sync":
+        client = threading.Thread(target=fsr_handler.run, name="fsr-client", daemon=True)
+    else:
+        loop = asyncio.new_event_loop()
+        stop = asyncio.Event()
+
+        def run_async():
+            asyncio.set_event_loop(loop)
+            loop.run_until_complete(async_engine.serve([account.default], stop))
+
+        client = threading.Thread(target=run_async, name="fsr-client", daemon=True)
+
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        client.start()
+        steps = results.get()
+        # Wait for the frames still on their way to the client.
+        while received and time.time() - received[-1][0] < SETTLE_SECONDS:
+            time.sleep(0.1)
+        if loop is not None:
+            loop.call_soon_threadsafe(stop.set)
+            client.join(timeout=10)
+        request_handler.stop_dispatcher()
+        log_writer.shutdown()
+    server.join(timeout=5)
+    return {"steps": steps, "handled": handled, "frames": list(received)}
+
+
+def report(result: dict) -> None:
+    """
+    Print the results per step and in total.
+
+    Args:
+        result (dict): The result from run.
+    """
+    handled = result["handled"]
+    steps = result["steps"]
+    print(f"{'Step':<24} {'Sent':>7} {'Handled':>8} {'Dropped':>8} {'Unsent':>7} "
+          f"{'Sent/s':>9} {'Handled/s':>10} {'Received/s':>11} {'Reconnect':>10}")
+    totals = {"sent": 0, "handled": 0, "dropped": 0, "unsent": 0}
+    for index, step in enumerate(steps):
+        end = steps[index + 1]["start"] if index + 1 < len(steps) else step["end"] + SETTLE_SECONDS
+        seconds = max(step["end"] - step["start"], 1e-9)
+        received = sum(1 for at, _ in result["frames"] if step["start"] <= at < end)
+        line = f"{step['step']:<24} "
+        if step["kind"] == "incidents":
+            times = [handled[seq] for seq in range(step["first"], step["last"]) if seq in handled]
+            dropped = step["sent"] - len(times)
+            handled_seconds = max(max(times, default=step["start"]) - step["start"], 1e-9)
+            line += (f"{step['sent']:>7} {len(times):>8} {dropped:>8} {step['unsent']:>7} "
+                     f"{step['sent'] / seconds:>9,.0f} {len(times) / handled_seconds:>10,.0f} ")
+            totals["sent"] += step["sent"]
+            totals["handled"] += len(times)
+            totals["dropped"] += dropped
+            totals["unsent"] += step["unsent"]
+        elif step["kind"] == "pings":
+            line += f"{step['sent']:>7} {'':>8} {'':>8} {step['unsent']:>7} {step['sent'] / seconds:>9,.0f} {'':>10} "
+        else:
+            line += f"{'':>7} {'':>8} {'':>8} {'':>7} {'':>9} {'':>10} "
+        line += f"{received / max(end - step['start'], 1e-9):>11,.0f} "
+        if step["kind"] in DISRUPT_STEPS:
+            line += f"{'never' if step['reconnect'] is None else format(step['reconnect'], '.3f') + ' s':>10}"
+        print(line.rstrip())
+    print(f"\nIncident frames: {totals['sent']} sent, {totals['handled']} handled, {totals['dropped']} dropped "
+          f"(sent but not handled), {totals['unsent']} not sent (no connection)")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Load test the FSR WebSocket client against a local fake FSR.")
+    parser.add_argument("--scenario", choices=sorted(SCENARIOS), default="chaos", help="A built in scenario")
+    parser.add_argument("--script", help="A scenario script, overrides --scenario (see benchmarks.fake_fsr)")
+    parser.add_argument("--engine", choices=["sync", "async"], default="sync", help="fsr_handler or async_engine")
+    parser.add_argument("--connections", type=int, default=1, help="REDUNDANT_CONNECTIONS, needs --engine async above 1")
+    parser.add_argument("--ping-interval", type=float, default=1.0, help="Seconds between pings from the fake FSR")
+    args = parser.parse_args()
+
+    script = args.script or SCENARIOS[args.scenario]
+    try:
+        parse_script(script)
+    except ScriptError as e:
+        raise SystemExit(str(e))
+    if args.connections > 1 and args.engine != "async":
+        raise SystemExit("--connections above 1 needs --engine async")
+
+    # Logs written by the client go to a scratch directory, not the real log folders.
+    sys.path.insert(0, os.getcwd())
+    with tempfile.TemporaryDirectory() as scratch:
+        os.chdir(scratch)
+        report(run(script, args.engine, args.connections, args.ping_interval))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+"""
+Module: benchmarks.geo
+Purpose: Micro-benchmark of the map data lookups done for every new incident:
+         the nearest station and the points within GEO_NEARBY_RADIUS, with the
+         grid indexes of geo_index compared with a scan of every point, as the
+         number of points grows. The grid results are checked against the scan.
+
+Run from the repository root:
+    python -m benchmarks.geo
+"""
+
+import random
+import time
+from geo_index import GeoIndex, GeoPoint, POINT_CELL_DEGREES, STATION_CELL_DEGREES, distance_km
+
+POINT_COUNTS = [100, 10000, 100000, 1000000]
+STATIONS = 100
+LOOKUPS = 2000
+STATION_RADIUS_KM = 50.0
+NEARBY_RADIUS_KM = 0.25
+NEARBY_MAX = 3
+# A box around Denmark.
+LATITUDES = (54.5, 57.8)
+LONGITUDES = (8.0, 12.7)
+
+
+def _random_points(rng: random.Random, kind: str, count: int) -> list:
+    return [
+        GeoPoint(kind, f"{kind}{i}", rng.uniform(*LATITUDES), rng.uniform(*LONGITUDES))
+        for i in range(count)
+    ]
+
+
+def _scan_nearest(points: list, latitude: float, longitude: float) -> tuple:
+    best = min(points, key=lambda point: distance_km(latitude, longitude, point.latitude, point.longitude))
+    km = distance_km(latitude, longitude, best.latitude, best.longitude)
+    return (best, km) if km <= STATION_RADIUS_KM else None
+
+
+def _scan_within(points: list, latitude: float, longitude: float) -> list:
+    found = [(point, distance_km(latitude, longitude, point.latitude, point.longitude)) for point in points]
+    found = sorted((item for item in found if item[1] <= NEARBY_RADIUS_KM), key=lambda item: item[1])
+    return found[:NEARBY_MAX]
+
+
+def _percentile(values: list, fraction: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def _run(point_count: int) -> tuple:
+    rng = random.Random(point_count)
+    stations = _random_points(rng, "station", STATIONS)
+    hydrants = _random_points(rng, "hydrant", point_count)
+    lookups = [(rng.uniform(*LATITUDES), rng.uniform(*LONGITUDES)) for _ in range(LOOKUPS)]
+
+    start = time.perf_counter()
+    station_index = GeoIndex(stations, STATION_CELL_DEGREES)
+    hydrant_index = GeoIndex(hydrants, POINT_CELL_DEGREES)
+    build_ms = (time.perf_counter() - start) * 1000
+
+    index_us = []
+    for latitude, longitude in lookups:
+        start = time.perf_counter()
+        station_index.nearest(latitude, longitude, STATION_RADIUS_KM)
+        hydrant_index.within(latitude, longitude, NEARBY_RADIUS_KM, NEARBY_MAX)
+        index_us.append((time.perf_counter() - start) * 1e6)
+
+    # A full scan of a million points takes seconds, so only a few lookups are scanned.
+    scan_us = []
+    for latitude, longitude in lookups[:max(5, 200000 // point_count)]:
+        start = time.perf_counter()
+        nearest = _scan_nearest(stations, latitude, longitude)
+        within = _scan_within(hydrants, latitude, longitude)
+        scan_us.append((time.perf_counter() - start) * 1e6)
+        assert nearest == station_index.nearest(latitude, longitude, STATION_RADIUS_KM)
+        assert within == hydrant_index.within(latitude, longitude, NEARBY_RADIUS_KM, NEARBY_MAX)
+    return build_ms, _percentile(index_us, 0.5), _percentile(index_us, 0.99), _percentile(scan_us, 0.5)
+
+
+def main() -> None:
+    print(f"{'points':>9} {'build ms':>9} {'grid p50 us':>12} {'grid p99 us':>12} {'scan p50 us':>12}")
+    for point_count in POINT_COUNTS:
+        build_ms, p50, p99, scan = _run(point_count)
+        print(f"{point_count:>9} {build_ms:>9.1f} {p50:>12.1f} {p99:>12.1f} {scan:>12.0f}")
+
+
+if __name__ == "__main__":
+    main()
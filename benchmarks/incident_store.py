@@ -0,0 +1,112 @@
+"""
+Module: benchmarks.incident_store
+Purpose: Micro-benchmark of the per-message cost of the incident store, compared
+         with the list based bookkeeping it replaced, as the number of concurrent
+         incidents and responders grows. The diff column is the change detection
+         path incident_handler uses, for update frames where nothing changed.
+
+Run from the repository root:
+    python -m benchmarks.incident_store
+"""
+
+import time
+from datetime import datetime, timedelta
+from incident_store import IncidentStore
+
+INCIDENT_COUNTS = [1, 10, 100, 1000]
+RESPONDER_COUNTS = [10, 100, 500]
+MESSAGES = 2000
+
+
+def _list_message(incidents: list, msg: dict) -> list:
+    """
+    One message handled the way incident_handler did it with a list of dicts.
+    """
+    threshold = datetime.now() - timedelta(minutes=10)
+    incidents = [entry for entry in incidents if entry["timestamp"] >= threshold]
+    if any(entry["id"] == msg["id"] for entry in incidents):
+        incident = next(entry for entry in incidents if entry["id"] == msg["id"])
+        for user in msg["incident_responses"]:
+            if user["status"] == "acknowledged" and not any(p == user["user_name"] for p in incident["people"]):
+                incident["people"].append(user["user_name"])
+        next(entry for entry in incidents if entry["id"] == msg["id"])
+    return incidents
+
+
+def _store_message(store: IncidentStore, msg: dict) -> None:
+    """
+    One message handled the way incident_handler does it with the store.
+    """
+    store.expire()
+    if msg["id"] in store:
+        store.add_responders(msg["id"], [
+            user["user_name"] for user in msg["incident_responses"] if user["status"] == "acknowledged"
+        ])
+        store.get(msg["id"])
+
+
+def _diff_message(store: IncidentStore, msg: dict) -> None:
+    """
+    One message handled the way incident_handler does it with change detection.
+    """
+    store.expire()
+    if msg["id"] in store:
+        delta = store.update_responses(msg["id"], msg["incident_responses"])
+        if delta:
+            store.add_responders(msg["id"], [
+                user_name for user_name, (old, new) in delta.items() if new == "acknowledged"
+            ])
+        store.get(msg["id"])
+
+
+def _frames(incident_count: int, responder_count: int) -> list:
+    """
+    Build update frames that cycle over the incidents, each with every responder acknowledged.
+    """
+    responses = [{"user_name": f"user{i}", "status": "acknowledged"} for i in range(responder_count)]
+    return [{"id": i % incident_count, "incident_responses": responses} for i in range(MESSAGES)]
+
+
+def _run(incident_count: int, responder_count: int) -> tuple:
+    frames = _frames(incident_count, responder_count)
+
+    store = IncidentStore()
+    for i in range(incident_count):
+        store.add(i)
+    start = time.perf_counter()
+    for msg in frames:
+        _store_message(store, msg)
+    store_us = (time.perf_counter() - start) / MESSAGES * 1e6
+
+    store = IncidentStore()
+    for i in range(incident_count):
+        store.add(i)
+    start = time.perf_counter()
+    for msg in frames:
+        _diff_message(store, msg)
+    diff_us = (time.perf_counter() - start) / MESSAGES * 1e6
+
+    incidents = [
+        {"id": i, "timestamp": datetime.now(), "people": []} for i in range(incident_count)
+    ]
+    start = time.perf_counter()
+    for msg in frames:
+        incidents = _list_message(incidents, msg)
+    list_us = (time.perf_counter() - start) / MESSAGES * 1e6
+    return store_us, diff_us, list_us
+
+
+def main() -> None:
+    print(f"{'incidents':>10} {'responders':>11} {'store us/msg':>13} {'store us/resp':>14} "
+          f"{'diff us/msg':>12} {'list us/msg':>12}")
+    for responder_count in RESPONDER_COUNTS:
+        for incident_count in INCIDENT_COUNTS:
+            store_us, diff_us, list_us = _run(incident_count, responder_count)
+            print(
+                f"{incident_count:>10} {responder_count:>11} {store_us:>13.2f} "
+                f"{store_us / responder_count:>14.3f} {diff_us:>12.2f} {list_us:>12.2f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+"""
+Module: benchmarks.profiler
+Purpose: Measures what the profiling hooks cost the message path. Synthetic
+         incident frames are fed to fsr_handler.on_message with profiling off,
+         while a CPU profile samples it, and while tracemalloc traces it, and
+         the frames handled per second are compared. The profiles written are
+         kept in the scratch folder's Profiles folder and listed.
+
+Run from the repository root, e.g.:
+    python -m benchmarks.profiler
+    python -m benchmarks.profiler --frames 20000 --interval 0.001
+"""
+
+import argparse
+import contextlib
+import json
+import os
+import sys
+import tempfile
+import time
+
+BENCHMARK_ENV = {
+    "FSR_USERNAME": "benchmark",
+    "FSR_PASSWORD": "benchmark",
+    "ENABLE_PUSHOVER": "0",
+    "ENABLE_ADMIN": "0",
+    "ENABLE_RESPONDING": "0",
+    "TOKEN_CACHE_PATH": "",
+    "METRICS_PORT": "0",
+    "OUTBOX_PATH": "",
+    "HTTP_WARMUP_INTERVAL": "0",
+}
+
+INCIDENTS = 50
+RESPONDERS = 60
+
+
+def _frames(count: int) -> list:
+    """
+    Build incident frames where the responders of INCIDENTS incidents answer one by one.
+    """
+    identifier = json.dumps({"channel": "IncidentNotificationsChannel"})
+    result = []
+    for number in range(count):
+        incident = number % INCIDENTS
+        answered = number // INCIDENTS % RESPONDERS + 1
+        result.append(json.dumps({
+            "identifier": identifier,
+            "message": {
+                "id": 500000 + incident,
+                "body": f"Benchmark incident {incident}",
+                "incident_responses": [
+                    {"user_name": f"user{i}", "status": "acknowledged" if i % 3 else "rejected"}
+                    for i in range(answered)
+                ],
+            },
+        }))
+    return result
+
+
+def _rate(frames: list) -> float:
+    import fsr_handler
+
+    start = time.perf_counter()
+    for frame in frames:
+        fsr_handler.on_message(None, frame)
+    return len(frames) / (time.perf_counter() - start)
+
+
+def run(count: int, interval: float) -> list:
+    """
+    Feed the frames with profiling off, sampled and traced.
+
+    Returns:
+        list: (mode, frames per second) tuples.
+    """
+    import profiler
+
+    os.environ["PROFILE_SAMPLE_INTERVAL"] = str(interval)
+    frames = _frames(count)
+    _rate(frames)  # Warm up, so every run sees incidents that are already known.
+    results = [("off", _rate(frames))]
+
+    profiler.start_cpu(duration=3600)
+    results.append((f"cpu every {interval * 1000:g} ms", _rate(frames)))
+    profiler.stop()
+
+    profiler.memory_snapshot()
+    results.append(("tracemalloc", _rate(frames)))
+    profiler.memory_snapshot()
+    profiler.stop()
+
+    results.append(("off again", _rate(frames)))
+    return results
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Measure the overhead of the profiling hooks on the message path.")
+    parser.add_argument("--frames", type=int, default=10000, help="Incident frames per run")
+    parser.add_argument("--interval", type=float, default=0.005, help="Seconds between CPU samples")
+    args = parser.parse_args()
+
+    for key, value in BENCHMARK_ENV.items():
+        os.environ.setdefault(key, value)
+    sys.path.insert(0, os.getcwd())
+    with tempfile.TemporaryDirectory() as scratch:
+        os.chdir(scratch)
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            results = run(args.frames, args.interval)
+            import log_writer
+            log_writer.shutdown()
+        base = results[0][1]
+        print(f"{'Profiling':<20} {'Frames/s':>10} {'Overhead':>9}")
+        for mode, rate in results:
+            print(f"{mode:<20} {rate:>10,.0f} {(base / rate - 1) * 100:>8.1f}%")
+        print("\nWritten: " + ", ".join(sorted(os.listdir("Profiles"))))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+"""
+Module: benchmarks.receipts
+Purpose: Measures the cost of following up on emergency-priority pages as the
+         number of pages waiting to be acknowledged grows. A local stub answers
+         the Pushover receipt requests and counts them, and every round of the
+         receipts module is timed, in requests and in CPU time (the stub runs
+         in the same process), against polling every outstanding receipt once
+         per round.
+
+Run from the repository root, e.g.:
+    python -m benchmarks.receipts
+    python -m benchmarks.receipts --outstanding 100 10000 --rounds 50
+"""
+
+import argparse
+import contextlib
+import http.server
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+
+BENCHMARK_ENV = {
+    "FSR_USERNAME": "benchmark",
+    "FSR_PASSWORD": "benchmark",
+    "ENABLE_PUSHOVER": "0",
+    "ENABLE_ADMIN": "0",
+    "ENABLE_RESPONDING": "0",
+    "TOKEN_CACHE_PATH": "",
+    "METRICS_PORT": "0",
+    # The rounds are driven by the benchmark, not by the background thread.
+    "PUSHOVER_RECEIPT_POLL_INTERVAL": "3600",
+}
+
+
+class _ReceiptRoute(http.server.BaseHTTPRequestHandler):
+    """Answers every receipt request with a page that is not acknowledged yet."""
+
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+    requests = 0
+    lock = threading.Lock()
+
+    def do_GET(self):
+        with _ReceiptRoute.lock:
+            _ReceiptRoute.requests += 1
+        body = json.dumps({"status": 1, "acknowledged": 0, "expired": 0, "request": "benchmark"}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def run(outstanding: int, rounds: int, base_url: str) -> dict:
+    """
+    Track a number of receipts and time polling rounds over them.
+
+    Args:
+        outstanding (int): The number of receipts waiting to be acknowledged.
+        rounds (int): The number of polling rounds to time.
+        base_url (str): The URL of the receipt stub.
+
+    Returns:
+        dict: The results.
+    """
+    import receipts
+    import settings
+
+    receipts.RECEIPT_ENDPOINT = base_url + "/1/receipts/{receipt}.json"
+    interval = settings.get().pushover_receipt_poll_interval
+    for number in range(outstanding):
+        receipts.track(f"r{number}", {"token": "benchmark", "user": f"user{number}", "message": "Benchmark", "expire": 10800})
+
+    _ReceiptRoute.requests = 0
+    wall, cpu = time.perf_counter(), time.process_time()
+    for _ in range(rounds):
+        # Every receipt is due in every round.
+        receipts.poll_due(time.time() + 2 * interval)
+    wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+    result = {
+        "outstanding": outstanding,
+        "requests": _ReceiptRoute.requests / rounds,
+        "cpu": cpu / rounds,
+        "wall": wall / rounds,
+        "naive_requests": outstanding,
+    }
+    receipts.stop()
+    return result
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Time polling Pushover receipts as the number of pages grows.")
+    parser.add_argument("--outstanding", type=int, nargs="+", default=[100, 1000, 10000],
+                        help="Numbers of pages waiting to be acknowledged")
+    parser.add_argument("--rounds", type=int, default=20, help="Polling rounds to time")
+    args = parser.parse_args()
+
+    for key, value in BENCHMARK_ENV.items():
+        os.environ.setdefault(key, value)
+    sys.path.insert(0, os.getcwd())
+
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), _ReceiptRoute)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f"http://127.0.0.1:{server.server_address[1]}"
+
+    print(f"{'Pages':>7} {'Requests/round':>15} {'CPU/round':>10} {'Time/round':>11} {'Polling every page':>19}")
+    with tempfile.TemporaryDirectory() as scratch:
+        os.chdir(scratch)
+        for outstanding in args.outstanding:
+            with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+                result = run(outstanding, args.rounds, base_url)
+            print(f"{result['outstanding']:>7} {result['requests']:>15.0f} {result['cpu'] * 1000:>8.2f}ms "
+                  f"{result['wall'] * 1000:>9.2f}ms {result['naive_requests']:>10} requests")
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,348 @@
+"""
+Module: benchmarks.replay
+Purpose: Replays captured incident logs, or synthetic bursts of incidents,
+         through the full pipeline (fsr_handler.on_message -> incident_handler ->
+         message_handler -> request_handler) against a local stub Pushover server,
+         and reports throughput, per-stage latency percentiles and memory growth.
+         Runs fully offline, so it can be used to catch performance regressions
+         before deploying.
+
+Run from the repository root, e.g.:
+    python -m benchmarks.replay --synthetic --incidents 50 --responders 300
+    python -m benchmarks.replay Incident/2026-10-01.jsonl Incident/2026-10-02.jsonl.gz
+"""
+
+import argparse
+import ast
+import contextlib
+import gc
+import gzip
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# The benchmark must never reach the real services, so configure it before the
+# pipeline modules load their settings.
+BENCHMARK_ENV = {
+    "FSR_USERNAME": "benchmark",
+    "FSR_PASSWORD": "benchmark",
+    "ENABLE_PUSHOVER": "1",
+    "ENABLE_ADMIN": "0",
+    "ENABLE_RESPONDING": "1",
+    "PUSHOVER_TOKEN": "benchmark",
+    "PUSHOVER_USER_KEY": "benchmark",
+    "PUSHOVER_HEADER": "benchmark",
+    "RESPONDING_USER_NAME": "user0",
+    "RESPONDING_MSG": "benchmark responding",
+    "DISPATCH_QUEUE_SIZE": "100000",
+    "DISPATCH_WORKERS": "4",
+    # Measure the pipeline itself, not the Pushover rate limiter.
+    "PUSHOVER_RATE": "1000000",
+    "PUSHOVER_BURST": "1000000",
+    "HTTP_WARMUP_INTERVAL": "0",
+    "TOKEN_CACHE_PATH": "",
+    "METRICS_PORT": "0",
+}
+
+STAGES = ["parse", "log_write", "classify", "render", "queue_wait", "http_send"]
+STATUSES = ["acknowledged", "rejected", "acknowledged", "absent"]
+
+
+class _StubPushover(BaseHTTPRequestHandler):
+    """Answers every POST like Pushover does, after an optional delay."""
+
+    protocol_version = "HTTP/1.1"
+    delay = 0.0
+    requests = 0
+    lock = threading.Lock()
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if self.delay:
+            time.sleep(self.delay)
+        with self.lock:
+            _StubPushover.requests += 1
+        body = b'{"status":1,"request":"benchmark"}'
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("X-Limit-App-Limit", "10000000")
+        self.send_header("X-Limit-App-Remaining", "10000000")
+        self.send_header("X-Limit-App-Reset", str(int(time.time()) + 86400))
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def load_frames(paths: list) -> list:
+    """
+    Load captured frames from incident archive files (.jsonl or .jsonl.gz),
+    or from the older .log files.
+
+    Args:
+        paths (list): Paths of incident log files, one frame per line.
+
+    Returns:
+        list: The frames as JSON strings, in the order they were captured.
+    """
+    frames = []
+    for path in paths:
+        opener = gzip.open if path.endswith(".gz") else open
+        with opener(path, "rt", encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    record = json.loads(line)
+                    frame = record.get("frame", record)
+                except ValueError:
+                    # Older logs hold the Python repr of the frame.
+                    frame = ast.literal_eval(line)
+                frames.append(json.dumps(frame))
+    return frames
+
+
+def synthetic_frames(incidents: int, responders: int, updates: int, ping_ratio: float, seed: int) -> list:
+    """
+    Build a burst of concurrent incidents with many responders.
+
+    Every incident starts with a frame without responses, followed by update
+    frames where more and more responders answer. Updates of different
+    incidents are interleaved, and pings are mixed in.
+
+    Args:
+        incidents (int): Number of concurrent incidents.
+        responders (int): Number of responders per incident.
+        updates (int): Number of update frames per incident.
+        ping_ratio (float): Number of pings per incident frame.
+        seed (int): Seed for the random generator.
+
+    Returns:
+        list: The frames as JSON strings.
+    """
+    rng = random.Random(seed)
+    per_incident = []
+    for incident in range(incidents):
+        frames = []
+        responses = []
+        for update in range(updates + 1):
+            answered = responders * update // max(1, updates)
+            while len(responses) < answered:
+                responses.append({
+                    "user_name": f"user{len(responses)}",
+                    "status": rng.choice(STATUSES),
+                })
+            frames.append({
+                "identifier": "{\"channel\":\"IncidentNotificationsChannel\"}",
+                "message": {
+                    "id": 100000 + incident,
+                    "body": f"Benchmark incident {incident} - Brand i bygning",
+                    "location": "MTV" if incident % 2 else f"Vej {incident}, 1234 By",
+                    "address": {"latitude": 55.0 + incident / 1000, "longitude": 12.0},
+                    "incident_responses": list(responses),
+                },
+            })
+        per_incident.append(frames)
+
+    result = []
+    ping = json.dumps({"type": "ping", "message": 0}, separators=(",", ":"))
+    pending_pings = 0.0
+    for update in range(updates + 1):
+        for frames in per_incident:
+            result.append(json.dumps(frames[update]))
+            pending_pings += ping_ratio
+            while pending_pings >= 1:
+                result.append(ping)
+                pending_pings -= 1
+    return result
+
+
+def run(frames: list, pushover_delay: float, trace_memory: bool) -> dict:
+    """
+    Feed the frames through the pipeline and wait until every notification is sent.
+
+    Args:
+        frames (list): The frames as JSON strings.
+        pushover_delay (float): Seconds the stub Pushover server waits before answering.
+        trace_memory (bool): If True, measure allocations with tracemalloc (slower).
+
+    Returns:
+        dict: The results.
+    """
+    for key, value in BENCHMARK_ENV.items():
+        os.environ.setdefault(key, value)
+
+    import account
+    import fsr_handler
+    import log_writer
+    import metrics
+    import outbox
+    import request_handler
+
+    _StubPushover.delay = pushover_delay
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _StubPushover)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    request_handler.PUSHOVER_ENDPOINT = f"http://127.0.0.1:{server.server_port}/1/messages.json"
+    request_handler.start_dispatcher()
+    metrics.reset()
+
+    gc.collect()
+    if trace_memory:
+        tracemalloc.start()
+    memory_before = _memory_in_use(trace_memory)
+
+    callback_seconds = []
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        start = time.perf_counter()
+        for frame in frames:
+            frame_start = time.perf_counter()
+            fsr_handler.on_message(None, frame)
+            callback_seconds.append(time.perf_counter() - frame_start)
+        handled = time.perf_counter()
+        request_handler.stop_dispatcher(timeout=600)
+        log_writer.flush()
+        done = time.perf_counter()
+
+    memory_after = _memory_in_use(trace_memory)
+    if trace_memory:
+        tracemalloc.stop()
+    server.shutdown()
+
+    callback_seconds.sort()
+    return {
+        "frames": len(frames),
+        "handle_seconds": handled - start,
+        "total_seconds": done - start,
+        "callback_p50": _percentile(callback_seconds, 0.50),
+        "callback_p99": _percentile(callback_seconds, 0.99),
+        "callback_max": callback_seconds[-1] if callback_seconds else 0.0,
+        "stages": {
+            stage: (
+                metrics.quantile(metrics.STAGE_HISTOGRAM, 0.50, stage=stage),
+                metrics.quantile(metrics.STAGE_HISTOGRAM, 0.99, stage=stage),
+            )
+            for stage in STAGES
+        },
+        "alert": (
+            metrics.quantile(metrics.ALERT_HISTOGRAM, 0.50, kind="user"),
+            metrics.quantile(metrics.ALERT_HISTOGRAM, 0.99, kind="user"),
+        ),
+        "recipients": {
+            recipient: (
+                metrics.quantile(request_handler.RECIPIENT_HISTOGRAM, 0.50, recipient=recipient),
+                metrics.quantile(request_handler.RECIPIENT_HISTOGRAM, 0.99, recipient=recipient),
+            )
+            for recipient in sorted(request_handler.stats()["recipients"])
+        },
+        "pushes": request_handler.stats(),
+        "outbox": outbox.stats(),
+        "stub_requests": _StubPushover.requests,
+        "active_incidents": len(account.default.store),
+        "memory_growth": memory_after - memory_before,
+        "memory_source": "tracemalloc" if trace_memory else "max RSS",
+    }
+
+
+def report(result: dict) -> None:
+    """
+    Print the results.
+
+    Args:
+        result (dict): The results from run.
+    """
+    frames = result["frames"]
+    print(f"Frames:               {frames}")
+    print(f"Handled in:           {result['handle_seconds']:.3f} s "
+          f"({frames / max(result['handle_seconds'], 1e-9):,.0f} frames/s on the WebSocket thread)")
+    print(f"Delivered in:         {result['total_seconds']:.3f} s "
+          f"({frames / max(result['total_seconds'], 1e-9):,.0f} frames/s end to end)")
+    print(f"on_message:           p50 {_ms(result['callback_p50'])}  p99 {_ms(result['callback_p99'])}  "
+          f"max {_ms(result['callback_max'])}")
+    print("Stage latency (estimated from histogram buckets):")
+    for stage, (p50, p99) in result["stages"].items():
+        print(f"  {stage:<12}        p50 {_ms(p50)}  p99 {_ms(p99)}")
+    p50, p99 = result["alert"]
+    print(f"Alert end to end:     p50 {_ms(p50)}  p99 {_ms(p99)}")
+    if len(result["recipients"]) > 1:
+        print("Per recipient (queued until accepted):")
+        for recipient, (p50, p99) in result["recipients"].items():
+            print(f"  {recipient:<12}        p50 {_ms(p50)}  p99 {_ms(p99)}")
+    pushes = result["pushes"]
+    print(f"Pushes:               {pushes['sent']} ok, {pushes['failed']} failed, "
+          f"{pushes['dropped']} dropped, {result['stub_requests']} received by stub")
+    store = result["outbox"]
+    if store["commits"]:
+        print(f"Outbox:               {store['recorded']} stored in {store['commits']} commits, "
+              f"{_ms(store['commit_seconds'] / store['commits']).strip()} per commit")
+    print(f"Active incidents:     {result['active_incidents']}")
+    print(f"Memory growth:        {result['memory_growth'] / 1024:,.0f} KiB ({result['memory_source']})")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Replay incident traffic through the pipeline.")
+    parser.add_argument("logs", nargs="*", help="Incident log files to replay")
+    parser.add_argument("--synthetic", action="store_true", help="Generate a synthetic burst instead")
+    parser.add_argument("--incidents", type=int, default=20, help="Concurrent incidents in the burst")
+    parser.add_argument("--responders", type=int, default=200, help="Responders per incident")
+    parser.add_argument("--updates", type=int, default=20, help="Update frames per incident")
+    parser.add_argument("--ping-ratio", type=float, default=1.0, help="Pings per incident frame")
+    parser.add_argument("--repeat", type=int, default=1, help="Replay the frames this many times")
+    parser.add_argument("--pushover-delay", type=float, default=0.0, help="Stub Pushover delay in ms")
+    parser.add_argument("--recipients", type=int, default=1, help="Pushover recipients per notification")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--tracemalloc", action="store_true", help="Measure memory with tracemalloc")
+    args = parser.parse_args()
+
+    if args.synthetic:
+        frames = synthetic_frames(args.incidents, args.responders, args.updates, args.ping_ratio, args.seed)
+    elif args.logs:
+        frames = load_frames(args.logs)
+    else:
+        parser.error("give incident log files to replay, or --synthetic")
+    frames = frames * args.repeat
+    if args.recipients > 1:
+        os.environ.setdefault("PUSHOVER_RECIPIENTS", ",".join(f"recipient{i:04d}" for i in range(1, args.recipients)))
+        os.environ.setdefault("DISPATCH_WORKERS", str(max(4, args.recipients)))
+
+    # Logs written by the pipeline go to a scratch directory, not the real log folders.
+    sys.path.insert(0, os.getcwd())
+    with tempfile.TemporaryDirectory() as scratch:
+        os.chdir(scratch)
+        report(run(frames, args.pushover_delay / 1000, args.tracemalloc))
+
+
+def _memory_in_use(trace_memory: bool) -> int:
+    if trace_memory:
+        return tracemalloc.get_traced_memory()[0]
+    try:
+        import resource
+        scale = 1 if sys.platform == "darwin" else 1024
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+    except ImportError:
+        return 0
+
+
+def _percentile(values: list, q: float) -> float:
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def _ms(seconds: float) -> str:
+    if seconds is None:
+        return "     -   "
+    return f"{seconds * 1000:8.3f} ms"
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+"""
+Module: benchmarks.snapshot
+Purpose: Measures the size of the incident snapshot file and the time to save
+         and load it, as the number of active incidents and responders grows.
+         Loading happens at startup, so its time is added to every restart.
+
+Run from the repository root:
+    python -m benchmarks.snapshot
+"""
+
+import os
+import sys
+import tempfile
+import time
+
+INCIDENT_COUNTS = [10, 100, 1000, 10000]
+RESPONDER_COUNTS = [10, 100]
+ROUNDS = 5
+
+# Set over the caller's environment, so real FSR and Pushover settings never reach the run.
+BENCHMARK_ENV = {
+    "FSR_USERNAME": "benchmark",
+    "FSR_PASSWORD": "benchmark",
+    "ENABLE_PUSHOVER": "0",
+    "ENABLE_ADMIN": "0",
+    "ENABLE_RESPONDING": "0",
+    "PUSHOVER_TOKEN": "benchmark",
+    "PUSHOVER_USER_KEY": "benchmark",
+    "PUSHOVER_HEADER": "benchmark",
+    "TOKEN_CACHE_PATH": "",
+    "OUTBOX_PATH": "",
+    "METRICS_PORT": "0",
+}
+
+
+def _store(incident_count: int, responder_count: int):
+    """
+    Build a store with every incident answered by every responder.
+    """
+    from incident_store import IncidentStore
+
+    store = IncidentStore()
+    responses = [
+        {"user_name": f"user{i}", "status": "acknowledged" if i % 2 else "unavailable"}
+        for i in range(responder_count)
+    ]
+    for i in range(incident_count):
+        store.add(100000 + i)
+        delta = store.update_responses(100000 + i, responses)
+        store.add_responders(100000 + i, [user for user, (old, new) in delta.items() if new == "acknowledged"])
+    return store
+
+
+def _run(path: str, incident_count: int, responder_count: int) -> tuple:
+    import incident_snapshot
+    from account import Account
+    from incident_store import IncidentStore
+
+    account = Account("benchmark")
+    account.store = _store(incident_count, responder_count)
+    save_ms = load_ms = 0.0
+    for _ in range(ROUNDS):
+        incident_snapshot._last_written.clear()
+        start = time.perf_counter()
+        incident_snapshot.save(account)
+        save_ms += (time.perf_counter() - start) * 1000
+
+        account.store = IncidentStore()
+        start = time.perf_counter()
+        loaded = incident_snapshot.load(account)
+        load_ms += (time.perf_counter() - start) * 1000
+        assert loaded == incident_count
+    size = os.path.getsize(account.file_path(path))
+    return size, save_ms / ROUNDS, load_ms / ROUNDS
+
+
+def main() -> None:
+    # Logs written by the modules go to a scratch directory, not the real log folders.
+    sys.path.insert(0, os.getcwd())
+    with tempfile.TemporaryDirectory() as directory:
+        os.chdir(directory)
+        path = os.path.join(directory, "incidents.json")
+        os.environ.update(BENCHMARK_ENV)
+        os.environ["INCIDENT_SNAPSHOT_PATH"] = path
+        import settings
+        settings.load()
+
+        print(f"{'incidents':>10} {'responders':>11} {'file KiB':>9} {'save ms':>8} {'load ms':>8}")
+        for responder_count in RESPONDER_COUNTS:
+            for incident_count in INCIDENT_COUNTS:
+                size, save_ms, load_ms = _run(path, incident_count, responder_count)
+                print(f"{incident_count:>10} {responder_count:>11} {size / 1024:>9.1f} {save_ms:>8.2f} {load_ms:>8.2f}")
+
+
+if __name__ == "__main__":
+    main()
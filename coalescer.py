@@ -0,0 +1,104 @@
+"""
+Module: coalescer
+Purpose: Merges bursts of response changes for the same incident into one
+         event. The first change for an incident opens a short window, later
+         changes in the window are merged into it, and when the window closes
+         a single event with the net changes is emitted.
+"""
+
+import threading
+import log_writer
+
+MODULE_NAME = "Coalescer"
+
+
+class Coalescer:
+    """
+    Coalesces changes per key within a time window.
+
+    Changes are dicts of (old, new) by name. A name that changes more than once
+    in a window keeps its first old value and its last new value, and is left
+    out when it ends where it started.
+    """
+
+    def __init__(self, emit):
+        """
+        Args:
+            emit: Called as emit(key, changes, context) from a timer thread when a
+                window closes with net changes.
+        """
+        self.emit = emit
+        self.counters = {"changes": 0, "emitted": 0, "merged": 0}
+        self._pending: dict = {}
+        self._lock = threading.Lock()
+
+    def add(self, key: object, changes: dict, context: object, window: float) -> None:
+        """
+        Add changes for a key.
+
+        Args:
+            key (object): What the changes belong to, e.g. (account, incident id).
+            changes (dict): (old, new) by name.
+            context (object): Passed to emit; the latest value for the window is used.
+            window (float): Seconds to wait for more changes. 0 emits right away.
+        """
+        if window <= 0:
+            with self._lock:
+                self.counters["changes"] += 1
+            self._emit(key, dict(changes), context)
+            return
+        with self._lock:
+            self.counters["changes"] += 1
+            pending = self._pending.get(key)
+            if pending is None:
+                timer = threading.Timer(window, self._flush, (key,))
+                timer.daemon = True
+                pending = self._pending[key] = {"changes": {}, "context": context, "timer": timer}
+                timer.start()
+            else:
+                self.counters["merged"] += 1
+            merged: dict = pending["changes"]
+            for name, (old, new) in changes.items():
+                first_old = merged[name][0] if name in merged else old
+                merged[name] = (first_old, new)
+            pending["context"] = context
+
+    def flush_all(self) -> None:
+        """
+        Emit every open window now, e.g. before shutting down.
+        """
+        with self._lock:
+            keys = list(self._pending)
+        for key in keys:
+            self._flush(key)
+
+    def stats(self) -> dict:
+        """
+        Get the counters.
+
+        Returns:
+            dict: Counters for changes added, events emitted and changes merged
+                  into an already open window, plus the number of open windows.
+        """
+        with self._lock:
+            snapshot = dict(self.counters)
+            snapshot["open_windows"] = len(self._pending)
+        return snapshot
+
+    def _flush(self, key: object) -> None:
+        with self._lock:
+            pending = self._pending.pop(key, None)
+        if pending is None:
+            return
+        pending["timer"].cancel()
+        changes = {name: change for name, change in pending["changes"].items() if change[0] != change[1]}
+        if changes:
+            self._emit(key, changes, pending["context"])
+
+    def _emit(self, key: object, changes: dict, context: object) -> None:
+        with self._lock:
+            self.counters["emitted"] += 1
+        try:
+            self.emit(key, changes, context)
+        except Exception as e:
+            log_writer.to_error(MODULE_NAME, "Emit coalesced changes", e, key)
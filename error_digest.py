@@ -0,0 +1,255 @@
+"""
+Module: error_digest
+Purpose: Collects the errors logged by log_writer into admin notifications.
+         The first error of a kind (module, operation and error class) is
+         pushed right away; repeats are counted and sent as one digest per
+         window, e.g. "37x Request Handler: Push to pushover failed in the
+         last 5 min". Admin pushes are capped by a token bucket, and all of it
+         happens on a background thread, so logging an error never waits for
+         Pushover and an error while pushing can not cause another push.
+"""
+
+import datetime
+import threading
+import time
+import metrics
+import request_handler
+import settings
+from rate_limit import TokenBucket
+
+MODULE_NAME = "Error Digest"
+
+# Defaults used when the settings can not be loaded, so errors are still reported.
+DEFAULT_WINDOW = 300.0
+DEFAULT_PER_HOUR = 12.0
+DEFAULT_BURST = 5
+
+# Max characters of an error message or element in a push.
+MAX_TEXT = 300
+
+_lock = threading.Lock()
+_wake = threading.Event()
+_stop = threading.Event()
+_thread: threading.Thread = None
+_bucket = TokenBucket(DEFAULT_PER_HOUR / 3600, DEFAULT_BURST)
+# Kinds of errors seen in this window: key -> entry dict, see report.
+_entries: dict = {}
+# The first error of new kinds, not pushed yet: (key, logged_at, err_msg, elem).
+_first: list = []
+_counters: dict = {"errors": 0, "pushed": 0, "digests": 0, "suppressed": 0}
+
+
+def report(module: str, tried_to: str, err_msg: object, elem: object) -> None:
+    """
+    Count an error for the admin notifications. Never blocks on Pushover.
+
+    Args:
+        module (str): The module where the error occurred.
+        tried_to (str): Description of the operation attempted.
+        err_msg (object): The exception, or an error message. Pass the exception
+            itself, so errors are grouped by its class.
+        elem (object): The element or context associated with the error.
+    """
+    if isinstance(err_msg, type):
+        error_class = err_msg.__name__
+    elif isinstance(err_msg, BaseException):
+        error_class = type(err_msg).__name__
+    else:
+        error_class = ""
+    key = (module, tried_to, error_class)
+    now = time.time()
+    with _lock:
+        _counters["errors"] += 1
+        entry = _entries.get(key)
+        if entry is None:
+            entry = _entries[key] = {"count": 0, "since": now}
+            _first.append((key, now, err_msg, elem))
+        entry["count"] += 1
+        entry["err_msg"] = err_msg
+    _ensure_thread()
+    _wake.set()
+
+
+def stop(timeout: float = 5.0) -> None:
+    """
+    Stop the background thread and send what has not been reported yet.
+
+    Args:
+        timeout (float): Maximum number of seconds to wait for the thread.
+    """
+    global _thread
+    _stop.set()
+    _wake.set()
+    if _thread is not None:
+        _thread.join(timeout=timeout)
+        _thread = None
+    _send_first()
+    _send_digest()
+
+
+def stats() -> dict:
+    """
+    Get the digest counters.
+
+    Returns:
+        dict: Counters for errors reported, errors pushed right away, digests sent
+              and pushes left out by the rate limit, plus the number of kinds of
+              errors in the current window.
+    """
+    with _lock:
+        snapshot = dict(_counters)
+        snapshot["kinds"] = len(_entries)
+    return snapshot
+
+
+def _ensure_thread() -> None:
+    """
+    Start the background thread if it is not running.
+    """
+    global _thread
+    if _thread is not None and _thread.is_alive():
+        return
+    with _lock:
+        if _stop.is_set() or (_thread is not None and _thread.is_alive()):
+            return
+        _thread = threading.Thread(target=_digest_loop, name="error-digest", daemon=True)
+        _thread.start()
+
+
+def _digest_loop() -> None:
+    """
+    Push first errors as they come, and a digest of the repeats when the window closes.
+    """
+    window_end = time.monotonic() + _settings()[0]
+    while not _stop.is_set():
+        _wake.wait(max(0.0, window_end - time.monotonic()))
+        _wake.clear()
+        if _stop.is_set():
+            return
+        _send_first()
+        if time.monotonic() >= window_end:
+            _send_digest()
+            window_end = time.monotonic() + _settings()[0]
+
+
+def _settings() -> tuple:
+    """
+    Get the window and apply the push limit to the token bucket. Falls back to the
+    defaults if the settings can not be loaded.
+
+    Returns:
+        tuple: (window, per_hour, burst)
+    """
+    try:
+        current = settings.get()
+        result = (current.error_digest_window, current.error_push_per_hour, current.error_push_burst)
+    except settings.SettingsError:
+        result = (DEFAULT_WINDOW, DEFAULT_PER_HOUR, DEFAULT_BURST)
+    window, per_hour, burst = result
+    if _bucket.rate != per_hour / 3600 or _bucket.capacity != burst:
+        _bucket.configure(per_hour / 3600, burst)
+    return result
+
+
+def _send_first() -> None:
+    """
+    Push the first error of every new kind, if the rate limit allows.
+    """
+    with _lock:
+        firsts = list(_first)
+        _first.clear()
+        for key, logged_at, err_msg, elem in firsts:
+            # The first error is reported by itself, repeats go in the digest.
+            _entries[key]["count"] -= 1
+            _entries[key]["since"] = time.time()
+    for (module, tried_to, error_class), logged_at, err_msg, elem in firsts:
+        if not _bucket.try_acquire():
+            with _lock:
+                _counters["suppressed"] += 1
+                entry = _entries.get((module, tried_to, error_class))
+                if entry is not None:
+                    entry["count"] += 1
+            continue
+        _push(
+            f"{datetime.datetime.fromtimestamp(logged_at).strftime('%Y-%m-%d %H:%M:%S')}\n"
+            f"Module: {module}\n"
+            f"Tried to: {tried_to}\n"
+            f"Error message: {_shorten(_describe(error_class, err_msg))}\n"
+            f"Element: {_shorten(elem)}"
+        )
+        with _lock:
+            _counters["pushed"] += 1
+
+
+def _send_digest() -> None:
+    """
+    Push one digest of the repeated errors in the window, if the rate limit allows.
+    Kinds without repeats are forgotten, so their next error is pushed right away.
+    """
+    now = time.time()
+    with _lock:
+        repeats = [(key, dict(entry)) for key, entry in _entries.items() if entry["count"] > 0]
+        waiting = {first[0] for first in _first}
+        quiet = [key for key, entry in _entries.items() if entry["count"] == 0 and key not in waiting]
+        for key in quiet:
+            del _entries[key]
+    if not repeats:
+        return
+    if not _bucket.try_acquire():
+        # Keep counting, the repeats are sent with the next digest.
+        with _lock:
+            _counters["suppressed"] += 1
+        return
+    lines = []
+    for (module, tried_to, error_class), entry in sorted(repeats, key=lambda item: -item[1]["count"]):
+        minutes = max(1, round((now - entry["since"]) / 60))
+        kind = f" ({error_class})" if error_class else ""
+        lines.append(
+            f"{entry['count']}x {module}: {tried_to} failed{kind} in the last {minutes} min\n"
+            f"Last error: {_shorten(entry['err_msg'])}"
+        )
+    _push("\n".join(lines))
+    with _lock:
+        _counters["digests"] += 1
+        for key, sent in repeats:
+            entry = _entries.get(key)
+            if entry is not None:
+                entry["count"] -= sent["count"]
+                entry["since"] = now
+
+
+def _push(msg: str) -> None:
+    try:
+        request_handler.push_to_pushover_admin(msg, "default")
+    except Exception as e:
+        print("Exception in sending pushover to Admin")
+        print(e)
+
+
+def _describe(error_class: str, err_msg: object) -> str:
+    return f"{error_class}: {err_msg}" if isinstance(err_msg, BaseException) else str(err_msg)
+
+
+def _shorten(value: object) -> str:
+    text = str(value)
+    return text if len(text) <= MAX_TEXT else f"{text[:MAX_TEXT]}..."
+
+
+def _collect_metrics() -> list:
+    """
+    Report the digest counters to the metrics module.
+
+    Returns:
+        list: Metric samples, see metrics.register_collector.
+    """
+    stats_now = stats()
+    help = "Errors reported to the admin by how they were sent"
+    return [
+        ("fsr_admin_errors_total", "counter", "Errors logged", {}, stats_now["errors"]),
+        ("fsr_admin_pushes_total", "counter", help, {"kind": "first"}, stats_now["pushed"]),
+        ("fsr_admin_pushes_total", "counter", help, {"kind": "digest"}, stats_now["digests"]),
+        ("fsr_admin_pushes_total", "counter", help, {"kind": "suppressed"}, stats_now["suppressed"]),
+    ]
+
+
+metrics.register_collector(_collect_metrics)
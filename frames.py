@@ -0,0 +1,145 @@
+"""
+Module: frames
+Purpose: Decodes the frames received from the FSR cable. Most frames are
+         ActionCable pings sent every few seconds; they and the other control
+         frames are recognised from their first bytes without parsing them.
+         Only incident frames and rare control frames are parsed, with orjson
+         when it is installed (pip install orjson) and the json module otherwise.
+"""
+
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+MODULE_NAME = "Frames"
+
+# Frame kinds, the ActionCable "type" of a frame or INCIDENT for frames without one.
+PING = "ping"
+WELCOME = "welcome"
+CONFIRM_SUBSCRIPTION = "confirm_subscription"
+DISCONNECT = "disconnect"
+INCIDENT = "incident"
+
+# JSON backends.
+BACKEND_AUTO = "auto"
+BACKEND_ORJSON = "orjson"
+BACKEND_JSON = "json"
+
+# Control frames the server always writes the same way, by the start or the end
+# of the frame. Frames written differently are parsed, so they still work.
+_PREFIXES = (
+    ('{"type":"ping",', PING),
+    ('{"type":"welcome"}', WELCOME),
+    ('{"type":"welcome",', WELCOME),
+)
+_SUFFIXES = (
+    ('"type":"confirm_subscription"}', CONFIRM_SUBSCRIPTION),
+)
+# Incident frames are longer than any control frame matched by its suffix.
+_MAX_CONTROL_LENGTH = 512
+
+_backend: str = BACKEND_JSON
+
+
+class FrameError(Exception):
+    """Raised when an unknown JSON backend is chosen."""
+    pass
+
+
+def set_backend(name: str) -> str:
+    """
+    Choose the JSON backend.
+
+    Args:
+        name (str): BACKEND_AUTO for orjson when installed and json otherwise,
+            BACKEND_ORJSON or BACKEND_JSON.
+
+    Returns:
+        str: The backend in use.
+
+    Raises:
+        FrameError: If the backend is unknown or orjson was asked for but is not installed.
+    """
+    global _backend
+    if name == BACKEND_AUTO:
+        name = BACKEND_JSON if orjson is None else BACKEND_ORJSON
+    if name not in (BACKEND_ORJSON, BACKEND_JSON):
+        raise FrameError(f"Unknown JSON backend {name}, expected auto, orjson or json")
+    if name == BACKEND_ORJSON and orjson is None:
+        raise FrameError("The orjson backend needs the orjson package: pip install orjson")
+    _backend = name
+    return name
+
+
+def backend() -> str:
+    """
+    Get the JSON backend in use.
+
+    Returns:
+        str: BACKEND_ORJSON or BACKEND_JSON.
+    """
+    return _backend
+
+
+def loads(data: str) -> object:
+    """
+    Parse JSON with the chosen backend.
+
+    Args:
+        data (str): The JSON text.
+
+    Returns:
+        object: The parsed value.
+
+    Raises:
+        ValueError: If the text is not valid JSON.
+    """
+    if _backend == BACKEND_ORJSON:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def dumps(obj: object) -> str:
+    """
+    Write compact JSON with the chosen backend, keeping non-ASCII characters as they are.
+
+    Args:
+        obj (object): The value to write.
+
+    Returns:
+        str: The JSON text.
+    """
+    if _backend == BACKEND_ORJSON:
+        return orjson.dumps(obj).decode("utf-8")
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":"))
+
+
+def classify(message: str) -> tuple:
+    """
+    Get the kind of a frame, parsing it only when needed.
+
+    Args:
+        message (str): The frame as received.
+
+    Returns:
+        tuple: (kind, msg), where kind is the frame's type or INCIDENT, and msg is
+               the parsed frame, or None for a control frame recognised without parsing.
+
+    Raises:
+        ValueError: If the frame had to be parsed and is not valid JSON.
+    """
+    for prefix, kind in _PREFIXES:
+        if message.startswith(prefix):
+            return kind, None
+    if len(message) <= _MAX_CONTROL_LENGTH:
+        for suffix, kind in _SUFFIXES:
+            if message.endswith(suffix):
+                return kind, None
+    msg = loads(message)
+    return msg.get("type") or INCIDENT, msg
+
+
+set_backend(BACKEND_AUTO)
@@ -6,26 +6,65 @@ Purpose: Manages the WebSocket connection to the Fire Service Rota (FSR) API,
 
 import json
 import time
+import requests
 from websocket import WebSocketApp
+import account
+import frames
 import request_handler
 import log_writer
 import oauth_handler
 import incident_handler
+import liveness
+import metrics
+import reconnect
+import redundancy
+import settings
 
 # Module constants and global variables
 MODULE_NAME = "FSR Handler"
+SUBSCRIBE_MESSAGE = json.dumps({
+    "command": "subscribe",
+    "identifier": json.dumps({
+        "channel": "IncidentNotificationsChannel"
+    })
+})
 force_update: bool = False
 alive_counter: int = 0
+reconnect_engine: reconnect.ReconnectEngine = None
+connection_liveness: liveness.Liveness = None
 
 
 def run() -> None:
     """
     Runs the WebSocket client and attempts reconnection on disconnection.
+
+    Reconnects back off exponentially with jitter. Failures to get a token are
+    handled separately from lost connections, see the reconnect module. A
+    connection that goes silent is closed by the liveness watchdog.
     """
+    global reconnect_engine, connection_liveness
+    current = settings.get()
+    reconnect_engine = reconnect.ReconnectEngine(
+        current.reconnect_min_delay,
+        current.reconnect_max_delay,
+        current.reconnect_auth_delay
+    )
+    connection_liveness = liveness.Liveness("default", reconnect_engine)
+    liveness.track([connection_liveness])
+    liveness.start()
     keep_running: bool = True
     while keep_running:
         try:
-            url: str = _generate_url()
+            reconnect_engine.connecting()
+            try:
+                url: str = _generate_url()
+            except oauth_handler.OAuthError as e:
+                _wait_for_reconnect(reconnect.AUTH, f"Could not get access token: {str(e)}")
+                continue
+            except requests.RequestException as e:
+                _wait_for_reconnect(reconnect.NETWORK, f"Could not reach FSR for a token: {str(e)}")
+                continue
+
             ws: WebSocketApp = WebSocketApp(
                 url,
                 on_open=on_open,
@@ -34,12 +73,27 @@ def run() -> None:
                 on_error=on_error
             )
             ws.run_forever()
-            time.sleep(1)
-            _to_terminal("Attempting to establish new connection")
+            connection_liveness.disconnected()
+            reconnect_engine.connection_lost()
+            kind = reconnect.AUTH if force_update else reconnect.NETWORK
+            _wait_for_reconnect(kind, "Connection lost")
         except KeyboardInterrupt:
             keep_running = False
 
 
+def _wait_for_reconnect(kind: str, reason: str) -> None:
+    """
+    Register a failure with the reconnect engine and sleep for the delay it returns.
+
+    Args:
+        kind (str): reconnect.NETWORK or reconnect.AUTH.
+        reason (str): Why the connection failed, for the log.
+    """
+    delay = reconnect_engine.failure(kind)
+    _to_terminal(f"{reason} - attempting to establish new connection in {delay:.1f} s")
+    time.sleep(delay)
+
+
 def _generate_url() -> str:
     """
     Generates the WebSocket URL using a valid OAuth token.
@@ -49,7 +103,7 @@ def _generate_url() -> str:
     """
     global force_update
     token: str = oauth_handler.get_token(force_update)
-    url: str = f"wss://www.fireservicerota.co.uk/cable?access_token={token}"
+    url: str = f"{settings.get().fsr_cable_url}?access_token={token}"
     force_update = False
     return url
 
@@ -64,62 +118,108 @@ def on_open(ws: WebSocketApp) -> None:
         ws (WebSocketApp): The WebSocket connection instance.
     """
     _to_terminal("WebSocket connected")
-    msg = {
-        "command": "subscribe",
-        "identifier": json.dumps({
-            "channel": "IncidentNotificationsChannel"
-        })
-    }
-    ws.send(json.dumps(msg))
+    if connection_liveness:
+        connection_liveness.connected(lambda: _abort(ws))
+    ws.send(SUBSCRIBE_MESSAGE)
+
+
+def _abort(ws: WebSocketApp) -> None:
+    """
+    Close a connection that has gone silent from another thread. A close handshake
+    would wait for the dead peer, so the socket is shut down instead, which wakes
+    run_forever up.
+
+    Args:
+        ws (WebSocketApp): The WebSocket connection instance.
+    """
+    ws.keep_running = False
+    if ws.sock:
+        ws.sock.abort()
 
 
 def on_message(ws: WebSocketApp, message: str) -> None:
     """
     Callback when a message is received from the WebSocket.
     
-    Processes different message types and handles them accordingly.
+    Classifies the message, parsing it only when needed, and passes it to the
+    handler for its type, see _HANDLERS.
     
     Args:
         ws (WebSocketApp): The WebSocket connection instance.
         message (str): The received message in JSON format.
     """
-    global force_update, alive_counter
+    metrics.start_trace()
     try:
-        msg = json.loads(message)
+        with metrics.timed("parse"):
+            kind, msg = frames.classify(message)
+        if connection_liveness:
+            connection_liveness.frame(kind)
+        metrics.inc("fsr_messages_total", help="Messages received from FSR by type", type=kind)
+        if kind == frames.INCIDENT and not redundancy.admit(MODULE_NAME, account.default, message, msg):
+            return
+        _HANDLERS.get(kind, _on_incident)(msg)
+    except Exception as e:
+        _to_error("Handle a new message", e, "")
 
-        # Handle 'ping' messages to manage connection liveness.
-        if msg.get("type") == "ping":
-            alive_counter -= 1
-            if alive_counter <= 0:
-                _to_terminal("Alive ping")
-                alive_counter = 999
 
-        # Ignore further processing for ping or welcome messages.
-        if msg.get("type") in ["ping", "welcome"]:
-            return
+def _on_ping(msg: dict) -> None:
+    """
+    Handle 'ping' messages to manage connection liveness.
+    """
+    global alive_counter
+    alive_counter -= 1
+    if alive_counter <= 0:
+        _to_terminal("Alive ping")
+        alive_counter = 999
 
-        # Handle subscription confirmation.
-        if msg.get("type") == "confirm_subscription":
-            _to_terminal("New connection established")
-            alive_counter = 0
-            return
 
-        # Check for an unauthorized disconnect.
-        if msg.get("type") == "disconnect" and msg.get("reason") == "unauthorized":
-            force_update = True
-            request_handler.push_to_pushover_admin(
-                "Connection was closed because the user was not authorized", "default"
-            )
-            return
-        
-        incident_handler.handle_incident(msg)
-        
-        
+def _on_welcome(msg: dict) -> None:
+    """
+    Ignore 'welcome' messages.
+    """
+    pass
 
 
-    except Exception as e:
-        print(e)
-        #_to_error("Handle a new message", str(e), "")
+def _on_confirm_subscription(msg: dict) -> None:
+    """
+    Handle the subscription confirmation.
+    """
+    global alive_counter
+    blind = reconnect_engine.subscribed() if reconnect_engine else 0.0
+    _to_terminal(f"New connection established (blind for {blind:.1f} s)")
+    alive_counter = 0
+
+
+def _on_disconnect(msg: dict) -> None:
+    """
+    Check for an unauthorized disconnect.
+    """
+    global force_update
+    if msg.get("reason") == "unauthorized":
+        force_update = True
+        request_handler.push_to_pushover_admin(
+            "Connection was closed because the user was not authorized", "default"
+        )
+        return
+    _on_incident(msg)
+
+
+def _on_incident(msg: dict) -> None:
+    """
+    Handle incident messages, and any message of a type without a handler.
+    """
+    incident_handler.handle_incident(msg)
+
+
+# Handler per message kind, see frames.classify. Control frames recognised without
+# parsing are passed None.
+_HANDLERS = {
+    frames.PING: _on_ping,
+    frames.WELCOME: _on_welcome,
+    frames.CONFIRM_SUBSCRIPTION: _on_confirm_subscription,
+    frames.DISCONNECT: _on_disconnect,
+    frames.INCIDENT: _on_incident,
+}
 
 
 def on_close(ws: WebSocketApp, close_status_code: int, close_msg: str) -> None:
@@ -132,6 +232,8 @@ def on_close(ws: WebSocketApp, close_status_code: int, close_msg: str) -> None:
         close_msg (str): The close message.
     """
     _to_terminal("WebSocket closed")
+    if connection_liveness:
+        connection_liveness.disconnected()
 
 
 def on_error(ws: WebSocketApp, error: Exception) -> None:
@@ -155,13 +257,36 @@ def _to_terminal(msg: str) -> None:
     log_writer.to_terminal(MODULE_NAME, msg)
 
 
-def _to_error(tried_to: str, err_msg: str, obj: object) -> None:
+def _to_error(tried_to: str, err_msg: object, obj: object) -> None:
     """
     Log an error message using the writer module.
     
     Args:
         tried_to (str): Description of the operation attempted.
-        err_msg (str): The error message.
+        err_msg (object): The exception, or an error message.
         obj (object): Additional context for the error.
     """
     log_writer.to_error(MODULE_NAME, tried_to, err_msg, obj)
+
+
+def _collect_metrics() -> list:
+    """
+    Report the reconnect counters to the metrics module.
+
+    Returns:
+        list: Metric samples, see metrics.register_collector.
+    """
+    if reconnect_engine is None:
+        return []
+    stats = reconnect_engine.stats()
+    return [
+        ("fsr_reconnects_total", "counter", "Reconnects by failure kind", {"kind": reconnect.NETWORK}, stats["network_failures"]),
+        ("fsr_reconnects_total", "counter", "Reconnects by failure kind", {"kind": reconnect.AUTH}, stats["auth_failures"]),
+        ("fsr_subscribed", "gauge", "1 if the incident subscription is confirmed", {}, stats["state"] == reconnect.STATE_SUBSCRIBED),
+        ("fsr_blind_seconds_total", "counter", "Total time without a confirmed subscription", {}, stats["blind_seconds_total"]),
+        ("fsr_blind_seconds_last", "gauge", "Length of the last period without a subscription", {}, stats["blind_seconds_last"]),
+        ("fsr_blind_seconds_current", "gauge", "Time since the subscription was lost, 0 if subscribed", {}, stats["blind_seconds_current"]),
+    ]
+
+
+metrics.register_collector(_collect_metrics)
@@ -0,0 +1,335 @@
+"""
+Module: geo_index
+Purpose: Enriches incidents with local map data: the nearest fire station and
+         the hydrants, access points and other points of interest close to
+         the incident. The points are read once from a GeoJSON or CSV file
+         into grid indexes, so a lookup only looks at the cells around the
+         incident, and results are kept in an LRU cache by location.
+"""
+
+import csv
+import json
+import math
+import threading
+from collections import OrderedDict
+from typing import NamedTuple
+import log_writer
+import metrics
+import settings
+
+MODULE_NAME = "Geo Index"
+
+# The kind of point that is looked up as the nearest station, all other kinds
+# are looked up as nearby points.
+STATION_KIND = "station"
+
+# Grid cell sizes in degrees. Stations are few and far apart, nearby points are
+# many and looked up within a few hundred meters.
+STATION_CELL_DEGREES = 0.1
+POINT_CELL_DEGREES = 0.005
+
+KM_PER_DEGREE = 111.32
+EARTH_RADIUS_KM = 6371.0
+
+# Locations are cached by their coordinates rounded to this many decimals (about 1 m).
+CACHE_DECIMALS = 5
+
+_lock = threading.Lock()
+_stations = None
+_points: dict = {}
+_cache: OrderedDict = OrderedDict()
+_counters: dict = {"hits": 0, "misses": 0}
+
+
+class GeoError(Exception):
+    """Raised when the map data can not be read."""
+    pass
+
+
+class GeoPoint(NamedTuple):
+    """A point of interest from the map data."""
+    kind: str
+    name: str
+    latitude: float
+    longitude: float
+
+
+class GeoIndex:
+    """
+    A grid index of points for nearest and within-radius lookups.
+
+    The points are put in cells of cell_degrees by cell_degrees, and lookups only
+    visit the cells that can hold points close enough, nearest ones first.
+    """
+
+    def __init__(self, points: list, cell_degrees: float):
+        """
+        Args:
+            points (list): The GeoPoints to index.
+            cell_degrees (float): Size of a grid cell in degrees.
+        """
+        self.cell_degrees = cell_degrees
+        self.size = len(points)
+        self._cells: dict = {}
+        for point in points:
+            self._cells.setdefault(self._cell(point.latitude, point.longitude), []).append(point)
+
+    def nearest(self, latitude: float, longitude: float, max_km: float) -> tuple:
+        """
+        Find the point nearest to a location.
+
+        Args:
+            latitude (float): Latitude of the location.
+            longitude (float): Longitude of the location.
+            max_km (float): Ignore points further away than this.
+
+        Returns:
+            tuple: (GeoPoint, distance in km), or None if no point is within max_km.
+        """
+        row, col = self._cell(latitude, longitude)
+        cell_km = self._cell_km(latitude)
+        best, best_km = None, max_km
+        ring = 0
+        # Points in ring r are at least r - 1 cells away.
+        while (ring - 1) * cell_km <= best_km:
+            for key in self._ring(row, col, ring):
+                for point in self._cells.get(key, ()):
+                    km = distance_km(latitude, longitude, point.latitude, point.longitude)
+                    if km <= best_km:
+                        best, best_km = point, km
+            ring += 1
+        return None if best is None else (best, best_km)
+
+    def within(self, latitude: float, longitude: float, radius_km: float, limit: int) -> list:
+        """
+        Find the points within a radius of a location, nearest first.
+
+        Args:
+            latitude (float): Latitude of the location.
+            longitude (float): Longitude of the location.
+            radius_km (float): The radius in km.
+            limit (int): Max number of points to return.
+
+        Returns:
+            list: Tuples of (GeoPoint, distance in km).
+        """
+        row, col = self._cell(latitude, longitude)
+        rings = int(radius_km / self._cell_km(latitude)) + 1
+        found = []
+        for ring in range(rings + 1):
+            for key in self._ring(row, col, ring):
+                for point in self._cells.get(key, ()):
+                    km = distance_km(latitude, longitude, point.latitude, point.longitude)
+                    if km <= radius_km:
+                        found.append((point, km))
+        found.sort(key=lambda item: item[1])
+        return found[:limit]
+
+    def _cell(self, latitude: float, longitude: float) -> tuple:
+        return math.floor(latitude / self.cell_degrees), math.floor(longitude / self.cell_degrees)
+
+    def _cell_km(self, latitude: float) -> float:
+        """
+        The smallest side of a cell in km at a latitude, longitude degrees shrink towards the poles.
+        """
+        return self.cell_degrees * KM_PER_DEGREE * max(math.cos(math.radians(latitude)), 0.01)
+
+    @staticmethod
+    def _ring(row: int, col: int, ring: int):
+        """
+        Yield the cells at exactly ring cells from (row, col).
+        """
+        if ring == 0:
+            yield row, col
+            return
+        for c in range(col - ring, col + ring + 1):
+            yield row - ring, c
+            yield row + ring, c
+        for r in range(row - ring + 1, row + ring):
+            yield r, col - ring
+            yield r, col + ring
+
+
+def distance_km(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
+    """
+    Great-circle distance between two locations (haversine).
+
+    Returns:
+        float: The distance in km.
+    """
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    d_phi = phi2 - phi1
+    d_lambda = math.radians(lon2 - lon1)
+    a = math.sin(d_phi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(d_lambda / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(a)))
+
+
+def read_points(path: str) -> list:
+    """
+    Read points of interest from a GeoJSON file (.geojson or .json) or a CSV file.
+
+    GeoJSON files hold a FeatureCollection of Point features with "kind" and "name"
+    properties. CSV files have a header with kind, name, latitude and longitude.
+
+    Args:
+        path (str): The file to read.
+
+    Returns:
+        list: The GeoPoints.
+
+    Raises:
+        GeoError: If the file can not be read or a point is invalid.
+    """
+    try:
+        if path.lower().endswith((".geojson", ".json")):
+            with open(path, encoding="utf-8") as f:
+                features = json.load(f).get("features", [])
+            points = []
+            for feature in features:
+                geometry = feature.get("geometry") or {}
+                if geometry.get("type") != "Point":
+                    continue
+                longitude, latitude = geometry["coordinates"][:2]
+                properties = feature.get("properties") or {}
+                points.append(_point(properties.get("kind"), properties.get("name"), latitude, longitude))
+            return points
+        with open(path, encoding="utf-8", newline="") as f:
+            return [
+                _point(row.get("kind"), row.get("name"), row.get("latitude"), row.get("longitude"))
+                for row in csv.DictReader(f)
+            ]
+    except (OSError, ValueError, KeyError, TypeError, AttributeError) as e:
+        raise GeoError(f"Could not read {path}: {e}")
+
+
+def load(path: str) -> int:
+    """
+    Read the map data and build the indexes, replacing any data loaded before.
+
+    Args:
+        path (str): The GeoJSON or CSV file, empty to disable the enrichment.
+
+    Returns:
+        int: The number of points loaded.
+
+    Raises:
+        GeoError: If the file can not be read.
+    """
+    global _stations, _points
+    if not path:
+        with _lock:
+            _stations, _points = None, {}
+            _cache.clear()
+        return 0
+    points = read_points(path)
+    by_kind: dict = {}
+    for point in points:
+        by_kind.setdefault(point.kind, []).append(point)
+    stations = GeoIndex(by_kind.pop(STATION_KIND, []), STATION_CELL_DEGREES)
+    others = {kind: GeoIndex(kind_points, POINT_CELL_DEGREES) for kind, kind_points in by_kind.items()}
+    with _lock:
+        _stations, _points = stations, others
+        _cache.clear()
+    _to_terminal(f"Loaded {len(points)} points ({stations.size} stations) from {path}")
+    return len(points)
+
+
+def is_loaded() -> bool:
+    """
+    Check if map data is loaded.
+
+    Returns:
+        bool: True if incidents can be enriched.
+    """
+    return _stations is not None
+
+
+def enrich(latitude: float, longitude: float) -> dict:
+    """
+    Look up the nearest station and the nearby points of a location.
+
+    Args:
+        latitude (float): Latitude of the incident.
+        longitude (float): Longitude of the incident.
+
+    Returns:
+        dict: {"station": (name, km) or None, "nearby": {kind: [(name, km), ...]}},
+              or None if no map data is loaded.
+    """
+    if _stations is None:
+        return None
+    key = (round(latitude, CACHE_DECIMALS), round(longitude, CACHE_DECIMALS))
+    with _lock:
+        result = _cache.get(key)
+        if result is not None:
+            _cache.move_to_end(key)
+            _counters["hits"] += 1
+            return result
+        _counters["misses"] += 1
+        stations, points = _stations, _points
+
+    current = settings.get()
+    station = stations.nearest(latitude, longitude, current.geo_station_radius)
+    nearby = {}
+    for kind, index in points.items():
+        found = index.within(latitude, longitude, current.geo_nearby_radius / 1000, current.geo_nearby_max)
+        if found:
+            nearby[kind] = [(point.name, km) for point, km in found]
+    result = {"station": None if station is None else (station[0].name, station[1]), "nearby": nearby}
+
+    with _lock:
+        _cache[key] = result
+        while len(_cache) > max(1, current.geo_cache_size):
+            _cache.popitem(last=False)
+    return result
+
+
+def stats() -> dict:
+    """
+    Get the cache counters.
+
+    Returns:
+        dict: Cache hits and misses, the number of cached locations and of loaded points.
+    """
+    with _lock:
+        snapshot = dict(_counters)
+        snapshot["cached"] = len(_cache)
+        snapshot["points"] = (0 if _stations is None else _stations.size) + sum(
+            index.size for index in _points.values()
+        )
+    return snapshot
+
+
+def _point(kind: str, name: str, latitude: object, longitude: object) -> GeoPoint:
+    if not kind:
+        raise ValueError(f"Point {name} has no kind")
+    return GeoPoint(str(kind), str(name or kind), float(latitude), float(longitude))
+
+
+def _to_terminal(msg: str) -> None:
+    """
+    Log a message to the terminal using the writer module.
+
+    Args:
+        msg (str): The message to log.
+    """
+    log_writer.to_terminal(MODULE_NAME, msg)
+
+
+def _collect_metrics() -> list:
+    """
+    Report the cache counters to the metrics module.
+
+    Returns:
+        list: Metric samples, see metrics.register_collector.
+    """
+    stats_now = stats()
+    help = "Location lookups by cache result"
+    return [
+        ("fsr_geo_lookups_total", "counter", help, {"cache": "hit"}, stats_now["hits"]),
+        ("fsr_geo_lookups_total", "counter", help, {"cache": "miss"}, stats_now["misses"]),
+        ("fsr_geo_points", "gauge", "Points of interest loaded", {}, stats_now["points"]),
+    ]
+
+
+metrics.register_collector(_collect_metrics)
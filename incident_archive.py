@@ -0,0 +1,343 @@
+"""
+Module: incident_archive
+Purpose: Stores every incident frame as JSON Lines in one file per day, with a
+         SQLite index by incident id and time, so the full update history of an
+         incident or a time range can be fetched without scanning the archive.
+         Closed days are compressed in the background, and days older than the
+         retention period are deleted.
+
+Usage:
+    python incident_archive.py incident <incident id>
+    python incident_archive.py range <from> <to>        (ISO dates or date-times)
+    python incident_archive.py maintain                 (compress and prune now)
+"""
+
+import contextlib
+import datetime
+import gzip
+import json
+import os
+import shutil
+import sqlite3
+import sys
+import threading
+import time
+import frames
+import log_writer
+import settings
+
+MODULE_NAME = "Incident Archive"
+ARCHIVE_DIR = "Incident"
+INDEX_FILE = "index.sqlite"
+
+# A closed day is only compressed when its file has not been written for this long.
+CLOSED_DAY_GRACE = 3600
+MAINTENANCE_INTERVAL = 3600
+
+_index: sqlite3.Connection = None
+_handle = None
+_handle_day: str = None
+_maintenance_thread: threading.Thread = None
+_maintenance_stop = threading.Event()
+
+
+def write(records: list) -> None:
+    """
+    Append frames to the archive and index them. Called by the log writer thread.
+
+    Args:
+        records (list): Tuples of (day, received_at, frame), where day is the date
+            (YYYY-MM-DD) of the file to write to, received_at the epoch time the
+            frame was received and frame the frame as a dict.
+    """
+    rows = []
+    for day, received_at, frame in records:
+        handle = _get_handle(day)
+        line = frames.dumps({"received_at": received_at, "frame": frame})
+        data = f"{line}\n".encode("utf-8")
+        offset = handle.tell()
+        handle.write(data)
+        rows.append((_incident_id(frame), received_at, day, offset, len(data)))
+    index = _get_index()
+    index.executemany(
+        "INSERT INTO frames (incident_id, received_at, day, offset, length) VALUES (?, ?, ?, ?, ?)", rows
+    )
+    index.commit()
+
+
+def flush(fsync: bool) -> None:
+    """
+    Flush the open archive file.
+
+    Args:
+        fsync (bool): If True, also sync the file to disk.
+    """
+    if _handle is not None:
+        _handle.flush()
+        if fsync:
+            os.fsync(_handle.fileno())
+
+
+def close() -> None:
+    """
+    Close the open archive file and the index.
+    """
+    global _handle, _handle_day, _index
+    if _handle is not None:
+        _handle.close()
+        _handle, _handle_day = None, None
+    if _index is not None:
+        _index.close()
+        _index = None
+
+
+def incident_history(incident_id: str) -> list:
+    """
+    Get every archived frame of one incident, oldest first.
+
+    Args:
+        incident_id (str): The id of the incident.
+
+    Returns:
+        list: Dicts with "received_at" (epoch seconds) and "frame".
+    """
+    with contextlib.closing(_open_index()) as index:
+        rows = index.execute(
+            "SELECT day, offset, length FROM frames WHERE incident_id = ? ORDER BY received_at, offset",
+            (str(incident_id),)
+        ).fetchall()
+    return _read_rows(rows)
+
+
+def time_range(start: datetime.datetime, end: datetime.datetime) -> list:
+    """
+    Get every archived frame received in a time range, oldest first.
+
+    Args:
+        start (datetime.datetime): Start of the range (inclusive).
+        end (datetime.datetime): End of the range (exclusive).
+
+    Returns:
+        list: Dicts with "received_at" (epoch seconds) and "frame".
+    """
+    with contextlib.closing(_open_index()) as index:
+        rows = index.execute(
+            "SELECT day, offset, length FROM frames WHERE received_at >= ? AND received_at < ? "
+            "ORDER BY received_at, offset",
+            (start.timestamp(), end.timestamp())
+        ).fetchall()
+    return _read_rows(rows)
+
+
+def all_frames():
+    """
+    Read every archived frame, day by day in the order they were written, without
+    loading the whole archive into memory.
+
+    Yields:
+        tuple: (received_at, frame)
+    """
+    if not os.path.isdir(ARCHIVE_DIR):
+        return
+    for day in _archived_days():
+        path = _path(day)
+        with (open(path, "rb") if os.path.exists(path) else gzip.open(f"{path}.gz", "rb")) as source:
+            for line in source:
+                if line.strip():
+                    record = json.loads(line)
+                    yield record["received_at"], record["frame"]
+
+
+def maintain(today: datetime.date = None) -> None:
+    """
+    Compress closed days and delete days older than the retention period.
+
+    INCIDENT_COMPRESS turns compression on or off, and INCIDENT_RETENTION_DAYS sets
+    how many days to keep (0 keeps everything).
+
+    Args:
+        today (datetime.date): The current date. Defaults to today.
+    """
+    current = settings.get()
+    today = today or datetime.date.today()
+    if not os.path.isdir(ARCHIVE_DIR):
+        return
+
+    if current.incident_retention_days > 0:
+        cutoff = (today - datetime.timedelta(days=current.incident_retention_days)).isoformat()
+        expired = [day for day in _archived_days() if day < cutoff]
+        for day in expired:
+            for path in (_path(day), _path(day) + ".gz"):
+                if os.path.exists(path):
+                    os.remove(path)
+        if expired:
+            with contextlib.closing(_open_index()) as index:
+                index.execute("DELETE FROM frames WHERE day < ?", (cutoff,))
+                index.commit()
+            _to_terminal(f"Deleted {len(expired)} day(s) older than {cutoff}")
+
+    if current.incident_compress:
+        for day in _archived_days():
+            path = _path(day)
+            if day >= today.isoformat() or not os.path.exists(path) or os.path.exists(f"{path}.gz"):
+                continue
+            if time.time() - os.path.getmtime(path) < CLOSED_DAY_GRACE:
+                continue
+            with open(path, "rb") as source, gzip.open(f"{path}.gz.tmp", "wb") as target:
+                shutil.copyfileobj(source, target)
+            os.replace(f"{path}.gz.tmp", f"{path}.gz")
+            os.remove(path)
+
+
+def start_maintenance() -> None:
+    """
+    Run maintain now and then every hour in a background thread.
+    """
+    global _maintenance_thread
+    if _maintenance_thread and _maintenance_thread.is_alive():
+        return
+    _maintenance_stop.clear()
+    _maintenance_thread = threading.Thread(target=_maintenance_loop, name="incident-archive", daemon=True)
+    _maintenance_thread.start()
+
+
+def stop_maintenance() -> None:
+    """
+    Stop the background maintenance.
+    """
+    _maintenance_stop.set()
+    if _maintenance_thread:
+        _maintenance_thread.join(timeout=10)
+
+
+def _maintenance_loop() -> None:
+    while True:
+        try:
+            maintain()
+        except Exception as e:
+            log_writer.to_error(MODULE_NAME, "Compress and prune the incident archive", e, "")
+        if _maintenance_stop.wait(MAINTENANCE_INTERVAL):
+            return
+
+
+def _incident_id(frame: dict) -> str:
+    message = frame.get("message") if isinstance(frame, dict) else None
+    if isinstance(message, dict) and message.get("id") is not None:
+        return str(message.get("id"))
+    return None
+
+
+def _path(day: str) -> str:
+    return os.path.join(ARCHIVE_DIR, f"{day}.jsonl")
+
+
+def _archived_days() -> list:
+    days = set()
+    for name in os.listdir(ARCHIVE_DIR):
+        if name.endswith(".jsonl") or name.endswith(".jsonl.gz"):
+            days.add(name.split(".", 1)[0])
+    return sorted(days)
+
+
+def _get_handle(day: str):
+    """
+    Get the open archive file for a day, rotating when the day changes.
+    """
+    global _handle, _handle_day
+    if _handle is not None and _handle_day == day:
+        return _handle
+    if _handle is not None:
+        _handle.close()
+    log_writer.ensure_dir(ARCHIVE_DIR)
+    _handle = open(_path(day), "ab")
+    _handle_day = day
+    return _handle
+
+
+def _get_index() -> sqlite3.Connection:
+    global _index
+    if _index is None:
+        _index = _open_index()
+    return _index
+
+
+def _open_index() -> sqlite3.Connection:
+    """
+    Open the index, creating it if it does not exist.
+    """
+    log_writer.ensure_dir(ARCHIVE_DIR)
+    index = sqlite3.connect(os.path.join(ARCHIVE_DIR, INDEX_FILE), check_same_thread=False)
+    index.execute("PRAGMA journal_mode=WAL")
+    index.execute("PRAGMA synchronous=NORMAL")
+    index.execute(
+        "CREATE TABLE IF NOT EXISTS frames ("
+        "incident_id TEXT, received_at REAL NOT NULL, day TEXT NOT NULL, "
+        "offset INTEGER NOT NULL, length INTEGER NOT NULL)"
+    )
+    index.execute("CREATE INDEX IF NOT EXISTS frames_incident ON frames (incident_id, received_at)")
+    index.execute("CREATE INDEX IF NOT EXISTS frames_time ON frames (received_at)")
+    return index
+
+
+def _read_rows(rows: list) -> list:
+    """
+    Read the frames for index rows, opening each day's file once.
+
+    Args:
+        rows (list): Tuples of (day, offset, length) in the order to return them.
+
+    Returns:
+        list: Dicts with "received_at" and "frame".
+    """
+    result = []
+    open_day, source = None, None
+    try:
+        for day, offset, length in rows:
+            if day != open_day:
+                if source is not None:
+                    source.close()
+                path = _path(day)
+                source = open(path, "rb") if os.path.exists(path) else gzip.open(f"{path}.gz", "rb")
+                open_day = day
+            source.seek(offset)
+            result.append(json.loads(source.read(length)))
+    finally:
+        if source is not None:
+            source.close()
+    return result
+
+
+def _to_terminal(msg: str) -> None:
+    """
+    Log a message to the terminal using the writer module.
+
+    Args:
+        msg (str): The message to log.
+    """
+    log_writer.to_terminal(MODULE_NAME, msg)
+
+
+def _parse_time(value: str) -> datetime.datetime:
+    return datetime.datetime.fromisoformat(value)
+
+
+def main(args: list) -> None:
+    if len(args) == 2 and args[0] == "incident":
+        records = incident_history(args[1])
+    elif len(args) == 3 and args[0] == "range":
+        records = time_range(_parse_time(args[1]), _parse_time(args[2]))
+    elif len(args) == 1 and args[0] == "maintain":
+        maintain()
+        log_writer.shutdown()
+        return
+    else:
+        print(__doc__.split("Usage:", 1)[1].rstrip())
+        sys.exit(1)
+    for record in records:
+        received = datetime.datetime.fromtimestamp(record["received_at"]).strftime("%Y-%m-%d %H:%M:%S")
+        print(f"{received}\t{json.dumps(record['frame'], ensure_ascii=False)}")
+    print(f"{len(records)} frame(s)", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -1,138 +1,187 @@
 import json
+import analytics
 import log_writer
 import message_handler
-import request_handler
+import metrics
+import settings
+import sinks
+from account import Account, default as default_account
+from coalescer import Coalescer
 from datetime import datetime, timedelta
-from decouple import config
 
 MODULE_NAME = "IncidentHandler"
 
-current_incidents: list = []
-
-def handle_incident(wrapper: json) -> None:
+def handle_incident(wrapper: json, account: Account = None) -> None:
     """
+    Handle an incident frame from FSR.
+
+    Args:
+        wrapper (json): The frame, with the incident in "message".
+        account (Account): The account the frame was received for. Defaults to the
+            account configured in .env.
     """
+    account = account or default_account
     try:
-      _update_list()
-      log_writer.to_incident_log(wrapper)
+        with metrics.timed("log_write"):
+            log_writer.to_incident_log(wrapper)
+
+        msg = wrapper.get("message")
+
+        with metrics.timed("classify"):
+            account.store.expire()
+            is_existing = msg.get("id") in account.store
+        if is_existing:
+            _handle_existing_incident(msg, account)
+        else:
+            _push_new_incident(msg, account)
+    except Exception as e:
+        _to_error("Handle new incident", e, account.name)
 
-      msg = wrapper.get("message")
 
-      if _is_in_list(msg.get("id")):
-         _handle_existing_incident(msg)
-      else:
-         _push_new_incident(msg)
-      _check_if_responding(msg)
+def flush_events() -> None:
+    """
+    Publish the response changes still waiting in a coalescing window, e.g. before shutting down.
+    """
+    _coalescer.flush_all()
+
+
+def _push_new_incident(msg: json, account: Account):
+    try:
+        _to_terminal("----- NEW INCIDENT -----", account)
+        _to_terminal(msg.get("body"), account)
+        incident = account.store.add(msg.get("id"))
+        analytics.incident_started(account.name, msg.get("id"), incident["timestamp"].timestamp())
+        metrics.inc("fsr_incident_frames_total", help="Incident frames by kind", kind="new")
+        delta = account.store.update_responses(msg.get("id"), msg.get("incident_responses") or [])
+        _update_people(msg.get("id"), delta, account)
+
+        pushover_msg: str = message_handler.generate_message(msg)
+        _publish("new_incident", msg.get("id"), pushover_msg, account, incident=msg)
+        _check_if_responding(msg, delta, account)
+
     except Exception as e:
-      _to_error("Handle new incident", str(e), "")
-
-
-def _push_new_incident(msg: json): 
-  try:
-    _to_terminal("----- NEW INCIDENT -----")
-    _to_terminal(msg.get("body"))
-    _add_to_list(msg)
-    _update_people(msg)
-
-    pushover_msg: str = message_handler.generate_message(msg)
-    request_handler.push_to_pushover(pushover_msg, "default")
-
-  except Exception as e:
-    _to_error("Handle a new message", str(e), "")
-
-
-def _handle_existing_incident(msg):
-   global current_incidents
-   _to_terminal("Handle existing incident")
-   _update_people(msg)
-   incident = next((entry for entry in current_incidents if entry["id"] == msg.get("id")), None)
-   threshold = incident["timestamp"] + timedelta(seconds=45)
-
-   if incident["hasSentPeople"]:
-      return
-   if datetime.now() < threshold:
-      return
-   
-   incident["hasSentPeople"] = True
-   _send_update(msg)
-
-
-def _update_people(msg: json):
-   global current_incidents
-   incident = next((entry for entry in current_incidents if entry["id"] == msg.get("id")), None)
-   for user in msg["incident_responses"]:
-      if user.get("status") == "acknowledged" and not any(entry == user.get("user_name") for entry in incident["people"]):
-         print("adding " + user.get("user_name"))
-         incident["people"].append(user.get("user_name"))
-
-
-def _add_to_list(msg: json):
-  global current_incidents
-  obj = {
-     "id": msg.get("id"),
-     "timestamp": datetime.now(),
-     "isResponding": False,
-     "people": [],
-     "hasSentPeople": False
-  }
-  current_incidents.append(obj)
-
-
-def _update_list():
-  global current_incidents
-  threshold = datetime.now() - timedelta(minutes=10)
-  current_incidents = [entry for entry in current_incidents if entry["timestamp"] >= threshold]
-
-
-def _is_in_list(id: str) -> bool:
-   global current_incidents
-   return any(entry["id"] == id for entry in current_incidents)
-
-
-def _check_if_responding(msg: json) -> None: 
-   global current_incidents
-   if not config('ENABLE_RESPONDING', cast=bool, default=False):
-      return
-   userName = config('RESPONDING_USER_NAME')
-   user = next((item for item in msg.get("incident_responses") if item.get("user_name") == userName), None)
-   incident = next((entry for entry in current_incidents if entry["id"] == msg.get("id")), None)
-
-   if user == None:
-      return
-   if incident == None:
-      return
-   if incident["isResponding"] == True:
-      return
-   if user.get("status") != "acknowledged":
-      return
-   
-   incident["isResponding"] = True
-   request_handler.push_to_pushover(config('RESPONDING_MSG'))
-
-
-def _to_terminal(msg: str) -> None:
+        _to_error("Handle a new message", e, account.name)
+
+
+def _handle_existing_incident(msg, account: Account):
+    delta = account.store.update_responses(msg.get("id"), msg.get("incident_responses") or [])
+    if delta:
+        _to_terminal("Handle existing incident", account)
+        metrics.inc("fsr_incident_frames_total", help="Incident frames by kind", kind="changed")
+        _update_people(msg.get("id"), delta, account)
+        _coalescer.add(
+            (account.name, msg.get("id")), delta, account, settings.get().incident_coalesce_window
+        )
+    else:
+        metrics.inc("fsr_incident_frames_total", help="Incident frames by kind", kind="unchanged")
+
+    incident = account.store.get(msg.get("id"))
+    threshold = incident["timestamp"] + timedelta(seconds=45)
+    if not incident["hasSentPeople"] and datetime.now() >= threshold:
+        incident["hasSentPeople"] = True
+        _send_update(incident, account)
+
+    if delta:
+        _check_if_responding(msg, delta, account)
+
+
+def _update_people(incident_id, delta: dict, account: Account):
+    acknowledged = [user_name for user_name, (old, new) in delta.items() if new == "acknowledged"]
+    added = account.store.add_responders(incident_id, acknowledged)
+    if added:
+        analytics.acknowledged(account.name, incident_id, added)
+
+
+def _check_if_responding(msg: json, delta: dict, account: Account) -> None:
+    if not settings.get().enable_responding:
+        return
+    userName, responding_msg = account.responder()
+    change = delta.get(userName)
+    incident = account.store.get(msg.get("id"))
+
+    if change == None:
+        return
+    if incident == None:
+        return
+    if incident["isResponding"] == True:
+        return
+    if change[1] != "acknowledged":
+        return
+
+    incident["isResponding"] = True
+    _publish("responding", msg.get("id"), responding_msg, account, incident=msg)
+
+
+def _to_terminal(msg: str, account: Account = None) -> None:
     """
     Log a message to the terminal using the writer module.
-    
+
     Args:
         msg (str): The message to log.
+        account (Account): The account the message is about, named in the log
+            unless it is the default account.
     """
-    log_writer.to_terminal(MODULE_NAME, msg)
+    if account is None or account is default_account:
+        log_writer.to_terminal(MODULE_NAME, msg)
+    else:
+        log_writer.to_terminal(f"{MODULE_NAME} {account.name}", msg)
 
 
-def _to_error(tried_to: str, err_msg: str, obj: object) -> None:
+def _to_error(tried_to: str, err_msg: object, obj: object) -> None:
     """
     Log an error message using the writer module.
-    
+
     Args:
         tried_to (str): Description of the operation attempted.
-        err_msg (str): The error message.
+        err_msg (object): The exception, or an error message.
         obj (object): Additional context for the error.
     """
     log_writer.to_error(MODULE_NAME, tried_to, err_msg, obj)
 
-def _send_update(msg: json) -> None:
-   incident = next((entry for entry in current_incidents if entry["id"] == msg.get("id")), None)
-   people = len(incident["people"])
-   message = str(people) + ' retursvar'
-   request_handler.push_to_pushover(message)
\ No newline at end of file
+def _send_update(incident: dict, account: Account) -> None:
+    people = len(incident["people"])
+    message = str(people) + ' retursvar'
+    _publish("responders", incident["id"], message, account, responders=people)
+
+
+def _publish_responses(key: tuple, changes: dict, account: Account) -> None:
+    """
+    Publish the coalesced response changes of an incident to the sinks.
+
+    Args:
+        key (tuple): The account name and incident id.
+        changes (dict): (old status, new status) by user name.
+        account (Account): The account the incident belongs to.
+    """
+    incident_id = key[1]
+    incident = account.store.get(incident_id)
+    statuses = {user_name: new for user_name, (old, new) in changes.items()}
+    counts: dict = {}
+    for status in statuses.values():
+        counts[status] = counts.get(status, 0) + 1
+    text = ", ".join(f"{count} {status}" for status, count in sorted(counts.items(), key=lambda item: str(item[0])))
+    _publish(
+        "responses", incident_id, text, account,
+        changes=statuses,
+        responders=len(incident["people"]) if incident else None
+    )
+
+
+_coalescer = Coalescer(_publish_responses)
+
+
+def _publish(event: str, incident_id, text: str, account: Account, **extra) -> None:
+    """
+    Publish an event about an incident to every sink (Pushover, webhook, MQTT).
+
+    Args:
+        event (str): The kind of event, see the sinks module.
+        incident_id: The FSR incident id.
+        text (str): The notification text.
+        account (Account): The account the incident belongs to.
+        **extra: Further fields of the event.
+    """
+    sinks.publish(
+        {"event": event, "account": account.name, "incident_id": incident_id, "text": text, **extra},
+        account
+    )
@@ -0,0 +1,159 @@
+"""
+Module: incident_snapshot
+Purpose: Saves the state of the active incidents (ids, timestamps, flags,
+         responders) to disk periodically and on shutdown, and loads it at
+         startup. After a restart an ongoing incident is then recognised, so
+         nobody is paged again and the responder summary is still sent.
+"""
+
+import json
+import os
+import threading
+import time
+import lease
+import log_writer
+import settings
+
+MODULE_NAME = "Incident Snapshot"
+
+# Format version written to the file, files with another version are ignored.
+VERSION = 1
+
+_accounts: list = []
+_last_written: dict = {}
+_thread: threading.Thread = None
+_stop = threading.Event()
+
+
+def save(account) -> bool:
+    """
+    Write the account's incidents to its snapshot file, if they changed since the last write.
+    A process standing by for another one (see the lease module) does not write.
+
+    Args:
+        account (Account): The account.
+
+    Returns:
+        bool: True if the file was written.
+    """
+    path = account.file_path(settings.get().incident_snapshot_path)
+    if not path or not lease.is_active():
+        return False
+    data = json.dumps(
+        {"version": VERSION, "saved_at": time.time(), "incidents": account.store.export()},
+        separators=(",", ":"),
+        ensure_ascii=False
+    )
+    # saved_at always changes, so compare the incidents only.
+    content = data[data.index('"incidents":'):]
+    if _last_written.get(path) == content:
+        return False
+    tmp = f"{path}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        f.write(data)
+    os.replace(tmp, path)
+    _last_written[path] = content
+    return True
+
+
+def load(account) -> int:
+    """
+    Load the account's incidents from its snapshot file, skipping expired incidents.
+
+    Args:
+        account (Account): The account.
+
+    Returns:
+        int: The number of incidents loaded.
+    """
+    path = account.file_path(settings.get().incident_snapshot_path)
+    if not path or not os.path.exists(path):
+        return 0
+    start = time.perf_counter()
+    try:
+        with open(path, encoding="utf-8") as f:
+            data = json.load(f)
+        if data.get("version") != VERSION:
+            _to_terminal(f"Ignoring {path} with unknown version {data.get('version')}")
+            return 0
+        loaded = account.store.restore(data["incidents"])
+    except (OSError, ValueError, KeyError, TypeError) as e:
+        _to_error("Load incident snapshot", e, path)
+        return 0
+    _to_terminal(f"Loaded {loaded} active incident(s) from {path} in {(time.perf_counter() - start) * 1000:.1f} ms")
+    return loaded
+
+
+def load_all() -> int:
+    """
+    Load the snapshots of the accounts given to start again, e.g. when taking over
+    from another process that wrote them.
+
+    Returns:
+        int: The number of incidents loaded.
+    """
+    return sum(load(account) for account in list(_accounts))
+
+
+def start(accounts: list) -> None:
+    """
+    Load the snapshots of the accounts and save them every INCIDENT_SNAPSHOT_INTERVAL
+    seconds in a background thread.
+
+    Args:
+        accounts (list): The accounts whose incidents to keep.
+    """
+    global _thread
+    _accounts[:] = accounts
+    for account in accounts:
+        load(account)
+    if _thread and _thread.is_alive():
+        return
+    _stop.clear()
+    _thread = threading.Thread(target=_snapshot_loop, name="incident-snapshot", daemon=True)
+    _thread.start()
+
+
+def stop() -> None:
+    """
+    Stop the background thread and save the snapshots one last time.
+    """
+    _stop.set()
+    if _thread:
+        _thread.join(timeout=5)
+    _save_all()
+
+
+def _snapshot_loop() -> None:
+    while not _stop.wait(settings.get().incident_snapshot_interval):
+        _save_all()
+
+
+def _save_all() -> None:
+    for account in list(_accounts):
+        try:
+            save(account)
+        except Exception as e:
+            _to_error("Save incident snapshot", e, account.name)
+
+
+def _to_terminal(msg: str) -> None:
+    """
+    Log a message to the terminal using the writer module.
+
+    Args:
+        msg (str): The message to log.
+    """
+    log_writer.to_terminal(MODULE_NAME, msg)
+
+
+def _to_error(tried_to: str, err_msg: object, obj: object) -> None:
+    """
+    Log an error using the writer module.
+
+    Args:
+        tried_to (str): Description of the operation attempted.
+        err_msg (object): The exception, or an error message.
+        obj (object): The context or data related to the error.
+    """
+    log_writer.to_error(MODULE_NAME, tried_to, err_msg, obj)
@@ -0,0 +1,211 @@
+"""
+Module: incident_store
+Purpose: Keeps the state of the incidents currently being handled, indexed by
+         incident id. Lookups and updates are O(1), responders are kept in a set,
+         and expiry uses a heap ordered by timestamp, so it only touches entries
+         that have actually expired. The last seen responses of every incident
+         are kept with a fingerprint, so an update frame that changes nothing
+         is recognised without comparing every response. The state can be
+         exported and restored, so it survives a restart (see incident_snapshot).
+"""
+
+import heapq
+from datetime import datetime, timedelta
+
+DEFAULT_MAX_AGE = timedelta(minutes=10)
+
+
+class IncidentStore:
+    """
+    In-memory store of active incidents.
+
+    Each incident is a dict with the keys "id", "timestamp", "isResponding",
+    "people" (a set of user names), "hasSentPeople", "responses" (the last
+    seen status by user name) and "fingerprint" (of the last seen responses).
+    """
+
+    def __init__(self, max_age: timedelta = DEFAULT_MAX_AGE):
+        """
+        Args:
+            max_age (timedelta): How long an incident is kept after it was added.
+        """
+        self.max_age = max_age
+        self._incidents: dict = {}
+        self._expiry: list = []
+
+    def __contains__(self, incident_id: object) -> bool:
+        return incident_id in self._incidents
+
+    def __len__(self) -> int:
+        return len(self._incidents)
+
+    def get(self, incident_id: object) -> dict:
+        """
+        Get an incident by id.
+
+        Args:
+            incident_id (object): The id of the incident.
+
+        Returns:
+            dict: The incident, or None if it is not in the store.
+        """
+        return self._incidents.get(incident_id)
+
+    def add(self, incident_id: object, now: datetime = None) -> dict:
+        """
+        Add a new incident, replacing any existing incident with the same id.
+
+        Args:
+            incident_id (object): The id of the incident.
+            now (datetime): The time the incident was received. Defaults to now.
+
+        Returns:
+            dict: The new incident.
+        """
+        timestamp = now or datetime.now()
+        incident = {
+            "id": incident_id,
+            "timestamp": timestamp,
+            "isResponding": False,
+            "people": set(),
+            "hasSentPeople": False,
+            "responses": {},
+            "fingerprint": None
+        }
+        self._incidents[incident_id] = incident
+        heapq.heappush(self._expiry, (timestamp, _HeapKey(incident_id)))
+        return incident
+
+    def add_responders(self, incident_id: object, user_names: list) -> list:
+        """
+        Add responders to an incident.
+
+        Args:
+            incident_id (object): The id of the incident.
+            user_names (list): The user names that have acknowledged.
+
+        Returns:
+            list: The user names that were not already registered.
+        """
+        incident = self._incidents.get(incident_id)
+        if incident is None:
+            return []
+        people: set = incident["people"]
+        added = [name for name in user_names if name not in people]
+        people.update(added)
+        return added
+
+    def update_responses(self, incident_id: object, responses: list) -> dict:
+        """
+        Record the responses of an incident frame and get what changed since the last frame.
+
+        Args:
+            incident_id (object): The id of the incident.
+            responses (list): The "incident_responses" of the frame.
+
+        Returns:
+            dict: (old status, new status) by user name for every response that
+                  changed, with None for a status that was not there. Empty if
+                  nothing changed.
+        """
+        incident = self._incidents.get(incident_id)
+        if incident is None:
+            return {}
+        pairs = tuple([(response.get("user_name"), response.get("status")) for response in responses])
+        fingerprint = hash(pairs)
+        if fingerprint == incident["fingerprint"]:
+            return {}
+        incident["fingerprint"] = fingerprint
+
+        last: dict = incident["responses"]
+        current = dict(pairs)
+        delta = {
+            user_name: (last.get(user_name), status)
+            for user_name, status in current.items()
+            if last.get(user_name) != status
+        }
+        if len(last) > len(current) - len(delta):
+            for user_name, status in last.items():
+                if user_name not in current:
+                    delta[user_name] = (status, None)
+        incident["responses"] = current
+        return delta
+
+    def expire(self, now: datetime = None) -> int:
+        """
+        Remove incidents that are older than max_age.
+
+        Args:
+            now (datetime): The current time. Defaults to now.
+
+        Returns:
+            int: The number of incidents removed.
+        """
+        threshold = (now or datetime.now()) - self.max_age
+        removed = 0
+        while self._expiry and self._expiry[0][0] < threshold:
+            timestamp, key = heapq.heappop(self._expiry)
+            incident = self._incidents.get(key.incident_id)
+            # Skip heap entries left behind when an incident was re-added.
+            if incident is not None and incident["timestamp"] == timestamp:
+                del self._incidents[key.incident_id]
+                removed += 1
+        return removed
+
+
+    def export(self) -> list:
+        """
+        Export the incidents in a compact, JSON serialisable form.
+
+        Returns:
+            list: One [id, timestamp (epoch seconds), isResponding, hasSentPeople,
+                  people, responses] list per incident.
+        """
+        return [
+            [
+                incident["id"],
+                incident["timestamp"].timestamp(),
+                incident["isResponding"],
+                incident["hasSentPeople"],
+                sorted(incident["people"]),
+                incident["responses"],
+            ]
+            for incident in list(self._incidents.values())
+        ]
+
+    def restore(self, records: list, now: datetime = None) -> int:
+        """
+        Add incidents exported by export, skipping those older than max_age.
+
+        Args:
+            records (list): The exported incidents.
+            now (datetime): The current time. Defaults to now.
+
+        Returns:
+            int: The number of incidents restored.
+        """
+        threshold = (now or datetime.now()) - self.max_age
+        restored = 0
+        for incident_id, timestamp, is_responding, has_sent_people, people, responses in records:
+            timestamp = datetime.fromtimestamp(timestamp)
+            if timestamp < threshold:
+                continue
+            incident = self.add(incident_id, timestamp)
+            incident["isResponding"] = is_responding
+            incident["hasSentPeople"] = has_sent_people
+            incident["people"] = set(people)
+            incident["responses"] = responses
+            restored += 1
+        return restored
+
+
+class _HeapKey:
+    """Wraps an incident id so heap entries with equal timestamps never compare ids."""
+
+    __slots__ = ("incident_id",)
+
+    def __init__(self, incident_id: object):
+        self.incident_id = incident_id
+
+    def __lt__(self, other: "_HeapKey") -> bool:
+        return False
@@ -0,0 +1,217 @@
+"""
+Module: lease
+Purpose: Decides which of several processes handles incidents when they run
+         as hot standbys of each other. The processes share a lease in a
+         SQLite file; the holder renews it every third of LEASE_TTL, and when
+         it stops renewing (crash, hang, lost host) another process takes it
+         over within LEASE_TTL seconds. Without LEASE_PATH the process is
+         always active.
+"""
+
+import os
+import socket
+import sqlite3
+import threading
+import time
+import log_writer
+import metrics
+
+MODULE_NAME = "Lease"
+
+LEASE_NAME = "fsr"
+
+_lock = threading.Lock()
+_db: sqlite3.Connection = None
+_holder: str = f"{socket.gethostname()}:{os.getpid()}"
+_ttl: float = 0.0
+_active: bool = True
+_renewed_at: float = 0.0
+_on_change = None
+_thread: threading.Thread = None
+_stop = threading.Event()
+_counters: dict = {"acquired": 0, "lost": 0}
+
+
+class LeaseError(Exception):
+    """Raised when the lease file can not be used."""
+    pass
+
+
+def start(path: str, ttl: float, on_change=None) -> bool:
+    """
+    Open the lease file, try to take the lease and keep renewing or trying in a
+    background thread.
+
+    Args:
+        path (str): The SQLite file shared by the processes. Empty to always be active.
+        ttl (float): Seconds the lease is valid without being renewed.
+        on_change: Called with True from the lease thread when this process takes
+            over the lease from another one, before is_active returns True, and with
+            False when it lost the lease, after is_active returns False.
+
+    Returns:
+        bool: True if this process holds the lease.
+
+    Raises:
+        LeaseError: If the lease file can not be opened.
+    """
+    global _db, _ttl, _active, _on_change, _thread
+    if not path:
+        _active = True
+        return True
+    try:
+        _db = sqlite3.connect(path, timeout=ttl, check_same_thread=False, isolation_level=None)
+        _db.execute("PRAGMA journal_mode=WAL")
+        _db.execute(
+            "CREATE TABLE IF NOT EXISTS lease (name TEXT PRIMARY KEY, holder TEXT NOT NULL, expires_at REAL NOT NULL)"
+        )
+    except sqlite3.Error as e:
+        raise LeaseError(f"Could not open {path}: {e}")
+    _ttl, _on_change = ttl, on_change
+    _active = _try_acquire()
+    _to_terminal(f"{'Holding' if _active else 'Waiting for'} the lease in {path} as {_holder}")
+    _stop.clear()
+    _thread = threading.Thread(target=_lease_loop, name="lease", daemon=True)
+    _thread.start()
+    return _active
+
+
+def stop() -> None:
+    """
+    Stop renewing and release the lease, so a standby takes over right away.
+    """
+    global _db
+    _stop.set()
+    if _thread is not None:
+        _thread.join(timeout=5)
+    if _db is None:
+        return
+    try:
+        _db.execute("UPDATE lease SET expires_at = 0 WHERE name = ? AND holder = ?", (LEASE_NAME, _holder))
+    except sqlite3.Error as e:
+        _to_error("Release the lease", e, _holder)
+    _db.close()
+    _db = None
+
+
+def is_active() -> bool:
+    """
+    Check if this process handles incidents.
+
+    Returns:
+        bool: True if this process holds the lease or no lease is used.
+    """
+    return _active
+
+
+def holder() -> str:
+    """
+    Get the name this process uses for the lease.
+
+    Returns:
+        str: host:pid
+    """
+    return _holder
+
+
+def _try_acquire() -> bool:
+    """
+    Take or renew the lease if it is free, expired or already ours.
+
+    Returns:
+        bool: True if this process holds the lease.
+    """
+    global _renewed_at
+    now = time.time()
+    try:
+        _db.execute("BEGIN IMMEDIATE")
+        try:
+            row = _db.execute("SELECT holder, expires_at FROM lease WHERE name = ?", (LEASE_NAME,)).fetchone()
+            if row is None or row[0] == _holder or row[1] < now:
+                _db.execute(
+                    "INSERT OR REPLACE INTO lease (name, holder, expires_at) VALUES (?, ?, ?)",
+                    (LEASE_NAME, _holder, now + _ttl)
+                )
+                result = True
+            else:
+                result = False
+            _db.execute("COMMIT")
+        except Exception:
+            _db.execute("ROLLBACK")
+            raise
+    except sqlite3.Error as e:
+        _to_error("Renew the lease", e, _holder)
+        # Nobody else can take the lease before it expires, so stay active until then.
+        return _active and now < _renewed_at + _ttl
+    if result:
+        _renewed_at = now
+    return result
+
+
+def _lease_loop() -> None:
+    global _active
+    while not _stop.wait(_ttl / 3):
+        acquired = _try_acquire()
+        if acquired and not _active:
+            _to_terminal("Took over the lease - handling incidents")
+            with _lock:
+                _counters["acquired"] += 1
+            _notify(True)
+            _active = True
+        elif not acquired and _active:
+            _to_terminal("Lost the lease - standing by")
+            with _lock:
+                _counters["lost"] += 1
+            _active = False
+            _notify(False)
+
+
+def _notify(active: bool) -> None:
+    if _on_change is None:
+        return
+    try:
+        _on_change(active)
+    except Exception as e:
+        _to_error("Change the lease state", e, _holder)
+
+
+def _to_terminal(msg: str) -> None:
+    """
+    Log a message to the terminal using the writer module.
+
+    Args:
+        msg (str): The message to log.
+    """
+    log_writer.to_terminal(MODULE_NAME, msg)
+
+
+def _to_error(tried_to: str, err_msg: object, obj: object) -> None:
+    """
+    Log an error using the writer module.
+
+    Args:
+        tried_to (str): Description of the operation attempted.
+        err_msg (object): The exception, or an error message.
+        obj (object): The context or data related to the error.
+    """
+    log_writer.to_error(MODULE_NAME, tried_to, err_msg, obj)
+
+
+def _collect_metrics() -> list:
+    """
+    Report the lease state to the metrics module.
+
+    Returns:
+        list: Metric samples, see metrics.register_collector.
+    """
+    with _lock:
+        counters = dict(_counters)
+    help = "Lease changes of this process"
+    return [
+        ("fsr_lease_active", "gauge", "1 if this process handles incidents", {}, _active),
+        ("fsr_lease_changes_total", "counter", help, {"change": "acquired"}, counters["acquired"]),
+        ("fsr_lease_changes_total", "counter", help, {"change": "lost"}, counters["lost"]),
+    ]
+
+
+metrics.register_collector(_collect_metrics)
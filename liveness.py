@@ -0,0 +1,260 @@
+"""
+Module: liveness
+Purpose: Detects FSR connections that look open but have gone silent. FSR
+         sends a ping every few seconds, so when no frame has arrived for
+         WATCHDOG_PING_TIMEOUT seconds the connection is closed, which makes
+         the handler reconnect. Also serves /health on the metrics server with
+         the state of every connection, for supervisors to poll.
+"""
+
+import json
+import threading
+import time
+import frames
+import log_writer
+import metrics
+import reconnect
+import settings
+
+MODULE_NAME = "Liveness"
+
+# Seconds between checks of the connections.
+CHECK_INTERVAL = 1.0
+
+_lock = threading.Lock()
+_tracked: list = []
+_thread: threading.Thread = None
+_stop = threading.Event()
+
+
+class Liveness:
+    """
+    Liveness of one FSR connection: when frames, pings and incidents last arrived.
+
+    The connection handler reports what happens, and the watchdog closes the
+    connection through the callback given to connected when it goes silent.
+    """
+
+    def __init__(self, name: str, engine: reconnect.ReconnectEngine):
+        """
+        Args:
+            name (str): The account the connection belongs to.
+            engine (ReconnectEngine): The connection's reconnect engine, for the subscription state.
+        """
+        self.name = name
+        self.engine = engine
+        self.is_connected = False
+        self.closable = False
+        self.forced_reconnects = 0
+        self._close = None
+        self._connected_at = None
+        self._last_frame = None
+        self._last_ping = None
+        self._last_incident = None
+        self._lock = threading.Lock()
+
+    def connected(self, close=None) -> None:
+        """
+        Register an opened connection.
+
+        Args:
+            close: Called without arguments from the watchdog thread to close the
+                connection when it goes silent. None if the handler checks
+                silent_for itself.
+        """
+        now = time.monotonic()
+        with self._lock:
+            self.is_connected = True
+            self.closable = close is not None
+            self._close = close
+            self._connected_at = now
+            self._last_frame = now
+
+    def disconnected(self) -> None:
+        """
+        Register a closed connection.
+        """
+        with self._lock:
+            self.is_connected = False
+            self.closable = False
+            self._close = None
+
+    def frame(self, kind: str) -> None:
+        """
+        Register a received frame.
+
+        Args:
+            kind (str): The kind of frame, see frames.classify.
+        """
+        now = time.monotonic()
+        self._last_frame = now
+        if kind == frames.PING:
+            self._last_ping = now
+        elif kind == frames.INCIDENT:
+            self._last_incident = now
+
+    def silent_for(self) -> float:
+        """
+        Get the seconds since the last frame on the open connection.
+
+        Returns:
+            float: The seconds, 0.0 if not connected.
+        """
+        last = self._last_frame
+        if not self.is_connected or last is None:
+            return 0.0
+        return time.monotonic() - last
+
+    def force_reconnect(self, silent: float) -> None:
+        """
+        Close the connection because it has been silent too long. Without a close
+        callback only the forced reconnect is counted, the handler closes it.
+
+        Args:
+            silent (float): Seconds since the last frame, for the log.
+        """
+        with self._lock:
+            if not self.is_connected:
+                return
+            close, self._close = self._close, None
+            self.closable = False
+            self.forced_reconnects += 1
+        _to_terminal(f"No frames from FSR for {silent:.0f} s on {self.name} - reconnecting")
+        metrics.inc("fsr_watchdog_reconnects_total", help="Connections closed because FSR went silent", account=self.name)
+        if close is not None:
+            try:
+                close()
+            except Exception as e:
+                _to_error("Close a silent connection", e, self.name)
+
+    def status(self) -> dict:
+        """
+        Get the state of the connection.
+
+        Returns:
+            dict: connected, subscribed, the seconds since the connection opened and since the
+                  last frame, ping and incident (None if there was none), and forced reconnects.
+        """
+        now = time.monotonic()
+
+        def age(since):
+            return None if since is None else round(now - since, 1)
+
+        return {
+            "account": self.name,
+            "connected": self.is_connected,
+            "subscribed": self.is_connected and self.engine.state == reconnect.STATE_SUBSCRIBED,
+            "connected_age": age(self._connected_at) if self.is_connected else None,
+            "last_frame_age": age(self._last_frame),
+            "last_ping_age": age(self._last_ping),
+            "last_incident_age": age(self._last_incident),
+            "forced_reconnects": self.forced_reconnects,
+        }
+
+
+def track(livenesses: list) -> None:
+    """
+    Set the connections to watch and report on /health.
+
+    Args:
+        livenesses (list): The Liveness of every connection.
+    """
+    with _lock:
+        _tracked[:] = livenesses
+
+
+def start() -> None:
+    """
+    Start the watchdog thread, which closes connections that went silent.
+    """
+    global _thread
+    if _thread is not None and _thread.is_alive():
+        return
+    _stop.clear()
+    _thread = threading.Thread(target=_watch_loop, name="liveness-watchdog", daemon=True)
+    _thread.start()
+
+
+def stop() -> None:
+    """
+    Stop the watchdog thread.
+    """
+    _stop.set()
+    if _thread is not None:
+        _thread.join(timeout=5)
+
+
+def health() -> tuple:
+    """
+    Get the health of the connections for the /health endpoint.
+
+    Healthy means every connection is subscribed and has had a frame within
+    WATCHDOG_PING_TIMEOUT seconds (when the timeout is enabled).
+
+    Returns:
+        tuple: (status code, content type, JSON body); 200 if healthy, 503 otherwise.
+    """
+    timeout = settings.get().watchdog_ping_timeout
+    with _lock:
+        statuses = [liveness.status() for liveness in _tracked]
+    healthy = bool(statuses) and all(
+        status["subscribed"] and (timeout <= 0 or (status["last_frame_age"] or 0) <= timeout)
+        for status in statuses
+    )
+    body = json.dumps({"healthy": healthy, "connections": statuses})
+    return (200 if healthy else 503), "application/json", body + "\n"
+
+
+def _watch_loop() -> None:
+    while not _stop.wait(CHECK_INTERVAL):
+        timeout = settings.get().watchdog_ping_timeout
+        if timeout <= 0:
+            continue
+        with _lock:
+            livenesses = list(_tracked)
+        for liveness in livenesses:
+            silent = liveness.silent_for()
+            if liveness.closable and silent > timeout:
+                liveness.force_reconnect(silent)
+
+
+def _to_terminal(msg: str) -> None:
+    """
+    Log a message to the terminal using the writer module.
+
+    Args:
+        msg (str): The message to log.
+    """
+    log_writer.to_terminal(MODULE_NAME, msg)
+
+
+def _to_error(tried_to: str, err_msg: object, obj: object) -> None:
+    """
+    Log an error using the writer module.
+
+    Args:
+        tried_to (str): Description of the operation attempted.
+        err_msg (object): The exception, or an error message.
+        obj (object): The context or data related to the error.
+    """
+    log_writer.to_error(MODULE_NAME, tried_to, err_msg, obj)
+
+
+def _collect_metrics() -> list:
+    """
+    Report the age of the last frame of every connection to the metrics module.
+
+    Returns:
+        list: Metric samples, see metrics.register_collector.
+    """
+    with _lock:
+        livenesses = list(_tracked)
+    return [
+        ("fsr_last_frame_age_seconds", "gauge", "Seconds since the last frame from FSR, 0 if not connected",
+         {"account": liveness.name}, liveness.silent_for())
+        for liveness in livenesses
+    ]
+
+
+metrics.register_collector(_collect_metrics)
+metrics.register_endpoint("/health", health)
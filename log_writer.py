@@ -2,16 +2,38 @@
 Module: writer
 Purpose: Provides functions to log messages, errors, and incidents locally,
          and to send notifications (via pushover) to the administrator.
+         Writes are queued and done by a background writer thread, which keeps
+         one open file per destination and rotates it at midnight.
 """
 
+import atexit
 import datetime
 import os
-import request_handler
+import queue
+import threading
+import time
+import error_digest
+import incident_archive
+import settings
 
 DEST_LOG = "Log"
 DEST_ERROR = "Error"
 DEST_INCIDENT_LOG = "Incident"
 
+# Flush policies for the writer thread.
+FLUSH_BATCH = "batch"
+FLUSH_INTERVAL = "interval"
+
+MAX_BATCH = 256
+_STOP = object()
+
+_queue: queue.Queue = queue.Queue()
+_writer: threading.Thread = None
+_writer_lock = threading.Lock()
+_io_lock = threading.Lock()
+_handles: dict = {}
+_is_shut_down = False
+
 
 def ensure_dir(directory: str) -> None:
     """
@@ -34,29 +56,11 @@ def to_terminal(module: str, msg: str) -> None:
     try:
         now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
         output = f"{now}\t{module}\t{msg}"
-        _to_log(output)
-        print(output)
+        _submit(DEST_LOG, now[:10], f"{output}\n", output)
     except Exception as e:
         _send_pushover_to_admin("Writer", "Write to terminal", e.__class__, "")
 
 
-def _to_log(msg: str) -> None:
-    """
-    Write a log message to the daily log file in the log directory.
-
-    Args:
-        msg (str): The message to write.
-    """
-    try:
-        ensure_dir(DEST_LOG)
-        filename = f"{datetime.datetime.now().strftime('%Y-%m-%d')}.log"
-        path = os.path.join(DEST_LOG, filename)
-        with open(path, 'a+', encoding="utf-8") as f:
-            f.write(f"{msg}\n")
-    except Exception as e:
-        _send_pushover_to_admin("Writer", "Write to log", e.__class__, "")
-
-
 def to_error(module: str, tried_to: str, err_msg: Exception, elem: object) -> None:
     """
     Log an error message to the error log file and notify the admin.
@@ -70,45 +74,217 @@ def to_error(module: str, tried_to: str, err_msg: Exception, elem: object) -> No
     err_msg_repr = repr(err_msg)
     try:
         to_terminal("Writer", "Exception occurred - Check error log")
-        ensure_dir(DEST_ERROR)
-        filename = f"{datetime.datetime.now().strftime('%Y-%m-%d')}.log"
-        path = os.path.join(DEST_ERROR, filename)
-        with open(path, 'a+', encoding="utf-8") as f:
-            log_entry = (
-                "-----------\n"
-                f"{datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n"
-                f"Module: {module}\n"
-                f"Tried to: {tried_to}\n"
-                f"Error message: {err_msg_repr}\n"
-                f"Element: {elem}\n"
-                "-----------\n"
-            )
-            f.write(log_entry)
-        _send_pushover_to_admin(module, tried_to, err_msg_repr, elem)
+        now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        log_entry = (
+            "-----------\n"
+            f"{now}\n"
+            f"Module: {module}\n"
+            f"Tried to: {tried_to}\n"
+            f"Error message: {err_msg_repr}\n"
+            f"Element: {elem}\n"
+            "-----------\n"
+        )
+        _submit(DEST_ERROR, now[:10], log_entry)
+        _send_pushover_to_admin(module, tried_to, err_msg, elem)
     except Exception as e:
         _send_pushover_to_admin(module, "Exception while handling an error", e.__class__, " ")
 
 
-def to_incident_log(msg: str) -> None:
+def to_incident_log(msg: dict) -> None:
     """
-    Write an incident message to the incident log file.
+    Write an incident message to the incident archive (JSON Lines, see incident_archive).
 
     Args:
-        msg (str): The incident message to log.
+        msg (dict): The incident message to log.
     """
     try:
-        ensure_dir(DEST_INCIDENT_LOG)
-        filename = f"{datetime.datetime.now().strftime('%Y-%m-%d')}.log"
-        path = os.path.join(DEST_INCIDENT_LOG, filename)
-        with open(path, 'a+', encoding="utf-8") as f:
-            f.write(f"{msg}\n")
+        now = time.time()
+        day = datetime.date.fromtimestamp(now).isoformat()
+        _submit(DEST_INCIDENT_LOG, day, (now, msg))
     except Exception as e:
         _send_pushover_to_admin("Writer", "Write to incident log", e.__class__, "")
 
 
+def flush() -> None:
+    """
+    Wait until everything queued so far has been written and flushed to disk.
+    """
+    if _writer is not None and _writer.is_alive():
+        _queue.join()
+    with _io_lock:
+        _flush_handles(_flush_settings()[2])
+
+
+def shutdown() -> None:
+    """
+    Write everything still queued, then stop the writer thread and close all files.
+
+    Anything logged after shutdown is written directly by the caller.
+    """
+    global _is_shut_down
+    with _writer_lock:
+        if _is_shut_down:
+            return
+        _is_shut_down = True
+        if _writer is not None and _writer.is_alive():
+            _queue.put(_STOP)
+            _writer.join(timeout=10)
+    with _io_lock:
+        _flush_handles(_flush_settings()[2])
+        for _, handle in _handles.values():
+            handle.close()
+        _handles.clear()
+        incident_archive.close()
+
+
+def _submit(dest: str, day: str, text: str, echo: str = None) -> None:
+    """
+    Queue a write for the writer thread, starting it if needed.
+
+    Args:
+        dest (str): The destination directory.
+        day (str): The date (YYYY-MM-DD) of the entry, which selects the file.
+        text (str): The text to append to the file. For the incident log this is
+            a tuple of (received_at, frame) for the incident archive instead.
+        echo (str): Text to print to the terminal as well, if any.
+    """
+    record = (dest, day, text, echo)
+    if _is_shut_down:
+        with _io_lock:
+            _write_batch([record])
+            _flush_handles(False)
+        return
+    _ensure_writer()
+    _queue.put(record)
+
+
+def _ensure_writer() -> None:
+    """
+    Start the writer thread if it is not running.
+    """
+    global _writer
+    if _writer is not None and _writer.is_alive():
+        return
+    with _writer_lock:
+        if _writer is None or not _writer.is_alive():
+            _writer = threading.Thread(target=_writer_loop, name="log-writer", daemon=True)
+            _writer.start()
+
+
+def _writer_loop() -> None:
+    """
+    Drain the queue in batches and write them, flushing according to LOG_FLUSH_POLICY.
+
+    With the "batch" policy (default) files are flushed after every batch. With the
+    "interval" policy they are flushed every LOG_FLUSH_INTERVAL seconds. If LOG_FSYNC
+    is enabled, every flush is also synced to disk.
+    """
+    policy, interval, fsync = _flush_settings()
+    last_flush = time.monotonic()
+    while True:
+        try:
+            batch = [_queue.get(timeout=interval)]
+        except queue.Empty:
+            batch = []
+        while batch and len(batch) < MAX_BATCH:
+            try:
+                batch.append(_queue.get_nowait())
+            except queue.Empty:
+                break
+
+        stop = _STOP in batch
+        with _io_lock:
+            _write_batch([record for record in batch if record is not _STOP])
+            if policy != FLUSH_INTERVAL or stop or time.monotonic() - last_flush >= interval:
+                _flush_handles(fsync)
+                last_flush = time.monotonic()
+        for _ in batch:
+            _queue.task_done()
+        if stop:
+            return
+
+
+def _flush_settings() -> tuple:
+    """
+    Get the flush policy, interval and fsync settings. Falls back to the defaults
+    if the settings can not be loaded, so errors can still be logged.
+
+    Returns:
+        tuple: (policy, interval, fsync)
+    """
+    try:
+        current = settings.get()
+        return current.log_flush_policy, current.log_flush_interval, current.log_fsync
+    except settings.SettingsError:
+        return FLUSH_BATCH, 1.0, False
+
+
+def _write_batch(batch: list) -> None:
+    """
+    Write records to their files, printing those that should be echoed.
+
+    Args:
+        batch (list): Records of (dest, day, text, echo).
+    """
+    incidents = []
+    for dest, day, text, echo in batch:
+        try:
+            if dest == DEST_INCIDENT_LOG:
+                incidents.append((day, text[0], text[1]))
+                continue
+            if echo is not None:
+                print(echo)
+            _get_handle(dest, day).write(text)
+        except Exception as e:
+            _send_pushover_to_admin("Writer", f"Write to {dest}", e.__class__, "")
+    if incidents:
+        try:
+            incident_archive.write(incidents)
+        except Exception as e:
+            _send_pushover_to_admin("Writer", "Write to incident log", e.__class__, "")
+
+
+def _get_handle(dest: str, day: str):
+    """
+    Get the open file for a destination, rotating to a new file when the day changes.
+
+    Args:
+        dest (str): The destination directory.
+        day (str): The date (YYYY-MM-DD) of the entry.
+
+    Returns:
+        The open file.
+    """
+    current = _handles.get(dest)
+    if current is not None and current[0] == day:
+        return current[1]
+    if current is not None:
+        current[1].close()
+    ensure_dir(dest)
+    handle = open(os.path.join(dest, f"{day}.log"), 'a+', encoding="utf-8")
+    _handles[dest] = (day, handle)
+    return handle
+
+
+def _flush_handles(fsync: bool) -> None:
+    """
+    Flush all open files.
+
+    Args:
+        fsync (bool): If True, also sync the files to disk.
+    """
+    for _, handle in _handles.values():
+        handle.flush()
+        if fsync:
+            os.fsync(handle.fileno())
+    incident_archive.flush(fsync)
+
+
 def _send_pushover_to_admin(module: str, tried_to: str, err_msg: object, elem: object) -> None:
     """
-    Send a notification to the administrator via Pushover.
+    Report an error to the administrator. The error is collected by the error_digest
+    module, which pushes it via Pushover in the background, rate limited and
+    with repeats combined into digests.
 
     Args:
         module (str): The module where the error occurred.
@@ -117,15 +293,10 @@ def _send_pushover_to_admin(module: str, tried_to: str, err_msg: object, elem: o
         elem (object): The element or context associated with the error.
     """
     try:
-        now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        msg = (
-            f"{now}\n"
-            f"Module: {module}\n"
-            f"Tried to: {tried_to}\n"
-            f"Error message: {err_msg}\n"
-            f"Element: {elem}"
-        )
-        request_handler.push_to_pushover_admin(msg, "default")
+        error_digest.report(module, tried_to, err_msg, elem)
     except Exception as e:
         print("Exception in sending pushover to Admin")
         print(e)
+
+
+atexit.register(shutdown)
@@ -1,11 +1,16 @@
+import html
+import geo_index
 import log_writer as w
+import metrics
+import settings
 
 MODULE_NAME = "MessageHandler"
 
 
 def generate_message(msg: dict) -> str:
     """
-    Generate a message by appending a Google Maps link button.
+    Generate a message by appending the nearest station and nearby points from the
+    map data (if GEO_DATA_PATH is set) and a Google Maps link button.
 
     Args:
         msg (dict): A dictionary containing message details.
@@ -17,14 +22,20 @@ def generate_message(msg: dict) -> str:
     Returns:
         str: The generated message with the appended map link.
     """
-    res = msg.get("body", "")
+    with metrics.timed("render"):
+        res = msg.get("body", "")
 
-    try:
-        coor = _generate_url(msg.get("location", ""), msg.get("address", {}))
-        res += "\n\n" + _add_html_button(coor)
-    except Exception as e:
-        _to_error("Convert location to link", e.__class__.__name__, "")
-    return res
+        try:
+            res += _geo_lines(msg.get("address") or {})
+        except Exception as e:
+            _to_error("Enrich location", e, "")
+
+        try:
+            coor = _generate_url(msg.get("location", ""), msg.get("address", {}))
+            res += "\n\n" + _add_html_button(coor)
+        except Exception as e:
+            _to_error("Convert location to link", e, "")
+        return res
 
 
 def _generate_url(loc: str, addr: dict) -> str:
@@ -60,6 +71,46 @@ def _build_coordinates(loc: str, addr: dict) -> str:
     return loc
 
 
+def _geo_lines(addr: dict) -> str:
+    """
+    Describe the nearest station and the nearby points of the incident's coordinates.
+
+    Args:
+        addr (dict): A dictionary with 'latitude' and 'longitude' keys.
+
+    Returns:
+        str: The lines to append to the message, or an empty string if there is
+             no map data, no coordinates or nothing close by.
+    """
+    if not geo_index.is_loaded() or addr.get("latitude") is None or addr.get("longitude") is None:
+        return ""
+    found = geo_index.enrich(float(addr["latitude"]), float(addr["longitude"]))
+    if found is None:
+        return ""
+    lines = []
+    if found["station"] is not None:
+        name, km = found["station"]
+        lines.append(f"{geo_index.STATION_KIND.capitalize()}: {html.escape(name)} ({_format_distance(km)})")
+    for kind, points in found["nearby"].items():
+        lines.append(f"{html.escape(kind.capitalize())}: " + ", ".join(
+            f"{html.escape(name)} ({_format_distance(km)})" for name, km in points
+        ))
+    return "\n\n" + "\n".join(lines) if lines else ""
+
+
+def _format_distance(km: float) -> str:
+    """
+    Format a distance in m below 1 km and in km otherwise.
+
+    Args:
+        km (float): The distance in km.
+
+    Returns:
+        str: E.g. "120 m" or "2.3 km".
+    """
+    return f"{km * 1000:.0f} m" if km < 1 else f"{km:.1f} km"
+
+
 def _add_html_button(url: str) -> str:
     """
     Create an HTML anchor tag that links to the given URL.
@@ -70,16 +121,16 @@ def _add_html_button(url: str) -> str:
     Returns:
         str: An HTML string with a clickable link.
     """
-    return f'<a href="{url}" target="_blank">Link til kort</a>'
+    return f'<a href="{url}" target="_blank">{settings.get().link_to_map_str}</a>'
 
 
-def _to_error(tried_to: str, err_msg: str, extra_info: str) -> None:
+def _to_error(tried_to: str, err_msg: object, extra_info: str) -> None:
     """
     Log an error message using the writer module.
 
     Args:
         tried_to (str): A description of the operation that was attempted.
-        err_msg (str): The error message or exception name.
+        err_msg (object): The exception, or an error message.
         extra_info (str): Additional context or information.
     """
     w.to_error(MODULE_NAME, tried_to, err_msg, extra_info)
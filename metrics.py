@@ -0,0 +1,355 @@
+"""
+Module: metrics
+Purpose: Collects counters and latency histograms for the alert pipeline, and
+         serves them in Prometheus text format on a local HTTP endpoint.
+         Every message is traced from the moment it arrives on the WebSocket,
+         so the end-to-end latency until Pushover acknowledges it is known.
+"""
+
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Histogram buckets in seconds.
+DEFAULT_BUCKETS = (
+    0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+    0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0
+)
+
+STAGE_HISTOGRAM = "fsr_stage_latency_seconds"
+ALERT_HISTOGRAM = "fsr_alert_latency_seconds"
+
+_lock = threading.Lock()
+_types: dict = {}
+_counters: dict = {}
+_histograms: dict = {}
+_collectors: list = []
+_endpoints: dict = {}
+_trace = threading.local()
+_server: ThreadingHTTPServer = None
+
+
+def inc(name: str, amount: float = 1, help: str = "", **labels) -> None:
+    """
+    Increment a counter.
+
+    Args:
+        name (str): The metric name.
+        amount (float): The amount to add.
+        help (str): Help text shown for the metric.
+        **labels: Label values for this series.
+    """
+    key = (name, tuple(sorted(labels.items())))
+    with _lock:
+        _types.setdefault(name, ("counter", help))
+        _counters[key] = _counters.get(key, 0) + amount
+
+
+def observe(name: str, seconds: float, help: str = "", **labels) -> None:
+    """
+    Add an observation to a histogram.
+
+    Args:
+        name (str): The metric name.
+        seconds (float): The observed value in seconds.
+        help (str): Help text shown for the metric.
+        **labels: Label values for this series.
+    """
+    key = (name, tuple(sorted(labels.items())))
+    with _lock:
+        series = _histograms.get(key)
+        if series is None:
+            _types.setdefault(name, ("histogram", help))
+            series = _histograms[key] = [[0] * len(DEFAULT_BUCKETS), 0.0, 0]
+        buckets = series[0]
+        for i, bound in enumerate(DEFAULT_BUCKETS):
+            if seconds <= bound:
+                buckets[i] += 1
+                break
+        series[1] += seconds
+        series[2] += 1
+
+
+def register_collector(collector) -> None:
+    """
+    Register a function that is called on every scrape to report current values.
+
+    The function must return a list of (name, type, help, labels, value) tuples,
+    where type is "counter" or "gauge" and labels is a dict.
+
+    Args:
+        collector: The function to call.
+    """
+    _collectors.append(collector)
+
+
+def register_endpoint(path: str, handler, method: str = "GET") -> None:
+    """
+    Serve another path on the metrics server, e.g. a health check.
+
+    Args:
+        path (str): The path, e.g. "/health".
+        handler: Called without arguments for every request of the path, returns a
+            tuple of (status code, content type, body).
+        method (str): "GET", or "POST" for actions that change something, so
+            scrapers and health checks never trigger them.
+    """
+    _endpoints[(method, path)] = handler
+
+
+def start_trace(received_at: float = None) -> None:
+    """
+    Mark that a message was received on the current thread. Stages timed and
+    notifications queued on this thread are attributed to this message.
+
+    Args:
+        received_at (float): The time.perf_counter value the message was received
+            at, when it is handed on from another thread. Defaults to now.
+    """
+    _trace.received_at = time.perf_counter() if received_at is None else received_at
+
+
+def trace_started_at() -> float:
+    """
+    Get the time the message being handled on the current thread was received.
+
+    Returns:
+        float: A time.perf_counter value, or None if no message is being traced.
+    """
+    return getattr(_trace, "received_at", None)
+
+
+class timed:
+    """
+    Context manager that records how long a pipeline stage took.
+
+    Example:
+        with metrics.timed("render"):
+            ...
+    """
+
+    __slots__ = ("stage", "start")
+
+    def __init__(self, stage: str):
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        observe_stage(self.stage, time.perf_counter() - self.start)
+        return False
+
+
+def observe_stage(stage: str, seconds: float) -> None:
+    """
+    Record how long a pipeline stage took.
+
+    Args:
+        stage (str): The stage name, e.g. "parse" or "render".
+        seconds (float): The duration in seconds.
+    """
+    observe(STAGE_HISTOGRAM, seconds, "Latency of each stage of the alert pipeline", stage=stage)
+
+
+def observe_alert(received_at: float, kind: str) -> None:
+    """
+    Record the end-to-end latency from receiving a message to Pushover acknowledging it.
+
+    Args:
+        received_at (float): The time.perf_counter value when the message was received.
+        kind (str): The kind of notification, e.g. "user" or "admin".
+    """
+    observe(
+        ALERT_HISTOGRAM,
+        time.perf_counter() - received_at,
+        "Time from receiving a message until Pushover acknowledged the notification",
+        kind=kind
+    )
+
+
+def histogram(name: str, **labels) -> dict:
+    """
+    Get the current state of a histogram series.
+
+    Args:
+        name (str): The metric name.
+        **labels: Label values of the series.
+
+    Returns:
+        dict: The "buckets" as (upper bound, cumulative count) pairs, "sum" and
+              "count", or None if nothing has been observed.
+    """
+    key = (name, tuple(sorted(labels.items())))
+    with _lock:
+        series = _histograms.get(key)
+        if series is None:
+            return None
+        buckets, total, count = list(series[0]), series[1], series[2]
+    cumulative, running = [], 0
+    for bound, bucket_count in zip(DEFAULT_BUCKETS, buckets):
+        running += bucket_count
+        cumulative.append((bound, running))
+    cumulative.append((float("inf"), count))
+    return {"buckets": cumulative, "sum": total, "count": count}
+
+
+def quantile(name: str, q: float, **labels) -> float:
+    """
+    Estimate a quantile of a histogram series from its buckets, like Prometheus'
+    histogram_quantile does.
+
+    Args:
+        name (str): The metric name.
+        q (float): The quantile, between 0 and 1.
+        **labels: Label values of the series.
+
+    Returns:
+        float: The estimated value in seconds, or None if nothing has been observed.
+    """
+    state = histogram(name, **labels)
+    if state is None or state["count"] == 0:
+        return None
+    rank = q * state["count"]
+    lower_bound, lower_count = 0.0, 0
+    for bound, count in state["buckets"]:
+        if count >= rank:
+            if bound == float("inf"):
+                return lower_bound
+            if count == lower_count:
+                return bound
+            return lower_bound + (bound - lower_bound) * (rank - lower_count) / (count - lower_count)
+        lower_bound, lower_count = bound, count
+    return lower_bound
+
+
+def reset() -> None:
+    """
+    Remove all recorded counters and histograms.
+    """
+    with _lock:
+        _types.clear()
+        _counters.clear()
+        _histograms.clear()
+
+
+def render() -> str:
+    """
+    Render all metrics in the Prometheus text exposition format.
+
+    Returns:
+        str: The metrics.
+    """
+    families: dict = {}
+    with _lock:
+        for (name, labels), value in _counters.items():
+            families.setdefault(name, []).append(f"{name}{_labels(labels)} {_number(value)}")
+        for (name, labels), (buckets, total, count) in _histograms.items():
+            lines = families.setdefault(name, [])
+            running = 0
+            for bound, bucket_count in zip(DEFAULT_BUCKETS, buckets):
+                running += bucket_count
+                lines.append(f"{name}_bucket{_labels(labels + (('le', repr(bound)),))} {running}")
+            lines.append(f"{name}_bucket{_labels(labels + (('le', '+Inf'),))} {count}")
+            lines.append(f"{name}_sum{_labels(labels)} {_number(total)}")
+            lines.append(f"{name}_count{_labels(labels)} {count}")
+        types = dict(_types)
+
+    for collector in list(_collectors):
+        try:
+            for name, metric_type, help, labels, value in collector():
+                types.setdefault(name, (metric_type, help))
+                key = tuple(sorted(labels.items()))
+                families.setdefault(name, []).append(f"{name}{_labels(key)} {_number(value)}")
+        except Exception as e:
+            families.setdefault("fsr_metrics_collector_errors", []).append(
+                f'fsr_metrics_collector_errors{{error="{_escape(e.__class__.__name__)}"}} 1'
+            )
+
+    out = []
+    for name, lines in families.items():
+        metric_type, help = types.get(name, ("gauge", ""))
+        if help:
+            out.append(f"# HELP {name} {help}")
+        out.append(f"# TYPE {name} {metric_type}")
+        out.extend(lines)
+    return "\n".join(out) + "\n"
+
+
+def start_server(host: str, port: int) -> None:
+    """
+    Serve the metrics on http://host:port/metrics in a background thread.
+
+    Args:
+        host (str): The interface to bind to, normally 127.0.0.1.
+        port (int): The port to listen on. 0 disables the server.
+    """
+    global _server
+    if port <= 0 or _server is not None:
+        return
+    _server = ThreadingHTTPServer((host, port), _MetricsRequestHandler)
+    _server.daemon_threads = True
+    threading.Thread(target=_server.serve_forever, name="metrics-http", daemon=True).start()
+
+
+def stop_server() -> None:
+    """
+    Stop the metrics server.
+    """
+    global _server
+    if _server is not None:
+        _server.shutdown()
+        _server.server_close()
+        _server = None
+
+
+class _MetricsRequestHandler(BaseHTTPRequestHandler):
+    """Serves /metrics and the paths added with register_endpoint."""
+
+    def do_GET(self):
+        path = self.path.split("?", 1)[0]
+        if path == "/metrics":
+            self._respond(200, "text/plain; version=0.0.4; charset=utf-8", render())
+        else:
+            self._route("GET", path)
+
+    def do_POST(self):
+        self._route("POST", self.path.split("?", 1)[0])
+
+    def _route(self, method: str, path: str) -> None:
+        if (method, path) in _endpoints:
+            self._respond(*_endpoints[(method, path)]())
+        elif any(path == registered for _, registered in _endpoints):
+            self._respond(405, "text/plain; charset=utf-8", "Method not allowed\n")
+        else:
+            self._respond(404, "text/plain; charset=utf-8", "Not found\n")
+
+    def _respond(self, status: int, content_type: str, body: str) -> None:
+        data = body.encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def _labels(labels: tuple) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{_escape(value)}"' for key, value in labels) + "}"
+
+
+def _escape(value: object) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _number(value: float) -> str:
+    if isinstance(value, bool):
+        return "1" if value else "0"
+    if isinstance(value, int):
+        return str(value)
+    return repr(float(value))
@@ -1,67 +1,380 @@
 """
 Module: oAuthHandler
 Purpose: Handles OAuth token generation and caching for accessing the API.
+         Tokens are refreshed in the background before they expire, using the
+         refresh token, and cached on disk so a restart can reconnect without
+         a new password grant.
 """
 
-from decouple import config
-import requests
+import json
+import os
+import threading
+import time
+import log_writer
+import metrics
+import session_pool
+import settings
+
+MODULE_NAME = "OAuth Handler"
+
+# Seconds to wait before retrying a failed background refresh.
+REFRESH_RETRY_DELAY = 30
+
+_manager = None
+_manager_lock = threading.Lock()
 
-# Global variables to cache tokens.
-access_token = None
 
 class OAuthError(Exception):
     """Custom exception for OAuth related errors."""
     pass
 
+
+class TokenManager:
+    """
+    Keeps the access token for one FSR user valid.
+
+    The token, refresh token and expiry time are cached on disk. A background
+    thread refreshes the token ahead of its expiry, so get_token normally
+    returns without any network round trip.
+    """
+
+    def __init__(self, username: str, password: str, cache_path: str, refresh_ahead: float):
+        """
+        Args:
+            username (str): The FSR user name.
+            password (str): The FSR password.
+            cache_path (str): Path of the token cache file, or "" to disable the cache.
+            refresh_ahead (float): Seconds before expiry to refresh the token.
+        """
+        self.username = username
+        self.password = password
+        self.cache_path = cache_path
+        self.refresh_ahead = refresh_ahead
+        self.access_token = None
+        self.refresh_token = None
+        self.expires_at = 0.0
+        self.counters = {
+            "password_grants": 0,
+            "refreshes": 0,
+            "refresh_failures": 0,
+            "cache_hits": 0,
+            "blocked_calls": 0,
+            "blocked_seconds": 0.0,
+        }
+        self._lock = threading.RLock()
+        self._stop = threading.Event()
+        self._refresher: threading.Thread = None
+        self._load_cache()
+
+    def get_token(self, force_update: bool = False) -> str:
+        """
+        Retrieve a valid access token.
+
+        If the cached token is still valid and force_update is False, it is returned
+        right away. Otherwise a new token is fetched, using the refresh token if
+        there is one and a password grant if not.
+
+        Args:
+            force_update (bool): If True, forces the retrieval of a new token even if one is cached.
+
+        Returns:
+            str: A valid access token.
+
+        Raises:
+            OAuthError: If token generation fails.
+            requests.RequestException: If FSR could not be reached.
+        """
+        with self._lock:
+            if self.access_token and not force_update and not self._is_expired():
+                return self.access_token
+            start = time.perf_counter()
+            try:
+                return self._renew()
+            finally:
+                self.counters["blocked_calls"] += 1
+                self.counters["blocked_seconds"] += time.perf_counter() - start
+
+    def start_refresher(self) -> None:
+        """
+        Start the background thread that refreshes the token ahead of its expiry.
+        """
+        if self._refresher and self._refresher.is_alive():
+            return
+        self._stop.clear()
+        self._refresher = threading.Thread(target=self._refresh_loop, name="oauth-refresh", daemon=True)
+        self._refresher.start()
+
+    def stop_refresher(self) -> None:
+        """
+        Stop the background refresh thread.
+        """
+        self._stop.set()
+        if self._refresher:
+            self._refresher.join(timeout=5)
+
+    def stats(self) -> dict:
+        """
+        Get the token counters.
+
+        Returns:
+            dict: Counters for grants, refreshes, cache hits and time spent blocked
+                  waiting for a token, plus the seconds until the token expires.
+        """
+        with self._lock:
+            snapshot = dict(self.counters)
+            snapshot["expires_in"] = max(0.0, self.expires_at - time.time()) if self.access_token else 0.0
+        return snapshot
+
+    def _is_expired(self) -> bool:
+        return bool(self.expires_at) and time.time() >= self.expires_at
+
+    def _renew(self) -> str:
+        """
+        Get a new token, preferring the refresh token over a password grant.
+
+        Returns:
+            str: The new access token.
+
+        Raises:
+            OAuthError: If both the refresh and the password grant fail.
+        """
+        if self.refresh_token:
+            try:
+                token = self._request({"grant_type": "refresh_token", "refresh_token": self.refresh_token})
+                self.counters["refreshes"] += 1
+                return token
+            except OAuthError:
+                self.counters["refresh_failures"] += 1
+                self.refresh_token = None
+        token = self._request({
+            "grant_type": "password",
+            "username": self.username,
+            "password": self.password,
+        })
+        self.counters["password_grants"] += 1
+        return token
+
+    def _request(self, data: dict) -> str:
+        """
+        Make an OAuth token request and store the result.
+
+        Args:
+            data (dict): The form data for the token request.
+
+        Returns:
+            str: The new access token.
+
+        Raises:
+            OAuthError: If the token request fails or no access token is found in the response.
+            requests.RequestException: If FSR could not be reached.
+        """
+        response = session_pool.post(settings.get().fsr_token_url, data=data, timeout=10)
+
+        if response.status_code != 200:
+            # Raise a custom exception with error details.
+            raise OAuthError(f"Token request failed (status code {response.status_code}): {response.text}")
+
+        response_data = response.json()
+        access_token = response_data.get("access_token")
+        if not access_token:
+            raise OAuthError("No access token found in response body")
+
+        self.access_token = access_token
+        self.refresh_token = response_data.get("refresh_token") or self.refresh_token
+        expires_in = response_data.get("expires_in")
+        issued_at = response_data.get("created_at") or time.time()
+        self.expires_at = float(issued_at) + float(expires_in) if expires_in else 0.0
+        self._save_cache()
+        return access_token
+
+    def seconds_until_refresh(self) -> float:
+        """
+        Get the number of seconds until the token should be refreshed.
+
+        Returns:
+            float: Seconds until the refresh is due, 0 if it is due now.
+        """
+        with self._lock:
+            expires_at = self.expires_at
+        if not expires_at:
+            # The token does not expire, or we have none yet - check again later.
+            return max(self.refresh_ahead, REFRESH_RETRY_DELAY)
+        return max(0.0, expires_at - self.refresh_ahead - time.time())
+
+    def refresh(self) -> bool:
+        """
+        Renew the token now, logging the outcome instead of raising.
+
+        Returns:
+            bool: True if a new token was fetched.
+        """
+        try:
+            with self._lock:
+                self._renew()
+            _to_terminal("Access token refreshed")
+            return True
+        except Exception as e:
+            _to_terminal(f"Refreshing access token failed: {str(e)}")
+            return False
+
+    def _refresh_loop(self) -> None:
+        """
+        Refresh the token refresh_ahead seconds before it expires, until stopped.
+        """
+        while not self._stop.is_set():
+            delay = self.seconds_until_refresh()
+            if delay > 0:
+                if self._stop.wait(delay):
+                    return
+                continue
+            self.refresh()
+            # Never refresh more often than this, even if the token lifetime is short.
+            if self._stop.wait(REFRESH_RETRY_DELAY):
+                return
+
+    def _load_cache(self) -> None:
+        """
+        Load the token from the cache file if it belongs to this user and has not expired.
+        """
+        if not self.cache_path or not os.path.isfile(self.cache_path):
+            return
+        try:
+            with open(self.cache_path, encoding="utf-8") as f:
+                cached = json.load(f)
+        except (OSError, ValueError):
+            return
+        if cached.get("username") != self.username:
+            return
+        expires_at = float(cached.get("expires_at") or 0)
+        if expires_at and time.time() >= expires_at:
+            # The access token is useless, but the refresh token may still work.
+            self.refresh_token = cached.get("refresh_token")
+            return
+        self.access_token = cached.get("access_token")
+        self.refresh_token = cached.get("refresh_token")
+        self.expires_at = expires_at
+        if self.access_token:
+            self.counters["cache_hits"] += 1
+
+    def _save_cache(self) -> None:
+        """
+        Write the token to the cache file, readable only by the current user.
+        """
+        if not self.cache_path:
+            return
+        tmp_path = f"{self.cache_path}.tmp"
+        try:
+            fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump({
+                    "username": self.username,
+                    "access_token": self.access_token,
+                    "refresh_token": self.refresh_token,
+                    "expires_at": self.expires_at,
+                }, f)
+            os.replace(tmp_path, self.cache_path)
+        except OSError as e:
+            _to_terminal(f"Could not write token cache: {str(e)}")
+
+
 def get_token(force_update: bool = False) -> str:
     """
-    Retrieve a valid access token.
-    
+    Retrieve a valid access token for the configured FSR user.
+
     If a token is already cached and force_update is False, returns the cached token.
     Otherwise, generates a new token.
-    
+
     Args:
         force_update (bool): If True, forces the retrieval of a new token even if one is cached.
-    
+
     Returns:
         str: A valid access token.
-    
+
     Raises:
         OAuthError: If token generation fails.
     """
-    global access_token
-    if access_token and not force_update:
-        return access_token
-    return _generate_new_token()
+    return _get_manager().get_token(force_update)
+
 
-def _generate_new_token() -> str:
+def start_refresher() -> None:
     """
-    Generate a new access token by making an OAuth request.
-    
+    Start refreshing the token of the configured FSR user in the background.
+    """
+    _get_manager().start_refresher()
+
+
+def stop_refresher() -> None:
+    """
+    Stop refreshing the token in the background.
+    """
+    if _manager is not None:
+        _manager.stop_refresher()
+
+
+def stats() -> dict:
+    """
+    Get the token counters for the configured FSR user.
+
     Returns:
-        str: The new access token.
-    
-    Raises:
-        OAuthError: If the token request fails or no access token is found in the response.
+        dict: See TokenManager.stats.
     """
-    global access_token
+    return _get_manager().stats()
 
-    url = "https://www.fireservicerota.co.uk/oauth/token"
-    data = {
-        "grant_type": "password",
-        "username": config("FSR_USERNAME"),
-        "password": config("FSR_PASSWORD"),
-    }
 
-    response = requests.post(url, data=data)
+def _get_manager() -> TokenManager:
+    """
+    Get the token manager for the configured FSR user. A new manager is created
+    if the credentials have changed since the last call (e.g. after a reload).
 
-    if response.status_code != 200:
-        # Raise a custom exception with error details.
-        raise OAuthError(f"Token request failed (status code {response.status_code}): {response.json()}")
+    Returns:
+        TokenManager: The token manager.
+    """
+    global _manager
+    current = settings.get()
+    with _manager_lock:
+        manager = _manager
+        if manager is not None and manager.username == current.fsr_username \
+                and manager.password == current.fsr_password:
+            return manager
+        if manager is not None:
+            manager.stop_refresher()
+        _manager = TokenManager(
+            current.fsr_username,
+            current.fsr_password,
+            current.token_cache_path,
+            current.oauth_refresh_ahead
+        )
+        if manager is not None and manager._refresher is not None:
+            _manager.start_refresher()
+        return _manager
+
+
+def _collect_metrics() -> list:
+    """
+    Report the token counters to the metrics module.
+
+    Returns:
+        list: Metric samples, see metrics.register_collector.
+    """
+    if _manager is None:
+        return []
+    stats_now = _manager.stats()
+    return [
+        ("fsr_oauth_refreshes_total", "counter", "Access tokens renewed with the refresh token", {}, stats_now["refreshes"]),
+        ("fsr_oauth_password_grants_total", "counter", "Access tokens fetched with a password grant", {}, stats_now["password_grants"]),
+        ("fsr_oauth_blocked_seconds_total", "counter", "Time spent waiting for a new access token", {}, stats_now["blocked_seconds"]),
+        ("fsr_oauth_token_expires_in_seconds", "gauge", "Seconds until the access token expires", {}, stats_now["expires_in"]),
+    ]
+
+
+def _to_terminal(msg: str) -> None:
+    """
+    Log a message to the terminal using the writer module.
+
+    Args:
+        msg (str): The message to log.
+    """
+    log_writer.to_terminal(MODULE_NAME, msg)
 
-    response_data = response.json()
-    access_token = response_data.get("access_token")
-    if access_token:
-        return access_token
 
-    raise OAuthError("No access token found in response body")
+metrics.register_collector(_collect_metrics)
@@ -0,0 +1,332 @@
+"""
+Module: outbox
+Purpose: Keeps every notification on disk until Pushover has accepted it, so
+         an alert is never lost when the process dies or Pushover is down.
+         Notifications are stored in SQLite (WAL mode) by a writer thread that
+         commits everything waiting in one transaction (group commit), and the
+         pending ones are delivered again after a restart. A notification with
+         a dedupe key is only stored, and so only sent, once.
+"""
+
+import json
+import queue
+import sqlite3
+import threading
+import time
+import log_writer
+import metrics
+
+MODULE_NAME = "Outbox"
+
+# Notification states.
+STATE_PENDING = "pending"
+STATE_SENT = "sent"
+STATE_FAILED = "failed"
+STATE_EXPIRED = "expired"
+
+# Sent, failed and expired notifications are kept this long, so their dedupe
+# keys keep protecting against double pages.
+KEEP_SECONDS = 86400
+
+MAX_BATCH = 256
+# Max seconds a caller waits for its commit.
+WAIT_TIMEOUT = 5
+_STOP = object()
+
+_queue: queue.Queue = queue.Queue()
+_writer: threading.Thread = None
+_writer_lock = threading.Lock()
+_db: sqlite3.Connection = None
+_stats_lock = threading.Lock()
+_stats: dict = {"recorded": 0, "duplicates": 0, "commits": 0, "commit_seconds": 0.0}
+
+
+class OutboxError(Exception):
+    """Raised when the outbox could not store a notification."""
+    pass
+
+
+class _Waiter:
+    """Lets a caller wait until its operation has been committed."""
+
+    __slots__ = ("done", "result", "error", "on_commit")
+
+    def __init__(self, on_commit=None):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.on_commit = on_commit
+
+    def wait(self):
+        if not self.done.wait(WAIT_TIMEOUT):
+            raise OutboxError("Timed out waiting for the outbox")
+        if self.error is not None:
+            raise OutboxError(self.error)
+        return self.result
+
+
+def open_outbox(path: str, fsync: bool = False) -> None:
+    """
+    Open the outbox and start the writer thread.
+
+    Args:
+        path (str): The path of the SQLite file.
+        fsync (bool): If True, every commit is synced to disk, so notifications
+            also survive a power loss. Otherwise they survive a crash of the process.
+    """
+    global _db, _writer
+    with _writer_lock:
+        if _db is not None:
+            return
+        _db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        _db.execute("PRAGMA journal_mode=WAL")
+        _db.execute(f"PRAGMA synchronous={'FULL' if fsync else 'NORMAL'}")
+        _db.execute(
+            "CREATE TABLE IF NOT EXISTS outbox ("
+            "id INTEGER PRIMARY KEY, dedupe_key TEXT UNIQUE, created_at REAL NOT NULL, "
+            "updated_at REAL NOT NULL, dest TEXT NOT NULL, data TEXT NOT NULL, is_admin INTEGER NOT NULL, "
+            "state TEXT NOT NULL, attempts INTEGER NOT NULL DEFAULT 0)"
+        )
+        _db.execute("CREATE INDEX IF NOT EXISTS outbox_state ON outbox (state, created_at)")
+        _writer = threading.Thread(target=_writer_loop, name="outbox-writer", daemon=True)
+        _writer.start()
+
+
+def close_outbox() -> None:
+    """
+    Commit what is waiting and close the outbox.
+    """
+    global _db, _writer
+    with _writer_lock:
+        if _db is None:
+            return
+        _queue.put(_STOP)
+        _writer.join(timeout=10)
+        _db.close()
+        _db, _writer = None, None
+
+
+def is_open() -> bool:
+    """
+    Check if the outbox is in use.
+
+    Returns:
+        bool: True if the outbox is open.
+    """
+    return _db is not None
+
+
+def record(dest: str, data: dict, is_admin: bool, dedupe_key: str = None) -> int:
+    """
+    Store a notification and wait until it is committed.
+
+    Args:
+        dest (str): The URL to post to.
+        data (dict): The payload.
+        is_admin (bool): True for admin notifications.
+        dedupe_key (str): A key that identifies the notification, e.g. account,
+            incident id, kind and recipient. None to never deduplicate.
+
+    Returns:
+        int: The id of the notification, or None if a notification with the same
+             dedupe key was already stored.
+
+    Raises:
+        OutboxError: If the notification could not be stored.
+    """
+    if _db is None:
+        raise OutboxError("The outbox is not open")
+    waiter = _Waiter()
+    now = time.time()
+    _queue.put((_insert, (dedupe_key, now, now, dest, json.dumps(data), int(is_admin), STATE_PENDING), waiter))
+    outbox_id = waiter.wait()
+    with _stats_lock:
+        _stats["recorded" if outbox_id is not None else "duplicates"] += 1
+    return outbox_id
+
+
+def record_many(notifications: list, on_commit=None) -> list:
+    """
+    Store several notifications, e.g. one per recipient, as one operation and wait
+    once until they are committed together.
+
+    Args:
+        notifications (list): Tuples of (dest, data, is_admin, dedupe_key), see record.
+        on_commit: Called on the writer thread with the ids once they are committed,
+            before any caller of pending can see them, e.g. to claim them for delivery.
+
+    Returns:
+        list: The id of every notification, in order, or None for the ones whose
+              dedupe key was already stored.
+
+    Raises:
+        OutboxError: If the notifications could not be stored.
+    """
+    if _db is None:
+        raise OutboxError("The outbox is not open")
+    if not notifications:
+        return []
+    waiter = _Waiter(on_commit)
+    now = time.time()
+    rows = tuple(
+        (dedupe_key, now, now, dest, json.dumps(data), int(is_admin), STATE_PENDING)
+        for dest, data, is_admin, dedupe_key in notifications
+    )
+    _queue.put((_insert_many, rows, waiter))
+    outbox_ids = waiter.wait() or [None] * len(rows)
+    recorded = sum(1 for outbox_id in outbox_ids if outbox_id is not None)
+    with _stats_lock:
+        _stats["recorded"] += recorded
+        _stats["duplicates"] += len(rows) - recorded
+    return outbox_ids
+
+
+def mark(outbox_id: int, state: str, attempts: int) -> None:
+    """
+    Update the state of a notification. Does not wait for the commit.
+
+    Args:
+        outbox_id (int): The id of the notification.
+        state (str): The new state.
+        attempts (int): The number of delivery attempts so far.
+    """
+    if _db is None:
+        return
+    _queue.put((_update, (state, attempts, time.time(), outbox_id), None))
+
+
+def pending(max_age: float) -> list:
+    """
+    Get the notifications that have not been delivered yet, oldest first.
+    Pending notifications older than max_age are marked expired instead.
+
+    Args:
+        max_age (float): Max age in seconds of a notification worth sending.
+
+    Returns:
+        list: Tuples of (id, dest, data, is_admin, created_at).
+
+    Raises:
+        OutboxError: If the outbox could not be read.
+    """
+    if _db is None:
+        raise OutboxError("The outbox is not open")
+    waiter = _Waiter()
+    _queue.put((_pending, (time.time() - max_age,), waiter))
+    return waiter.wait()
+
+
+def stats() -> dict:
+    """
+    Get the outbox counters.
+
+    Returns:
+        dict: Counters for notifications recorded, duplicates skipped, commits and
+              the time spent committing.
+    """
+    with _stats_lock:
+        return dict(_stats)
+
+
+def _writer_loop() -> None:
+    """
+    Run everything waiting on the queue in one transaction, then wake the callers.
+    """
+    last_prune = 0.0
+    while True:
+        batch = [_queue.get()]
+        while len(batch) < MAX_BATCH:
+            try:
+                batch.append(_queue.get_nowait())
+            except queue.Empty:
+                break
+
+        stop = _STOP in batch
+        operations = [operation for operation in batch if operation is not _STOP]
+        start = time.perf_counter()
+        error = None
+        try:
+            _db.execute("BEGIN")
+            results = [operation(*params) for operation, params, waiter in operations]
+            if time.monotonic() - last_prune > 3600:
+                _db.execute(
+                    "DELETE FROM outbox WHERE state != ? AND updated_at < ?",
+                    (STATE_PENDING, time.time() - KEEP_SECONDS)
+                )
+                last_prune = time.monotonic()
+            _db.execute("COMMIT")
+        except Exception as e:
+            error = str(e)
+            log_writer.to_error(MODULE_NAME, "Write to the outbox", e, len(operations))
+            try:
+                _db.execute("ROLLBACK")
+            except sqlite3.Error:
+                pass
+            results = [None] * len(operations)
+        seconds = time.perf_counter() - start
+        with _stats_lock:
+            _stats["commits"] += 1
+            _stats["commit_seconds"] += seconds
+        metrics.observe("fsr_outbox_commit_seconds", seconds, "Time to commit a batch to the outbox")
+
+        if error is None:
+            # Before any waiter wakes, so a pending read in the same batch can not
+            # hand out rows their callers are about to deliver.
+            for (operation, params, waiter), result in zip(operations, results):
+                if waiter is not None and waiter.on_commit is not None:
+                    try:
+                        waiter.on_commit(result)
+                    except Exception as e:
+                        log_writer.to_error(MODULE_NAME, "Run a commit callback", e, "")
+        for (operation, params, waiter), result in zip(operations, results):
+            if waiter is not None:
+                waiter.result, waiter.error = result, error
+                waiter.done.set()
+        if stop:
+            return
+
+
+def _insert(*params) -> int:
+    cursor = _db.execute(
+        "INSERT OR IGNORE INTO outbox (dedupe_key, created_at, updated_at, dest, data, is_admin, state) "
+        "VALUES (?, ?, ?, ?, ?, ?, ?)",
+        params
+    )
+    return cursor.lastrowid if cursor.rowcount else None
+
+
+def _insert_many(*rows) -> list:
+    return [_insert(*row) for row in rows]
+
+
+def _update(*params) -> None:
+    _db.execute("UPDATE outbox SET state = ?, attempts = attempts + ?, updated_at = ? WHERE id = ?", params)
+
+
+def _pending(cutoff: float) -> list:
+    _db.execute(
+        "UPDATE outbox SET state = ?, updated_at = ? WHERE state = ? AND created_at < ?",
+        (STATE_EXPIRED, time.time(), STATE_PENDING, cutoff)
+    )
+    rows = _db.execute(
+        "SELECT id, dest, data, is_admin, created_at FROM outbox WHERE state = ? ORDER BY id", (STATE_PENDING,)
+    ).fetchall()
+    return [(row[0], row[1], json.loads(row[2]), bool(row[3]), row[4]) for row in rows]
+
+
+def _collect_metrics() -> list:
+    """
+    Report the outbox counters to the metrics module.
+
+    Returns:
+        list: Metric samples, see metrics.register_collector.
+    """
+    stats_now = stats()
+    help = "Notifications stored in the outbox by result"
+    return [
+        ("fsr_outbox_notifications_total", "counter", help, {"result": "recorded"}, stats_now["recorded"]),
+        ("fsr_outbox_notifications_total", "counter", help, {"result": "duplicate"}, stats_now["duplicates"]),
+    ]
+
+
+metrics.register_collector(_collect_metrics)
@@ -0,0 +1,408 @@
+"""
+Module: profiler
+Purpose: Looks inside the running process without restarting it. Sends of
+         SIGUSR1 (or a POST to /profile/cpu on the metrics server, if
+         PROFILE_ENDPOINTS is enabled) sample the
+         stacks of the threads that are in one of PROFILE_FUNCTIONS for
+         PROFILE_DURATION seconds, and write them to PROFILE_PATH as a pstats
+         file and as collapsed stacks for flame graphs. SIGUSR2 (or
+         /profile/memory) takes a tracemalloc snapshot and writes what grew
+         since the previous one. Nothing runs, and nothing is traced, until the
+         first trigger, so there is no overhead while no one is looking.
+"""
+
+import marshal
+import os
+import signal
+import sys
+import threading
+import time
+import tracemalloc
+import log_writer
+import metrics
+import settings
+
+MODULE_NAME = "Profiler"
+# Number of lines and tracebacks in a memory report.
+MEMORY_TOP = 25
+MEMORY_TRACEBACKS = 5
+
+_cpu_lock = threading.Lock()
+_cpu_thread: threading.Thread = None
+_cpu_stop = threading.Event()
+_memory_lock = threading.Lock()
+_memory_previous: tracemalloc.Snapshot = None
+_counters: dict = {"cpu_profiles": 0, "memory_snapshots": 0, "samples": 0}
+
+
+class ProfilerError(Exception):
+    """Raised when a profile can not be taken, e.g. because one is already running."""
+    pass
+
+
+class Sampler:
+    """
+    Samples the stacks of the other threads at a fixed interval.
+
+    Stacks are kept as tuples of code objects from the outermost frame in, and
+    counted, so a sample costs a walk of every stack and a dict update.
+    """
+
+    def __init__(self, focus: tuple, interval: float):
+        """
+        Args:
+            focus (tuple): Function names, only stacks with one of them are kept.
+                Empty to keep every stack.
+            interval (float): Seconds between samples.
+        """
+        self.focus = frozenset(focus)
+        self.interval = interval
+        self.stacks: dict = {}
+        self.ticks = 0
+        self.samples = 0
+        self.started_at = 0.0
+        self.seconds = 0.0
+        self._thread_names: dict = {}
+
+    def run(self, duration: float, stop: threading.Event) -> None:
+        """
+        Sample until the duration has passed or stop is set.
+
+        Args:
+            duration (float): Seconds to sample.
+            stop (threading.Event): Ends sampling early when set.
+        """
+        own = threading.get_ident()
+        self.started_at = time.time()
+        start = time.perf_counter()
+        deadline = start + duration
+        next_tick = start
+        while not stop.is_set():
+            now = time.perf_counter()
+            if now >= deadline:
+                break
+            self._sample(own)
+            next_tick += self.interval
+            if next_tick < now:
+                # Behind, e.g. the GIL was busy; skip the missed ticks.
+                next_tick = now + self.interval
+            stop.wait(max(0.0, next_tick - time.perf_counter()))
+        self.seconds = time.perf_counter() - start
+
+    def _sample(self, own: int) -> None:
+        self.ticks += 1
+        for ident, frame in sys._current_frames().items():
+            if ident == own:
+                continue
+            codes = []
+            while frame is not None:
+                codes.append(frame.f_code)
+                frame = frame.f_back
+            if self.focus and not any(code.co_name in self.focus for code in codes):
+                continue
+            codes.reverse()
+            key = (self._thread_name(ident), tuple(codes))
+            self.stacks[key] = self.stacks.get(key, 0) + 1
+            self.samples += 1
+
+    def _thread_name(self, ident: int) -> str:
+        name = self._thread_names.get(ident)
+        if name is None:
+            self._thread_names = {thread.ident: thread.name for thread in threading.enumerate()}
+            name = self._thread_names.get(ident, f"thread-{ident}")
+        return name
+
+    def write_collapsed(self, path: str) -> None:
+        """
+        Write the stacks in the collapsed format of flamegraph.pl and speedscope:
+        one line per stack, the thread and the frames separated by semicolons,
+        then the number of samples.
+
+        Args:
+            path (str): The file to write.
+        """
+        with open(path, "w", encoding="utf-8") as f:
+            for (thread_name, codes), count in sorted(self.stacks.items(), key=lambda item: -item[1]):
+                names = [thread_name.replace(" ", "_").replace(";", ":")] + [_frame_name(code) for code in codes]
+                f.write(f"{';'.join(names)} {count}\n")
+
+    def write_pstats(self, path: str) -> None:
+        """
+        Write the stacks as a pstats file, readable with pstats.Stats, snakeviz
+        or gprof2dot. Times are samples times the measured sampling interval, and
+        call counts are numbers of samples, not calls.
+
+        Args:
+            path (str): The file to write.
+        """
+        per_sample = self.seconds / self.ticks if self.ticks else self.interval
+        stats: dict = {}
+        for (_, codes), count in self.stacks.items():
+            seconds = count * per_sample
+            seen = set()
+            for depth, code in enumerate(codes):
+                key = _function_key(code)
+                entry = stats.setdefault(key, [0, 0, 0.0, 0.0, {}])
+                if key not in seen:
+                    # Count a recursive function once per sample in its cumulative time.
+                    seen.add(key)
+                    entry[0] += count
+                    entry[1] += count
+                    entry[3] += seconds
+                if depth == len(codes) - 1:
+                    entry[2] += seconds
+                if depth:
+                    caller = _function_key(codes[depth - 1])
+                    calls = entry[4].get(caller, (0, 0, 0.0, 0.0))
+                    own = seconds if depth == len(codes) - 1 else 0.0
+                    entry[4][caller] = (calls[0] + count, calls[1] + count, calls[2] + own, calls[3] + seconds)
+        with open(path, "wb") as f:
+            marshal.dump({key: tuple(entry) for key, entry in stats.items()}, f)
+
+
+def install_signal_handlers() -> None:
+    """
+    Start a CPU profile on SIGUSR1 and take a memory snapshot on SIGUSR2. Does
+    nothing on platforms without them (e.g. Windows). Must be called from the
+    main thread.
+    """
+    if hasattr(signal, "SIGUSR1"):
+        signal.signal(signal.SIGUSR1, lambda signum, frame: _in_background(start_cpu))
+    if hasattr(signal, "SIGUSR2"):
+        signal.signal(signal.SIGUSR2, lambda signum, frame: _in_background(memory_snapshot))
+
+
+def start_cpu(duration: float = None) -> str:
+    """
+    Start sampling the threads in PROFILE_FUNCTIONS in the background.
+
+    Args:
+        duration (float): Seconds to sample. Defaults to PROFILE_DURATION.
+
+    Returns:
+        str: The path the files are written to, without the extension.
+
+    Raises:
+        ProfilerError: If a CPU profile is already running.
+    """
+    global _cpu_thread
+    current = settings.get()
+    duration = current.profile_duration if duration is None else duration
+    with _cpu_lock:
+        if _cpu_thread is not None and _cpu_thread.is_alive():
+            raise ProfilerError("A CPU profile is already running")
+        base = _profile_path(current, "cpu")
+        sampler = Sampler(current.profile_functions, current.profile_sample_interval)
+        _cpu_stop.clear()
+        _cpu_thread = threading.Thread(target=_run_cpu, args=(sampler, duration, base), name="profiler", daemon=True)
+        _cpu_thread.start()
+    _to_terminal(f"Sampling {', '.join(current.profile_functions) or 'all threads'} for {duration:.0f} s "
+                 f"every {current.profile_sample_interval * 1000:.0f} ms")
+    return base
+
+
+def memory_snapshot() -> str:
+    """
+    Take a tracemalloc snapshot and write what grew since the previous one. The
+    first call starts tracemalloc, so it only sees memory allocated from then on.
+
+    Returns:
+        str: The path of the report.
+    """
+    global _memory_previous
+    current = settings.get()
+    with _memory_lock:
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(current.profile_tracemalloc_frames)
+            _memory_previous = None
+        snapshot = tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+        ))
+        base = _profile_path(current, "memory")
+        snapshot.dump(base + ".tracemalloc")
+        with open(base + ".txt", "w", encoding="utf-8") as f:
+            _write_memory_report(f, snapshot, _memory_previous)
+        _memory_previous = snapshot
+        _counters["memory_snapshots"] += 1
+    traced, peak = tracemalloc.get_traced_memory()
+    _to_terminal(f"Memory snapshot written to {base}.txt ({traced / 1048576:.1f} MiB traced, "
+                 f"peak {peak / 1048576:.1f} MiB)")
+    return base + ".txt"
+
+
+def stop_memory() -> None:
+    """
+    Stop tracemalloc and forget the previous snapshot.
+    """
+    global _memory_previous
+    with _memory_lock:
+        if tracemalloc.is_tracing():
+            tracemalloc.stop()
+            _to_terminal("Memory tracing stopped")
+        _memory_previous = None
+
+
+def stop(timeout: float = 5.0) -> None:
+    """
+    End a running CPU profile, writing what was sampled so far, and stop tracemalloc.
+
+    Args:
+        timeout (float): Maximum number of seconds to wait for the profile to be written.
+    """
+    global _cpu_thread
+    _cpu_stop.set()
+    if _cpu_thread is not None:
+        _cpu_thread.join(timeout=timeout)
+        _cpu_thread = None
+    stop_memory()
+
+
+def _run_cpu(sampler: Sampler, duration: float, base: str) -> None:
+    try:
+        sampler.run(duration, _cpu_stop)
+        sampler.write_pstats(base + ".prof")
+        sampler.write_collapsed(base + ".collapsed")
+        _counters["cpu_profiles"] += 1
+        _counters["samples"] += sampler.samples
+        _to_terminal(f"CPU profile written to {base}.prof and {base}.collapsed "
+                     f"({sampler.samples} samples in {sampler.ticks} ticks)")
+    except Exception as e:
+        _to_error("Write CPU profile", e, base)
+
+
+def _write_memory_report(f, snapshot: tracemalloc.Snapshot, previous: tracemalloc.Snapshot) -> None:
+    """
+    Write the biggest allocations, or the biggest growth since the previous snapshot.
+    """
+    traced, peak = tracemalloc.get_traced_memory()
+    f.write(f"Traced {traced / 1048576:.1f} MiB, peak {peak / 1048576:.1f} MiB, "
+            f"{tracemalloc.get_traceback_limit()} frames per allocation\n")
+    if previous is None:
+        f.write("\nFirst snapshot since tracing started, take another to see what grows.\n"
+                f"\nTop {MEMORY_TOP} lines by size:\n")
+        for stat in snapshot.statistics("lineno")[:MEMORY_TOP]:
+            f.write(f"{stat}\n")
+        return
+    f.write(f"\nTop {MEMORY_TOP} lines by growth since the previous snapshot:\n")
+    for stat in snapshot.compare_to(previous, "lineno")[:MEMORY_TOP]:
+        f.write(f"{stat}\n")
+    f.write(f"\nTop {MEMORY_TRACEBACKS} tracebacks by growth:\n")
+    for stat in snapshot.compare_to(previous, "traceback")[:MEMORY_TRACEBACKS]:
+        f.write(f"\n{stat.size_diff / 1024:+.1f} KiB, {stat.count_diff:+d} blocks\n")
+        for line in stat.traceback.format():
+            f.write(f"{line}\n")
+
+
+def _profile_path(current: settings.Settings, kind: str) -> str:
+    os.makedirs(current.profile_path, exist_ok=True)
+    return os.path.join(current.profile_path, f"{kind}-{time.strftime('%Y%m%d-%H%M%S')}")
+
+
+def _function_key(code) -> tuple:
+    return code.co_filename, code.co_firstlineno, code.co_name
+
+
+def _frame_name(code) -> str:
+    module = os.path.splitext(os.path.basename(code.co_filename))[0]
+    return f"{module}.{getattr(code, 'co_qualname', code.co_name)}"
+
+
+def _in_background(action) -> None:
+    """
+    Run an action triggered by a signal on its own thread, so the main thread is
+    not held up writing files.
+    """
+    def run():
+        try:
+            action()
+        except ProfilerError as e:
+            _to_terminal(str(e))
+        except Exception as e:
+            _to_error("Profile on signal", e, "")
+
+    threading.Thread(target=run, name="profiler-signal", daemon=True).start()
+
+
+def _endpoints_disabled() -> tuple:
+    """
+    The response of the profile endpoints while PROFILE_ENDPOINTS is off, None while it is on.
+    """
+    if settings.get().profile_endpoints:
+        return None
+    return 403, "text/plain; charset=utf-8", "Profiling over HTTP is disabled, set PROFILE_ENDPOINTS=1\n"
+
+
+def _cpu_endpoint() -> tuple:
+    """
+    Start a CPU profile from the metrics server.
+    """
+    disabled = _endpoints_disabled()
+    if disabled:
+        return disabled
+    try:
+        base = start_cpu()
+    except ProfilerError as e:
+        return 409, "text/plain; charset=utf-8", f"{e}\n"
+    return 202, "text/plain; charset=utf-8", f"Profiling, results in {base}.prof and {base}.collapsed\n"
+
+
+def _memory_endpoint() -> tuple:
+    """
+    Take a memory snapshot from the metrics server.
+    """
+    disabled = _endpoints_disabled()
+    if disabled:
+        return disabled
+    return 200, "text/plain; charset=utf-8", f"Written to {memory_snapshot()}\n"
+
+
+def _memory_stop_endpoint() -> tuple:
+    """
+    Stop tracemalloc from the metrics server. Always allowed, it only lowers the overhead.
+    """
+    stop_memory()
+    return 200, "text/plain; charset=utf-8", "Memory tracing stopped\n"
+
+
+def _to_terminal(msg: str) -> None:
+    """
+    Log a message to the terminal using the writer module.
+
+    Args:
+        msg (str): The message to log.
+    """
+    log_writer.to_terminal(MODULE_NAME, msg)
+
+
+def _to_error(tried_to: str, err_msg: object, obj: object) -> None:
+    """
+    Log an error using the writer module.
+
+    Args:
+        tried_to (str): Description of the operation attempted.
+        err_msg (object): The exception, or an error message.
+        obj (object): The context or data related to the error.
+    """
+    log_writer.to_error(MODULE_NAME, tried_to, err_msg, obj)
+
+
+def _collect_metrics() -> list:
+    """
+    Report the profiler counters to the metrics module.
+
+    Returns:
+        list: Metric samples, see metrics.register_collector.
+    """
+    return [
+        ("fsr_profiles_total", "counter", "Profiles written by kind", {"kind": "cpu"}, _counters["cpu_profiles"]),
+        ("fsr_profiles_total", "counter", "Profiles written by kind", {"kind": "memory"}, _counters["memory_snapshots"]),
+        ("fsr_profile_samples_total", "counter", "Stacks sampled by CPU profiles", {}, _counters["samples"]),
+        ("fsr_memory_tracing", "gauge", "1 while tracemalloc is tracing", {}, int(tracemalloc.is_tracing())),
+    ]
+
+
+metrics.register_collector(_collect_metrics)
+metrics.register_endpoint("/profile/cpu", _cpu_endpoint, method="POST")
+metrics.register_endpoint("/profile/memory", _memory_endpoint, method="POST")
+metrics.register_endpoint("/profile/memory/stop", _memory_stop_endpoint, method="POST")
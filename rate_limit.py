@@ -0,0 +1,140 @@
+"""
+Module: rate_limit
+Purpose: A thread-safe token bucket used to pace outgoing requests, so bursts
+         of notifications stay within the limits of the receiving service.
+"""
+
+import threading
+import time
+
+
+class TokenBucket:
+    """
+    Allows bursts of up to capacity requests, refilled at rate requests per second.
+
+    The rate can be changed while in use, e.g. when the receiving service reports
+    how much of its quota is left, and the bucket can be held empty for a while
+    when the service asks to back off.
+    """
+
+    def __init__(self, rate: float, capacity: int):
+        """
+        Args:
+            rate (float): Tokens added per second.
+            capacity (int): Maximum number of tokens, i.e. the largest burst.
+        """
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = float(capacity)
+        self._updated = time.monotonic()
+        self._held_until = 0.0
+        self._lock = threading.Lock()
+        self.counters = {"acquired": 0, "waits": 0, "wait_seconds": 0.0}
+
+    def configure(self, rate: float, capacity: int) -> None:
+        """
+        Change the refill rate and the capacity.
+
+        Args:
+            rate (float): Tokens added per second.
+            capacity (int): Maximum number of tokens.
+        """
+        with self._lock:
+            self._refill(time.monotonic())
+            self.rate = rate
+            self.capacity = capacity
+            self._tokens = min(self._tokens, float(capacity))
+
+    def hold(self, seconds: float) -> None:
+        """
+        Empty the bucket and hand out no tokens for a number of seconds.
+
+        Args:
+            seconds (float): How long to hold.
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = 0.0
+            self._updated = now
+            self._held_until = max(self._held_until, now + seconds)
+
+    def try_acquire(self) -> bool:
+        """
+        Take a token if one is available right now.
+
+        Returns:
+            bool: True if a token was taken.
+        """
+        return self._wait_time() == 0.0
+
+    def acquire(self, stop: threading.Event = None, timeout: float = None) -> bool:
+        """
+        Take a token, waiting until one is available.
+
+        Args:
+            stop (threading.Event): If set while waiting, give up.
+            timeout (float): Maximum seconds to wait, None to wait as long as needed.
+
+        Returns:
+            bool: True if a token was taken, False if stop was set or the timeout passed.
+        """
+        start = time.monotonic()
+        waited = False
+        while True:
+            wait = self._wait_time()
+            if wait == 0.0:
+                if waited:
+                    with self._lock:
+                        self.counters["waits"] += 1
+                        self.counters["wait_seconds"] += time.monotonic() - start
+                return True
+            waited = True
+            if timeout is not None:
+                remaining = timeout - (time.monotonic() - start)
+                if remaining <= 0:
+                    return False
+                wait = min(wait, remaining)
+            if stop is not None:
+                if stop.wait(wait):
+                    return False
+            else:
+                time.sleep(wait)
+
+    def stats(self) -> dict:
+        """
+        Get the bucket counters.
+
+        Returns:
+            dict: Counters for tokens taken, waits and seconds spent waiting, plus
+                  the current rate and number of tokens.
+        """
+        with self._lock:
+            self._refill(time.monotonic())
+            snapshot = dict(self.counters)
+            snapshot["rate"] = self.rate
+            snapshot["tokens"] = self._tokens
+        return snapshot
+
+    def _wait_time(self) -> float:
+        """
+        Take a token if possible.
+
+        Returns:
+            float: 0.0 if a token was taken, otherwise the seconds until one may be available.
+        """
+        with self._lock:
+            now = time.monotonic()
+            if now < self._held_until:
+                return self._held_until - now
+            self._refill(now)
+            if self._tokens >= 1.0:
+                self._tokens -= 1.0
+                self.counters["acquired"] += 1
+                return 0.0
+            return (1.0 - self._tokens) / self.rate
+
+    def _refill(self, now: float) -> None:
+        start = max(self._updated, self._held_until) if self._held_until <= now else now
+        if now > start:
+            self._tokens = min(float(self.capacity), self._tokens + (now - start) * self.rate)
+        self._updated = now
@@ -0,0 +1,400 @@
+"""
+Module: receipts
+Purpose: Follows up on Pushover emergency-priority notifications (priority 2).
+         Pushover returns a receipt for every emergency notification, and keeps
+         alerting the recipient until it is acknowledged or expires. The
+         receipts are polled by one background thread over the shared HTTP
+         session, at most PUSHOVER_RECEIPT_POLL_BATCH per
+         PUSHOVER_RECEIPT_POLL_INTERVAL, so the polling cost stays the same no
+         matter how many receipts are outstanding. A page that is not
+         acknowledged within PUSHOVER_ESCALATION_DEADLINE seconds is sent to
+         PUSHOVER_ESCALATION_USER_KEY, after one last poll to make sure it was
+         not acknowledged in the meantime. Deadlines are kept apart from the
+         polls and are not capped by the batch, so an escalation is never held
+         up by routine polls of other pages.
+         Receipts are kept in memory only and are lost on a restart: Pushover
+         keeps alerting the recipients, but those pages are not escalated.
+"""
+
+import heapq
+import itertools
+import threading
+import time
+import requests
+import log_writer
+import metrics
+import request_handler
+import session_pool
+import settings
+
+MODULE_NAME = "Receipts"
+RECEIPT_ENDPOINT = "https://api.pushover.net/1/receipts/{receipt}.json"
+ACKNOWLEDGE_HISTOGRAM = "fsr_page_acknowledge_seconds"
+
+# Results of a receipt.
+RESULT_ACKNOWLEDGED = "acknowledged"
+RESULT_ESCALATED = "escalated"
+RESULT_EXPIRED = "expired"
+RESULT_LOST = "lost"
+
+_lock = threading.Lock()
+_stop = threading.Event()
+# Set when a receipt with a deadline is tracked, so the thread picks up its deadline.
+_wake = threading.Event()
+_thread: threading.Thread = None
+# Receipts by next poll time: (next_poll, sequence, Receipt).
+_due: list = []
+# Receipts that escalate, by deadline: (deadline, sequence, Receipt).
+_deadlines: list = []
+# Receipts still outstanding. Finished receipts are left in the heaps and skipped.
+_outstanding: dict = {}
+_sequence = itertools.count()
+_counters: dict = {"tracked": 0, "polls": 0, "poll_failures": 0,
+                   RESULT_ACKNOWLEDGED: 0, RESULT_ESCALATED: 0, RESULT_EXPIRED: 0, RESULT_LOST: 0}
+
+
+class Receipt:
+    """An emergency notification waiting to be acknowledged."""
+
+    __slots__ = ("receipt", "token", "user", "message", "sent_at", "deadline", "expires_at", "polls", "finished")
+
+    def __init__(self, receipt: str, data: dict, deadline: float, sent_at: float):
+        """
+        Args:
+            receipt (str): The receipt Pushover returned.
+            data (dict): The notification as it was posted to Pushover.
+            deadline (float): Epoch time to escalate at if not acknowledged, None to never escalate.
+            sent_at (float): Epoch time Pushover accepted the notification.
+        """
+        self.receipt = receipt
+        self.token = data.get("token")
+        self.user = data.get("user")
+        self.message = data.get("message")
+        self.sent_at = sent_at
+        self.deadline = deadline
+        self.expires_at = sent_at + float(data.get("expire") or 0)
+        self.polls = 0
+        self.finished = False
+
+
+def track(receipt: str, data: dict) -> None:
+    """
+    Follow up on an emergency notification Pushover accepted. Called by request_handler.
+
+    Args:
+        receipt (str): The receipt Pushover returned.
+        data (dict): The notification as it was posted to Pushover.
+    """
+    current = settings.get()
+    now = time.time()
+    escalate_to = current.pushover_escalation_user_key
+    escalates = bool(escalate_to) and data.get("user") not in (escalate_to, current.pushover_user_key_admin)
+    entry = Receipt(receipt, data, now + current.pushover_escalation_deadline if escalates else None, now)
+    with _lock:
+        _counters["tracked"] += 1
+        _outstanding[receipt] = entry
+        if entry.deadline is not None:
+            heapq.heappush(_deadlines, (entry.deadline, next(_sequence), entry))
+    _schedule(entry, now + current.pushover_receipt_poll_interval)
+    _ensure_thread()
+    if entry.deadline is not None:
+        _wake.set()
+
+
+def stop(timeout: float = 5.0) -> None:
+    """
+    Stop polling. Receipts still outstanding are forgotten, Pushover keeps alerting
+    their recipients until they are acknowledged or expire.
+
+    Args:
+        timeout (float): Maximum number of seconds to wait for the thread.
+    """
+    global _thread
+    _stop.set()
+    _wake.set()
+    if _thread is not None:
+        _thread.join(timeout=timeout)
+        _thread = None
+    with _lock:
+        _due.clear()
+        _deadlines.clear()
+        _outstanding.clear()
+
+
+def stats() -> dict:
+    """
+    Get the receipt counters.
+
+    Returns:
+        dict: Counters for receipts tracked, polls made and failed, and receipts by
+              result, plus the number of receipts outstanding.
+    """
+    with _lock:
+        snapshot = dict(_counters)
+        snapshot["outstanding"] = len(_outstanding)
+    return snapshot
+
+
+def poll_due(now: float = None) -> int:
+    """
+    Escalate every receipt whose deadline has passed, then poll the receipts that
+    are due, at most PUSHOVER_RECEIPT_POLL_BATCH of them, the longest waiting first.
+    Receipts that are still due afterwards wait for the next round.
+
+    Args:
+        now (float): The epoch time. Defaults to now.
+
+    Returns:
+        int: The number of receipts polled.
+    """
+    current = settings.get()
+    now = time.time() if now is None else now
+    escalate_due(now)
+    batch = []
+    with _lock:
+        while _due and _due[0][0] <= now and len(batch) < current.pushover_receipt_poll_batch:
+            entry = heapq.heappop(_due)[2]
+            if not entry.finished:
+                batch.append(entry)
+    for entry in batch:
+        _poll(entry, current)
+    return len(batch)
+
+
+def escalate_due(now: float = None) -> int:
+    """
+    Escalate every receipt whose deadline has passed, however many there are.
+    Every overdue receipt is polled once more first, outside the batch, so a page
+    acknowledged since its last poll is not escalated. Deadlines are rare next to
+    the routine polls, so this does not change the cost per round. A receipt that
+    can not be polled is escalated.
+
+    Args:
+        now (float): The epoch time. Defaults to now.
+
+    Returns:
+        int: The number of receipts escalated.
+    """
+    current = settings.get()
+    now = time.time() if now is None else now
+    overdue = []
+    with _lock:
+        while _deadlines and _deadlines[0][0] <= now:
+            entry = heapq.heappop(_deadlines)[2]
+            if not entry.finished:
+                overdue.append(entry)
+    escalated = 0
+    for entry in overdue:
+        status = _fetch(entry)
+        if status is not None and status.get("status") == 1 and status.get("acknowledged"):
+            _acknowledge(entry, status)
+            continue
+        _escalate(entry, current)
+        escalated += 1
+    return escalated
+
+
+def _fetch(entry: Receipt) -> dict:
+    """
+    Get the status of one receipt from Pushover.
+
+    Returns:
+        dict: The status, or None if Pushover could not be reached.
+    """
+    entry.polls += 1
+    try:
+        response = session_pool.get(
+            RECEIPT_ENDPOINT.format(receipt=entry.receipt), params={"token": entry.token}, timeout=10
+        )
+        if response.status_code == 429 or response.status_code >= 500:
+            response.raise_for_status()
+        status = response.json()
+    except (requests.RequestException, ValueError) as e:
+        with _lock:
+            _counters["polls"] += 1
+            _counters["poll_failures"] += 1
+        _to_terminal(f"Could not poll receipt for {_label(entry)}: {str(e)}")
+        return None
+    with _lock:
+        _counters["polls"] += 1
+    return status
+
+
+def _poll(entry: Receipt, current) -> None:
+    """
+    Poll one receipt and act on it: forget it when it is acknowledged or expired,
+    or schedule the next poll.
+    """
+    status = _fetch(entry)
+    if status is None:
+        _reschedule(entry, current)
+    elif status.get("status") != 1:
+        # Unknown receipt, or an app token Pushover no longer accepts.
+        _to_terminal(f"Pushover does not know the receipt for {_label(entry)}: {status.get('errors')}")
+        _finish(entry, RESULT_LOST)
+    elif status.get("acknowledged"):
+        _acknowledge(entry, status)
+    elif status.get("expired"):
+        _to_terminal(f"Page to {_label(entry)} expired without being acknowledged")
+        _finish(entry, RESULT_EXPIRED)
+    else:
+        _reschedule(entry, current)
+
+
+def _acknowledge(entry: Receipt, status: dict) -> None:
+    """
+    Forget an acknowledged receipt and record how long it took.
+    """
+    acknowledged_at = float(status.get("acknowledged_at") or time.time())
+    seconds = max(0.0, acknowledged_at - entry.sent_at)
+    metrics.observe(ACKNOWLEDGE_HISTOGRAM, seconds, "Time from sending a page until it was acknowledged")
+    _to_terminal(f"Page to {_label(entry)} acknowledged after {_duration(seconds)}")
+    _finish(entry, RESULT_ACKNOWLEDGED)
+
+
+def _escalate(entry: Receipt, current) -> None:
+    """
+    Send an unacknowledged page to the escalation recipient, at emergency priority.
+    """
+    waited = _duration(time.time() - entry.sent_at)
+    _to_terminal(f"Page to {_label(entry)} not acknowledged after {waited} - escalating")
+    request_handler.push_to_pushover(
+        f"Not acknowledged by {_label(entry)} within {waited}\n{entry.message}",
+        request_handler.PRIORITY_EMERGENCY,
+        (current.pushover_escalation_user_key,),
+        dedupe_key=f"escalation/{entry.receipt}"
+    )
+    _finish(entry, RESULT_ESCALATED)
+
+
+def _reschedule(entry: Receipt, current) -> None:
+    """
+    Schedule the next poll of a receipt.
+    """
+    now = time.time()
+    if entry.expires_at and now >= entry.expires_at + current.pushover_receipt_poll_interval:
+        # Pushover should have reported it as expired by now.
+        _finish(entry, RESULT_EXPIRED)
+        return
+    _schedule(entry, now + current.pushover_receipt_poll_interval)
+
+
+def _schedule(entry: Receipt, next_poll: float) -> None:
+    with _lock:
+        heapq.heappush(_due, (next_poll, next(_sequence), entry))
+
+
+def _finish(entry: Receipt, result: str) -> None:
+    with _lock:
+        entry.finished = True
+        _outstanding.pop(entry.receipt, None)
+        _counters[result] += 1
+
+
+def _ensure_thread() -> None:
+    """
+    Start the polling thread if it is not running.
+    """
+    global _thread
+    if _thread is not None and _thread.is_alive():
+        return
+    with _lock:
+        if _thread is not None and _thread.is_alive():
+            return
+        _stop.clear()
+        _thread = threading.Thread(target=_poll_loop, name="pushover-receipts", daemon=True)
+        _thread.start()
+
+
+def _poll_loop() -> None:
+    """
+    Poll a batch of due receipts every PUSHOVER_RECEIPT_POLL_INTERVAL seconds, or
+    sooner when nothing is waiting and the next receipt is due before that. In
+    between, wake up at every escalation deadline to escalate without polling.
+    """
+    next_round = 0.0
+    while not _stop.is_set():
+        now = time.time()
+        try:
+            if now >= next_round:
+                poll_due(now)
+                next_round = now + _round_wait(now)
+            else:
+                escalate_due(now)
+        except Exception as e:
+            _to_error("Poll receipts", e, "")
+        with _lock:
+            next_deadline = _deadlines[0][0] if _deadlines else None
+        now = time.time()
+        wait = next_round - now
+        if next_deadline is not None:
+            wait = min(wait, max(0.01, next_deadline - now))
+        _wake.wait(max(0.0, wait))
+        _wake.clear()
+
+
+def _round_wait(now: float) -> float:
+    """
+    Seconds until the next round of polls.
+    """
+    interval = settings.get().pushover_receipt_poll_interval
+    with _lock:
+        next_due = _due[0][0] if _due else None
+    if next_due is None or next_due <= now:
+        # Receipts left over from this round wait for the next one, so the
+        # number of requests per round stays the same however many are waiting.
+        return interval
+    return min(interval, max(1.0, next_due - now))
+
+
+def _duration(seconds: float) -> str:
+    return f"{seconds:.0f} s" if seconds < 120 else f"{seconds / 60:.0f} min"
+
+
+def _label(entry: Receipt) -> str:
+    return request_handler._recipient_label(entry.user)
+
+
+def _to_terminal(msg: str) -> None:
+    """
+    Log a message to the terminal using the writer module.
+
+    Args:
+        msg (str): The message to log.
+    """
+    log_writer.to_terminal(MODULE_NAME, msg)
+
+
+def _to_error(tried_to: str, err_msg: object, obj: object) -> None:
+    """
+    Log an error using the writer module.
+
+    Args:
+        tried_to (str): Description of the operation attempted.
+        err_msg (object): The exception, or an error message.
+        obj (object): The context or data related to the error.
+    """
+    log_writer.to_error(MODULE_NAME, tried_to, err_msg, obj)
+
+
+def _collect_metrics() -> list:
+    """
+    Report the receipt counters to the metrics module.
+
+    Returns:
+        list: Metric samples, see metrics.register_collector.
+    """
+    stats_now = stats()
+    help = "Emergency notifications by how they ended"
+    return [
+        ("fsr_pages_outstanding", "gauge", "Emergency notifications waiting to be acknowledged", {},
+         stats_now["outstanding"]),
+        ("fsr_receipt_polls_total", "counter", "Receipt polls made", {}, stats_now["polls"]),
+        ("fsr_receipt_poll_failures_total", "counter", "Receipt polls that failed", {}, stats_now["poll_failures"]),
+    ] + [
+        ("fsr_pages_total", "counter", help, {"result": result}, stats_now[result])
+        for result in (RESULT_ACKNOWLEDGED, RESULT_ESCALATED, RESULT_EXPIRED, RESULT_LOST)
+    ]
+
+
+metrics.register_collector(_collect_metrics)
@@ -0,0 +1,139 @@
+"""
+Module: reconnect
+Purpose: Decides how long to wait before reconnecting to FSR, using capped
+         exponential backoff with jitter and separate handling of network and
+         authentication failures. Also measures "blind time", the time from
+         losing the subscription until the next confirmed subscription, during
+         which a callout can be missed.
+"""
+
+import random
+import threading
+import time
+
+# Failure kinds.
+NETWORK = "network"
+AUTH = "auth"
+
+# Connection states.
+STATE_CONNECTING = "connecting"
+STATE_SUBSCRIBED = "subscribed"
+STATE_WAITING = "waiting"
+
+
+class ReconnectEngine:
+    """
+    Reconnect state machine for one FSR connection.
+
+    The first retry after a network failure happens after min_delay. Every
+    following failure doubles the delay up to max_delay. Authentication
+    failures are retried once right away (a new token has been requested),
+    and then back off from auth_delay, so bad credentials do not hammer FSR.
+    """
+
+    def __init__(self, min_delay: float, max_delay: float, auth_delay: float):
+        """
+        Args:
+            min_delay (float): Seconds before the first retry after a network failure.
+            max_delay (float): Maximum seconds between retries.
+            auth_delay (float): Seconds before the second retry after an auth failure.
+        """
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.auth_delay = auth_delay
+        self.state = STATE_CONNECTING
+        self._attempts = {NETWORK: 0, AUTH: 0}
+        self._blind_since = time.monotonic()
+        self._lock = threading.Lock()
+        self.counters = {
+            "reconnects": 0,
+            "network_failures": 0,
+            "auth_failures": 0,
+            "subscriptions": 0,
+            "blind_seconds_total": 0.0,
+            "blind_seconds_last": 0.0,
+            "blind_seconds_max": 0.0,
+        }
+
+    def failure(self, kind: str) -> float:
+        """
+        Register a failed or lost connection and get the delay before the next attempt.
+
+        Args:
+            kind (str): NETWORK or AUTH.
+
+        Returns:
+            float: Seconds to wait before reconnecting.
+        """
+        with self._lock:
+            self._mark_blind()
+            self.state = STATE_WAITING
+            self._attempts[kind] += 1
+            self.counters[f"{kind}_failures"] += 1
+            self.counters["reconnects"] += 1
+            attempts = self._attempts[kind]
+
+        if kind == AUTH:
+            if attempts == 1:
+                return 0.0
+            delay = self.auth_delay * (2 ** (attempts - 2))
+        else:
+            delay = self.min_delay * (2 ** (attempts - 1))
+        delay = min(self.max_delay, delay)
+        # Equal jitter: keep at least half the delay, randomise the rest.
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    def connecting(self) -> None:
+        """
+        Register that a new connection attempt is starting.
+        """
+        with self._lock:
+            self.state = STATE_CONNECTING
+
+    def connection_lost(self) -> None:
+        """
+        Register that the connection was closed. Starts the blind time if it is not running.
+        """
+        with self._lock:
+            self._mark_blind()
+            self.state = STATE_WAITING
+
+    def subscribed(self) -> float:
+        """
+        Register a confirmed subscription, which ends the blind time and resets the backoff.
+
+        Returns:
+            float: The blind time in seconds that just ended.
+        """
+        with self._lock:
+            self.state = STATE_SUBSCRIBED
+            self._attempts = {NETWORK: 0, AUTH: 0}
+            self.counters["subscriptions"] += 1
+            if self._blind_since is None:
+                return 0.0
+            blind = time.monotonic() - self._blind_since
+            self._blind_since = None
+            self.counters["blind_seconds_total"] += blind
+            self.counters["blind_seconds_last"] = blind
+            self.counters["blind_seconds_max"] = max(self.counters["blind_seconds_max"], blind)
+            return blind
+
+    def stats(self) -> dict:
+        """
+        Get the reconnect counters.
+
+        Returns:
+            dict: Counters for reconnects, failures by kind, subscriptions and
+                  blind time, plus the current state and current blind time.
+        """
+        with self._lock:
+            snapshot = dict(self.counters)
+            snapshot["state"] = self.state
+            snapshot["blind_seconds_current"] = (
+                time.monotonic() - self._blind_since if self._blind_since is not None else 0.0
+            )
+        return snapshot
+
+    def _mark_blind(self) -> None:
+        if self._blind_since is None:
+            self._blind_since = time.monotonic()
@@ -0,0 +1,198 @@
+"""
+Module: redundancy
+Purpose: Lets incident frames arrive over several connections without being
+         handled more than once. With REDUNDANT_CONNECTIONS above 1 every
+         account keeps that many subscriptions open, the first copy of a frame
+         is handled and the later copies from the other connections are
+         dropped. With LEASE_PATH several processes stand by for each other:
+         only the holder of the lease (see the lease module) handles frames,
+         and a process that takes over replays the frames it received in the
+         last seconds, so a callout during the takeover is not missed.
+"""
+
+import threading
+import time
+from collections import OrderedDict, deque
+import analytics
+import incident_handler
+import incident_snapshot
+import lease
+import log_writer
+import metrics
+import settings
+
+MODULE_NAME = "Redundancy"
+
+# Max number of frames kept while standing by.
+STANDBY_BUFFER = 1000
+
+_lock = threading.Lock()
+_active: bool = True
+_standby: deque = deque(maxlen=STANDBY_BUFFER)
+_counters: dict = {"admitted": 0, "duplicates": 0, "standby": 0, "replayed": 0}
+
+
+class FrameDeduplicator:
+    """
+    Drops the copies of a frame that arrive over other connections.
+
+    Every connection counts how often it received a frame. A frame is new when
+    its connection has now received it more often than any other connection, so
+    a frame FSR really sends twice is handled twice, while the copies of it from
+    the other connections are dropped. Frames not seen for window seconds are forgotten.
+    """
+
+    def __init__(self, window: float):
+        """
+        Args:
+            window (float): Seconds to remember a frame after it was last received.
+        """
+        self.window = window
+        self._seen: OrderedDict = OrderedDict()
+
+    def admit(self, source: object, key: object, now: float = None) -> bool:
+        """
+        Register a frame received from a connection. Not thread-safe.
+
+        Args:
+            source (object): The connection the frame arrived on.
+            key (object): What identifies the frame, e.g. (account, incident id, fingerprint).
+            now (float): The monotonic time. Defaults to now.
+
+        Returns:
+            bool: True if the frame should be handled, False if it is a copy.
+        """
+        now = time.monotonic() if now is None else now
+        while self._seen:
+            oldest_key, (seen_at, _) = next(iter(self._seen.items()))
+            if now - seen_at <= self.window:
+                break
+            del self._seen[oldest_key]
+        entry = self._seen.pop(key, None)
+        counts = {} if entry is None else entry[1]
+        count = counts.get(source, 0) + 1
+        is_new = all(count > other for other_source, other in counts.items() if other_source is not source)
+        counts[source] = count
+        self._seen[key] = (now, counts)
+        return is_new
+
+    def __len__(self) -> int:
+        return len(self._seen)
+
+
+_deduplicator = FrameDeduplicator(300.0)
+
+
+def start() -> None:
+    """
+    Take part in the lease if LEASE_PATH is set.
+
+    Raises:
+        LeaseError: If the lease file can not be opened.
+    """
+    global _active
+    current = settings.get()
+    _deduplicator.window = current.dedupe_window
+    with _lock:
+        _active = lease.start(current.lease_path, current.lease_ttl, _lease_changed)
+
+
+def stop() -> None:
+    """
+    Release the lease, so a standby takes over right away.
+    """
+    lease.stop()
+
+
+def admit(source: object, account, message: str, msg: dict) -> bool:
+    """
+    Decide if an incident frame should be handled.
+
+    Args:
+        source (object): The connection the frame arrived on.
+        account (Account): The account the frame belongs to.
+        message (str): The frame as received.
+        msg (dict): The parsed frame.
+
+    Returns:
+        bool: True if the frame should be handled now. False if it is a copy of a
+              frame already handled, or this process stands by.
+    """
+    incident_id = (msg.get("message") or {}).get("id")
+    key = (account.name, incident_id, hash(message))
+    with _lock:
+        if not _deduplicator.admit(source, key):
+            _counters["duplicates"] += 1
+            return False
+        if not _active:
+            _standby.append((time.monotonic(), account, msg))
+            _counters["standby"] += 1
+            return False
+        _counters["admitted"] += 1
+        return True
+
+
+def stats() -> dict:
+    """
+    Get the redundancy counters.
+
+    Returns:
+        dict: Counters for frames admitted, dropped as copies, kept while standing
+              by and replayed on takeover, plus the number of frames remembered
+              and whether this process is active.
+    """
+    with _lock:
+        snapshot = dict(_counters)
+        snapshot["remembered"] = len(_deduplicator)
+        snapshot["active"] = _active
+    return snapshot
+
+
+def _lease_changed(active: bool) -> None:
+    """
+    Called by the lease thread. On takeover the snapshots written by the previous
+    holder are loaded and the recent frames are handled, before new frames are.
+    """
+    global _active
+    with _lock:
+        if not active:
+            _active = False
+            return
+        loaded = incident_snapshot.load_all()
+        analytics.load()
+        cutoff = time.monotonic() - 2 * settings.get().lease_ttl
+        frames = [(account, msg) for received_at, account, msg in _standby if received_at >= cutoff]
+        _standby.clear()
+        _to_terminal(f"Taking over with {loaded} active incident(s) and {len(frames)} recent frame(s)")
+        for account, msg in frames:
+            incident_handler.handle_incident(msg, account)
+        _counters["replayed"] += len(frames)
+        _active = True
+
+
+def _to_terminal(msg: str) -> None:
+    """
+    Log a message to the terminal using the writer module.
+
+    Args:
+        msg (str): The message to log.
+    """
+    log_writer.to_terminal(MODULE_NAME, msg)
+
+
+def _collect_metrics() -> list:
+    """
+    Report the redundancy counters to the metrics module.
+
+    Returns:
+        list: Metric samples, see metrics.register_collector.
+    """
+    stats_now = stats()
+    help = "Incident frames by what happened to them"
+    return [
+        ("fsr_redundant_frames_total", "counter", help, {"result": result}, stats_now[result])
+        for result in ("admitted", "duplicates", "standby", "replayed")
+    ]
+
+
+metrics.register_collector(_collect_metrics)
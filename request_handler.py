@@ -2,102 +2,664 @@
 Module: request_handler
 Purpose: Provides functions to send push notifications via Pushover,
          including separate functions for general and admin notifications.
+         Notifications are queued and delivered by a small pool of background
+         workers, so callers (e.g. the WebSocket callback) never wait on HTTP.
+         A notification for several recipients is queued as one job per
+         recipient, so the workers deliver them concurrently, and a token bucket
+         per Pushover app paces them within Pushover's rate limits.
+         Every notification is stored in the outbox until Pushover accepts it,
+         so notifications that could not be sent are tried again later and
+         after a restart, and a notification is never sent twice.
+         Emergency-priority notifications are followed up by the receipts module.
 """
 
+import queue
+import random
+import threading
+import time
 import requests
-from decouple import config
+import lease
 import log_writer
+import metrics
+import outbox
+import receipts
+import session_pool
+import settings
+from rate_limit import TokenBucket
 
 MODULE_NAME = "Request Handler"
+PUSHOVER_ENDPOINT = "https://api.pushover.net/1/messages.json"
 
+# Pushover emergency priority: repeated until acknowledged, see the receipts module.
+PRIORITY_EMERGENCY = "2"
 
-def push_to_pushover(msg: str, priority: str = "default") -> None:
+# Overflow policies used when the dispatch queue is full.
+OVERFLOW_DROP_OLDEST = "drop_oldest"
+OVERFLOW_DROP_NEWEST = "drop_newest"
+OVERFLOW_BLOCK = "block"
+
+# Results of one delivery attempt.
+RESULT_SENT = "sent"
+RESULT_REJECTED = "rejected"
+RESULT_RETRY = "retry"
+
+RECIPIENT_HISTOGRAM = "fsr_recipient_latency_seconds"
+
+# While fewer messages than PUSHOVER_QUOTA_RESERVE are left, the rest are spread
+# until the quota resets, but never slower than this many per second.
+MIN_QUOTA_RATE = 1 / 60
+# Seconds to pause an app that Pushover answered with HTTP 429, unless the
+# quota resets sooner.
+RATE_LIMITED_HOLD = 60
+
+# Dispatcher state.
+_queue: queue.Queue = None
+_workers: list = []
+_outbox_thread: threading.Thread = None
+_stop_event = threading.Event()
+_start_lock = threading.Lock()
+_stats_lock = threading.Lock()
+_stats: dict = {
+    "queued": 0,
+    "sent": 0,
+    "failed": 0,
+    "retried": 0,
+    "dropped": 0,
+    "duplicates": 0,
+    "replayed": 0,
+    "last_latency_ms": None,
+}
+# Outbox ids of the notifications on the queue or being delivered.
+_in_flight: set = set()
+_recipient_latency_ms: dict = {}
+
+# Rate limiting per Pushover app token.
+_limiters: dict = {}
+_quotas: dict = {}
+_limiters_lock = threading.Lock()
+
+
+class PushJob:
+    """A single queued HTTP POST to Pushover, for one recipient."""
+
+    __slots__ = (
+        "dest", "data", "is_admin", "recipient", "dedupe_key", "outbox_id", "enqueued_at", "received_at", "attempts"
+    )
+
+    def __init__(self, dest: str, data: dict, is_admin: bool = False, dedupe_key: str = None, outbox_id: int = None):
+        self.dest = dest
+        self.data = data
+        self.is_admin = is_admin
+        self.dedupe_key = dedupe_key
+        self.outbox_id = outbox_id
+        self.recipient = "admin" if is_admin else _recipient_label(data.get("user"))
+        self.enqueued_at = time.perf_counter()
+        # When the FSR message that caused this notification was received, if known.
+        self.received_at = metrics.trace_started_at()
+        self.attempts = 0
+
+
+def push_to_pushover(msg: str, priority: str = "default", user_keys: tuple = None, dedupe_key: str = None,
+                     emergency_user_keys: tuple = ()) -> None:
     """
-    Send a push notification via Pushover if ENABLE_PUSHOVER is enabled.
-    
+    Queue a push notification via Pushover if ENABLE_PUSHOVER is enabled.
+
+    Every recipient gets their own job, so the notification reaches all of them
+    concurrently instead of one after the other.
+
     Args:
         msg (str): The message to send.
         priority (str): The priority of the message. Defaults to "default".
+        user_keys (tuple): The Pushover user keys to send to. Defaults to
+            PUSHOVER_USER_KEY and PUSHOVER_RECIPIENTS.
+        dedupe_key (str): Identifies the notification, e.g. by incident id and kind.
+            A notification is sent at most once per dedupe key and recipient.
+            None to never deduplicate.
+        emergency_user_keys (tuple): Recipients that get the notification at
+            emergency priority instead, e.g. PUSHOVER_PAGER_KEYS.
     """
     try:
-        if config('ENABLE_PUSHOVER', cast=bool, default=False):
-            data = {
-                'title': config('PUSHOVER_HEADER'),
-                'token': config('PUSHOVER_TOKEN'),
-                'user': config('PUSHOVER_USER_KEY'),
-                'message': msg,
-                'html': "1"
-            }
-            if priority != "default":
-                data['priority'] = priority
-            endpoint = "https://api.pushover.net/1/messages.json"
-            _handle_http_post(endpoint, data)
+        current = settings.get()
+        if current.enable_pushover:
+            if not user_keys:
+                user_keys = (current.pushover_user_key,) + current.pushover_recipients
+            jobs = []
+            for user_key in dict.fromkeys(user_keys):
+                data = {
+                    'title': current.pushover_header,
+                    'token': current.pushover_token,
+                    'user': user_key,
+                    'message': msg,
+                    'html': "1"
+                }
+                _apply_priority(data, PRIORITY_EMERGENCY if user_key in emergency_user_keys else priority, current)
+                key = f"{dedupe_key}/{user_key}" if dedupe_key else None
+                jobs.append(PushJob(PUSHOVER_ENDPOINT, data, dedupe_key=key))
+            # One outbox commit for all recipients, so the caller waits once.
+            _enqueue_all(jobs)
     except Exception as e:
-        _to_error("Push to pushover", str(e), msg)
+        _to_error("Push to pushover", e, msg)
 
 
 def push_to_pushover_admin(msg: str, priority: str = "default") -> None:
     """
-    Send an admin push notification via Pushover if ENABLE_ADMIN is enabled.
-    
+    Queue an admin push notification via Pushover if ENABLE_ADMIN is enabled.
+
     Args:
         msg (str): The message to send.
         priority (str): The priority of the message. Defaults to "default".
     """
     try:
-        if config('ENABLE_ADMIN', cast=bool, default=False):
+        current = settings.get()
+        if current.enable_admin:
             data = {
-                'title': config('PUSHOVER_HEADER_ADMIN'),
-                'token': config('PUSHOVER_TOKEN_ADMIN'),
-                'user': config('PUSHOVER_USER_KEY_ADMIN'),
+                'title': current.pushover_header_admin,
+                'token': current.pushover_token_admin,
+                'user': current.pushover_user_key_admin,
                 'message': msg,
                 'html': "1"
             }
-            if priority != "default":
-                data['priority'] = priority
-            endpoint = "https://api.pushover.net/1/messages.json"
-            _handle_http_post(endpoint, data)
+            _apply_priority(data, priority, current)
+            _enqueue(PushJob(PUSHOVER_ENDPOINT, data, is_admin=True))
     except Exception as e:
         print("Exception in sending pushover to Admin:", e)
 
 
-def _handle_http_post(dest: str, data: dict) -> None:
+def _apply_priority(data: dict, priority: str, current: settings.Settings) -> None:
+    """
+    Set the priority of a notification. Emergency priority also needs to know how
+    often Pushover repeats it, and for how long.
+
+    Args:
+        data (dict): The notification payload.
+        priority (str): The priority, "default" to leave it to Pushover.
+        current (settings.Settings): The settings to use.
+    """
+    if priority == "default":
+        return
+    data['priority'] = priority
+    if priority == PRIORITY_EMERGENCY:
+        data['retry'] = current.pushover_emergency_retry
+        data['expire'] = current.pushover_emergency_expire
+
+
+def start_dispatcher() -> None:
+    """
+    Start the background dispatch workers if they are not already running.
+
+    The queue and pool are sized by the DISPATCH_QUEUE_SIZE and DISPATCH_WORKERS settings.
+    If OUTBOX_PATH is set, the outbox is opened and the notifications that were
+    not delivered before the last shutdown are queued again.
+    """
+    global _queue, _workers, _outbox_thread
+    with _start_lock:
+        if _workers:
+            return
+        current = settings.get()
+        _stop_event.clear()
+        _queue = queue.Queue(maxsize=current.dispatch_queue_size)
+        worker_count = max(1, current.dispatch_workers)
+        _workers = [
+            threading.Thread(target=_worker_loop, name=f"pushover-dispatch-{i}", daemon=True)
+            for i in range(worker_count)
+        ]
+        for worker in _workers:
+            worker.start()
+        if current.outbox_path:
+            try:
+                outbox.open_outbox(current.outbox_path, current.outbox_fsync)
+            except Exception as e:
+                _to_error("Open the outbox", e, current.outbox_path)
+        if outbox.is_open():
+            _outbox_thread = threading.Thread(target=_outbox_loop, name="pushover-outbox", daemon=True)
+            _outbox_thread.start()
+
+
+def stop_dispatcher(timeout: float = 10.0) -> None:
+    """
+    Stop the dispatch workers after the queued notifications have been sent.
+
+    Args:
+        timeout (float): Maximum number of seconds to wait for the queue to drain.
+    """
+    global _workers
+    with _start_lock:
+        if not _workers:
+            return
+        deadline = time.monotonic() + timeout
+        while _queue.unfinished_tasks and time.monotonic() < deadline:
+            time.sleep(0.05)
+        _stop_event.set()
+        for worker in _workers:
+            worker.join(max(0.0, deadline - time.monotonic()))
+        if _outbox_thread:
+            _outbox_thread.join(max(0.0, deadline - time.monotonic()))
+        _workers = []
+        outbox.close_outbox()
+
+
+def stats() -> dict:
+    """
+    Get a snapshot of the dispatcher counters.
+
+    Returns:
+        dict: Counters for queued, sent, failed, retried, dropped, duplicate and
+              replayed notifications, the current queue depth, the latency of the last delivery, the
+              latency of the last delivery per recipient and the rate limiter
+              state per Pushover app.
+    """
+    with _stats_lock:
+        snapshot = dict(_stats)
+        snapshot["recipients"] = dict(_recipient_latency_ms)
+    snapshot["queue_depth"] = _queue.qsize() if _queue else 0
+    with _limiters_lock:
+        limiters = dict(_limiters)
+    snapshot["rate_limit"] = {_recipient_label(token): limiter.stats() for token, limiter in limiters.items()}
+    return snapshot
+
+
+def _enqueue(job: PushJob) -> None:
+    """
+    Put a job on the dispatch queue, applying the configured overflow policy when full.
+
+    Args:
+        job (PushJob): The job to queue.
+    """
+    _enqueue_all([job])
+
+
+def _enqueue_all(jobs: list) -> None:
+    """
+    Store the jobs that are not in the outbox yet in one commit, then put them on
+    the dispatch queue. Jobs that were already sent are skipped.
+
+    Args:
+        jobs (list): The PushJobs to queue.
+    """
+    start_dispatcher()
+    new = [job for job in jobs if job.outbox_id is None]
+    if new and outbox.is_open():
+        try:
+            outbox_ids = outbox.record_many(
+                [(job.dest, job.data, job.is_admin, job.dedupe_key) for job in new], on_commit=_claim
+            )
+        except outbox.OutboxError as e:
+            # Still send them, just without the safety net.
+            _to_terminal(f"Could not store notification in the outbox: {str(e)}")
+        else:
+            duplicates = set()
+            for job, outbox_id in zip(new, outbox_ids):
+                job.outbox_id = outbox_id
+                if outbox_id is None:
+                    duplicates.add(id(job))
+                    _count("duplicates")
+                    _to_terminal(f"Skipped notification to {job.recipient} that was already sent")
+            jobs = [job for job in jobs if id(job) not in duplicates]
+    for job in jobs:
+        _queue_job(job)
+
+
+def _claim(outbox_ids: list) -> None:
+    """
+    Mark new outbox rows as in flight as soon as they are committed, so the outbox
+    loop does not queue them a second time while their caller queues them.
+
+    Args:
+        outbox_ids (list): The ids from outbox.record_many, None for duplicates.
+    """
+    with _stats_lock:
+        _in_flight.update(outbox_id for outbox_id in outbox_ids if outbox_id is not None)
+
+
+def _queue_job(job: PushJob) -> None:
+    """
+    Put a job on the dispatch queue, applying the configured overflow policy when full.
+
+    Args:
+        job (PushJob): The job to queue.
+    """
+    if job.outbox_id is not None:
+        with _stats_lock:
+            _in_flight.add(job.outbox_id)
+
+    current = settings.get()
+    policy = current.dispatch_overflow
+    try:
+        if policy == OVERFLOW_BLOCK:
+            _queue.put(job, timeout=current.dispatch_block_timeout)
+        else:
+            _queue.put_nowait(job)
+    except queue.Full:
+        if policy != OVERFLOW_DROP_OLDEST:
+            _drop(job)
+            _to_terminal("Dispatch queue full - dropped newest notification")
+            return
+        try:
+            _drop(_queue.get_nowait())
+            _queue.task_done()
+            _to_terminal("Dispatch queue full - dropped oldest notification")
+        except queue.Empty:
+            pass
+        try:
+            _queue.put_nowait(job)
+        except queue.Full:
+            _drop(job)
+            return
+    _count("queued")
+
+
+def _drop(job: PushJob) -> None:
+    """
+    Count a dropped job. A job in the outbox stays pending there and is queued again later.
+
+    Args:
+        job (PushJob): The dropped job.
+    """
+    _count("dropped")
+    if job.outbox_id is not None:
+        with _stats_lock:
+            _in_flight.discard(job.outbox_id)
+
+
+def _outbox_loop() -> None:
+    """
+    Queue the notifications in the outbox that are not delivered yet: right away
+    after a restart, and then every OUTBOX_RETRY_INTERVAL seconds for the ones
+    that could not be delivered.
+    """
+    while not _stop_event.is_set():
+        current = settings.get()
+        if not lease.is_active():
+            # A process standing by leaves the outbox to the one holding the lease.
+            _stop_event.wait(current.outbox_retry_interval)
+            continue
+        try:
+            rows = outbox.pending(current.outbox_max_age)
+        except outbox.OutboxError as e:
+            _to_terminal(f"Could not read the outbox: {str(e)}")
+            rows = []
+        with _stats_lock:
+            rows = [row for row in rows if row[0] not in _in_flight]
+        for outbox_id, dest, data, is_admin, created_at in rows:
+            if _stop_event.is_set():
+                return
+            _to_terminal(f"Sending notification from the outbox, created {time.time() - created_at:.0f} s ago")
+            _count("replayed")
+            _enqueue(PushJob(dest, data, is_admin=is_admin, outbox_id=outbox_id))
+        _stop_event.wait(current.outbox_retry_interval)
+
+
+def _worker_loop() -> None:
+    """
+    Take jobs from the dispatch queue and deliver them until the dispatcher is stopped.
+    """
+    while not _stop_event.is_set():
+        try:
+            job: PushJob = _queue.get(timeout=0.5)
+        except queue.Empty:
+            continue
+        try:
+            _deliver(job)
+        except Exception as e:
+            if job.is_admin:
+                # Never report admin delivery failures through the admin channel itself.
+                _to_terminal(f"Dispatch worker failed on an admin notification: {str(e)}")
+            else:
+                _to_error("Deliver a queued notification", e, job.recipient)
+        finally:
+            _queue.task_done()
+
+
+def _deliver(job: PushJob) -> None:
+    """
+    Deliver a job, retrying transient failures with exponential backoff and jitter.
+
+    Args:
+        job (PushJob): The job to deliver.
+    """
+    current = settings.get()
+    metrics.observe_stage("queue_wait", time.perf_counter() - job.enqueued_at)
+    limiter = _limiter(job.data.get("token"))
+    try:
+        _deliver_with_retries(job, limiter, current.dispatch_max_retries, current.dispatch_retry_delay)
+    finally:
+        if job.outbox_id is not None:
+            with _stats_lock:
+                _in_flight.discard(job.outbox_id)
+
+
+def _deliver_with_retries(job: PushJob, limiter: TokenBucket, max_retries: int, base_delay: float) -> None:
+    """
+    Deliver a job and record the outcome in the outbox.
+
+    Args:
+        job (PushJob): The job to deliver.
+        limiter (TokenBucket): The rate limiter of the job's Pushover app.
+        max_retries (int): Retries of transient failures.
+        base_delay (float): Seconds before the first retry, doubled for every retry.
+    """
+    while True:
+        if not limiter.acquire(_stop_event):
+            break
+        job.attempts += 1
+        result = _handle_http_post(job.dest, job.data, report_errors=not job.is_admin)
+        if result == RESULT_REJECTED:
+            _count("failed")
+            if job.outbox_id is not None:
+                outbox.mark(job.outbox_id, outbox.STATE_FAILED, job.attempts)
+            return
+        if result == RESULT_SENT:
+            if job.outbox_id is not None:
+                outbox.mark(job.outbox_id, outbox.STATE_SENT, job.attempts)
+            latency = time.perf_counter() - job.enqueued_at
+            latency_ms = latency * 1000
+            with _stats_lock:
+                _stats["sent"] += 1
+                _stats["last_latency_ms"] = round(latency_ms, 1)
+                _recipient_latency_ms[job.recipient] = round(latency_ms, 1)
+            metrics.observe(
+                RECIPIENT_HISTOGRAM, latency, "Time from queueing until Pushover accepted it, per recipient",
+                recipient=job.recipient
+            )
+            _to_terminal(f"Push to {job.recipient} completed in {latency_ms:.0f} ms (attempt {job.attempts})")
+            if job.received_at is not None:
+                metrics.observe_alert(job.received_at, "admin" if job.is_admin else "user")
+            return
+        if job.attempts > max_retries or _stop_event.is_set():
+            break
+        _count("retried")
+        delay = base_delay * (2 ** (job.attempts - 1))
+        _stop_event.wait(delay + random.uniform(0, delay / 2))
+
+    _count("failed")
+    if job.outbox_id is not None:
+        # Stays pending, so the outbox loop tries again later.
+        outbox.mark(job.outbox_id, outbox.STATE_PENDING, job.attempts)
+        _to_terminal(f"Could not deliver notification to {job.recipient} after {job.attempts} attempts - "
+                     "it stays in the outbox")
+    elif job.is_admin:
+        # Never report admin delivery failures through the admin channel itself.
+        _to_terminal(f"Giving up on admin notification after {job.attempts} attempts")
+    else:
+        _to_error("Handle push to pushover", f"Giving up after {job.attempts} attempts", job.dest)
+
+
+def _handle_http_post(dest: str, data: dict, report_errors: bool = True) -> str:
     """
     Handle the HTTP POST request to the specified destination.
-    
+
     Args:
         dest (str): The URL endpoint for the POST request.
         data (dict): The payload data to be sent.
+        report_errors (bool): If False, failures are only written to the terminal
+            instead of the error log (used for admin notifications).
+
+    Returns:
+        str: RESULT_SENT if Pushover accepted it, RESULT_REJECTED if it was
+             rejected permanently, or RESULT_RETRY if it failed in a way that is
+             worth retrying.
     """
     try:
-        response = requests.post(url=dest, data=data, timeout=10)
+        with metrics.timed("http_send"):
+            response = session_pool.post(dest, data=data, timeout=10)
+        reset = _apply_quota_headers(data.get("token"), response.headers)
+        if response.status_code == 429:
+            hold = RATE_LIMITED_HOLD if reset is None else min(RATE_LIMITED_HOLD, max(1.0, reset - time.time()))
+            _limiter(data.get("token")).hold(hold)
+            _to_terminal(f"Response from Pushover: HTTP 429 - pausing for {hold:.0f} s")
+            return RESULT_RETRY
+        if response.status_code >= 500:
+            _to_terminal(f"Response from Pushover: HTTP {response.status_code} - retrying")
+            return RESULT_RETRY
         response_data = response.json()
         if response_data.get("status") == 1:
             _to_terminal("Response from Pushover: Success")
-        else:
-            _to_terminal("Response from Pushover: Failure - See error log")
+            if response_data.get("receipt"):
+                receipts.track(response_data["receipt"], data)
+            return RESULT_SENT
+        _to_terminal("Response from Pushover: Failure - See error log")
+        if report_errors:
             _to_error("Got error msg from pushover", response.text, data)
+        return RESULT_REJECTED
+    except requests.RequestException as e:
+        _to_terminal(f"Push to pushover failed: {str(e)}")
+        return RESULT_RETRY
     except Exception as e:
-        _to_error("Handle push to pushover", str(e), dest)
+        if report_errors:
+            _to_error("Handle push to pushover", e, dest)
+        else:
+            _to_terminal(f"Push to pushover failed: {str(e)}")
+        return RESULT_REJECTED
+
+
+def _limiter(token: str) -> TokenBucket:
+    """
+    Get the token bucket of a Pushover app, sized by the settings and the quota
+    Pushover reported for it.
+
+    Args:
+        token (str): The app token.
+
+    Returns:
+        TokenBucket: The bucket.
+    """
+    current = settings.get()
+    rate, capacity = current.pushover_rate, current.pushover_burst
+    with _limiters_lock:
+        quota = _quotas.get(token)
+        if quota is not None and quota[0] < current.pushover_quota_reserve:
+            remaining, reset = quota
+            rate = min(rate, max(MIN_QUOTA_RATE, remaining / max(1.0, reset - time.time())))
+            capacity = max(1, min(capacity, remaining))
+        limiter = _limiters.get(token)
+        if limiter is None:
+            limiter = _limiters[token] = TokenBucket(rate, capacity)
+        elif limiter.rate != rate or limiter.capacity != capacity:
+            limiter.configure(rate, capacity)
+    return limiter
+
+
+def _apply_quota_headers(token: str, headers) -> float:
+    """
+    Remember the message quota Pushover reported for an app.
+
+    Args:
+        token (str): The app token.
+        headers: The response headers.
+
+    Returns:
+        float: The epoch time the quota resets, or None if the headers were missing.
+    """
+    try:
+        remaining = int(headers["X-Limit-App-Remaining"])
+        reset = float(headers["X-Limit-App-Reset"])
+    except (KeyError, TypeError, ValueError):
+        return None
+    with _limiters_lock:
+        _quotas[token] = (remaining, reset)
+    return reset
+
+
+def _recipient_label(user_key: str) -> str:
+    """
+    Get a label for a user or app key that is safe to show in logs and metrics.
+
+    Args:
+        user_key (str): The key.
+
+    Returns:
+        str: The last four characters of the key.
+    """
+    return f"...{str(user_key)[-4:]}" if user_key else "unknown"
+
+
+def _count(key: str) -> None:
+    """
+    Increment one of the dispatcher counters.
+
+    Args:
+        key (str): The counter to increment.
+    """
+    with _stats_lock:
+        _stats[key] += 1
 
 
 def _to_terminal(msg: str) -> None:
     """
     Log a message to the terminal using the writer module.
-    
+
     Args:
         msg (str): The message to log.
     """
     log_writer.to_terminal(MODULE_NAME, msg)
 
 
-def _to_error(tried_to: str, err_msg: str, obj: object) -> None:
+def _to_error(tried_to: str, err_msg: object, obj: object) -> None:
     """
     Log an error using the writer module.
-    
+
     Args:
         tried_to (str): Description of the operation attempted.
-        err_msg (str): The error message.
+        err_msg (object): The exception, or an error message.
         obj (object): The context or data related to the error.
     """
     log_writer.to_error(MODULE_NAME, tried_to, err_msg, obj)
+
+
+def _collect_metrics() -> list:
+    """
+    Report the dispatcher counters to the metrics module.
+
+    Returns:
+        list: Metric samples, see metrics.register_collector.
+    """
+    stats_now = stats()
+    help = "Pushover notifications by result"
+    samples = [
+        ("fsr_pushes_total", "counter", help, {"result": "ok"}, stats_now["sent"]),
+        ("fsr_pushes_total", "counter", help, {"result": "failed"}, stats_now["failed"]),
+        ("fsr_pushes_total", "counter", help, {"result": "retried"}, stats_now["retried"]),
+        ("fsr_pushes_total", "counter", help, {"result": "dropped"}, stats_now["dropped"]),
+        ("fsr_pushes_total", "counter", help, {"result": "duplicate"}, stats_now["duplicates"]),
+        ("fsr_pushes_total", "counter", help, {"result": "replayed"}, stats_now["replayed"]),
+        ("fsr_dispatch_queue_depth", "gauge", "Notifications waiting to be sent", {}, stats_now["queue_depth"]),
+    ]
+    for app, limiter in stats_now["rate_limit"].items():
+        labels = {"app": app}
+        samples.extend([
+            ("fsr_pushover_rate", "gauge", "Notifications per second allowed by the rate limiter", labels,
+             limiter["rate"]),
+            ("fsr_pushover_throttled_total", "counter", "Notifications that waited for the rate limiter", labels,
+             limiter["waits"]),
+            ("fsr_pushover_throttled_seconds_total", "counter", "Time notifications waited for the rate limiter",
+             labels, limiter["wait_seconds"]),
+        ])
+    with _limiters_lock:
+        quotas = dict(_quotas)
+    for token, (remaining, reset) in quotas.items():
+        samples.append(("fsr_pushover_quota_remaining", "gauge", "Messages left in the Pushover app's monthly quota",
+                        {"app": _recipient_label(token)}, remaining))
+    return samples
+
+
+metrics.register_collector(_collect_metrics)
@@ -0,0 +1,171 @@
+"""
+Module: session_pool
+Purpose: Provides a shared HTTP session with pooled keep-alive connections,
+         so Pushover and OAuth requests reuse an open TCP/TLS connection
+         instead of doing a new DNS lookup and handshake for every call.
+         A background warm-up keeps a connection open to selected hosts.
+"""
+
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+import metrics
+import settings
+
+_session: requests.Session = None
+_session_lock = threading.Lock()
+_warmup_thread: threading.Thread = None
+_warmup_stop = threading.Event()
+_warmup_stats: dict = {"warmups": 0, "warmup_failures": 0}
+
+
+def get_session() -> requests.Session:
+    """
+    Get the shared session, creating it on first use.
+
+    The pool is sized by HTTP_POOL_CONNECTIONS (number of hosts kept) and
+    HTTP_POOL_SIZE (connections kept per host).
+
+    Returns:
+        requests.Session: The shared session.
+    """
+    global _session
+    if _session is not None:
+        return _session
+    with _session_lock:
+        if _session is None:
+            current = settings.get()
+            adapter = HTTPAdapter(
+                pool_connections=current.http_pool_connections,
+                pool_maxsize=current.http_pool_size,
+                max_retries=0
+            )
+            session = requests.Session()
+            session.headers["Connection"] = "keep-alive"
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            _session = session
+    return _session
+
+
+def post(url: str, **kwargs) -> requests.Response:
+    """
+    Send a POST request through the shared session.
+
+    Args:
+        url (str): The URL to post to.
+        **kwargs: Passed on to requests.Session.post.
+
+    Returns:
+        requests.Response: The response.
+    """
+    return get_session().post(url, **kwargs)
+
+
+def get(url: str, **kwargs) -> requests.Response:
+    """
+    Send a GET request through the shared session.
+
+    Args:
+        url (str): The URL to get.
+        **kwargs: Passed on to requests.Session.get.
+
+    Returns:
+        requests.Response: The response.
+    """
+    return get_session().get(url, **kwargs)
+
+
+def start_warmup(urls: list) -> None:
+    """
+    Open connections to the given URLs now, and keep them alive in the background.
+
+    The URLs are requested again every HTTP_WARMUP_INTERVAL seconds, which should
+    be shorter than the idle timeout of the remote server. Set the interval to 0
+    to disable the warm-up.
+
+    Args:
+        urls (list): The URLs to keep a connection open to.
+    """
+    global _warmup_thread
+    interval = settings.get().http_warmup_interval
+    if interval <= 0 or (_warmup_thread and _warmup_thread.is_alive()):
+        return
+    _warmup_stop.clear()
+    _warmup_thread = threading.Thread(
+        target=_warmup_loop, args=(list(urls), interval), name="http-warmup", daemon=True
+    )
+    _warmup_thread.start()
+
+
+def stop_warmup() -> None:
+    """
+    Stop the background warm-up.
+    """
+    _warmup_stop.set()
+    if _warmup_thread:
+        _warmup_thread.join(timeout=5)
+
+
+def stats() -> dict:
+    """
+    Get connection reuse counts for every host in the pool.
+
+    Returns:
+        dict: Per host the number of connections opened, requests sent and
+              requests that reused an existing connection, plus warm-up counters.
+    """
+    hosts = {}
+    if _session is not None:
+        adapters = {id(adapter): adapter for adapter in _session.adapters.values()}
+        for adapter in adapters.values():
+            pools = adapter.poolmanager.pools
+            for key in pools.keys():
+                pool = pools.get(key)
+                if pool is None:
+                    continue
+                opened = pool.num_connections
+                sent = pool.num_requests
+                hosts[f"{pool.scheme}://{pool.host}"] = {
+                    "connections": opened,
+                    "requests": sent,
+                    "reused": max(0, sent - opened),
+                }
+    return {"hosts": hosts, **_warmup_stats}
+
+
+def _warmup_loop(urls: list, interval: float) -> None:
+    """
+    Request each URL, then wait for the interval, until stopped.
+
+    Args:
+        urls (list): The URLs to keep warm.
+        interval (float): Seconds between warm-ups.
+    """
+    while True:
+        for url in urls:
+            try:
+                get_session().head(url, timeout=10)
+                _warmup_stats["warmups"] += 1
+            except requests.RequestException:
+                _warmup_stats["warmup_failures"] += 1
+        if _warmup_stop.wait(interval):
+            return
+
+
+def _collect_metrics() -> list:
+    """
+    Report the connection reuse counts to the metrics module.
+
+    Returns:
+        list: Metric samples, see metrics.register_collector.
+    """
+    samples = []
+    for host, counts in stats()["hosts"].items():
+        samples.append(("fsr_http_connections_total", "counter", "HTTP connections opened", {"host": host}, counts["connections"]))
+        samples.append(("fsr_http_requests_total", "counter", "HTTP requests sent", {"host": host}, counts["requests"]))
+        samples.append(("fsr_http_reused_total", "counter", "HTTP requests that reused a connection", {"host": host}, counts["reused"]))
+    return samples
+
+
+metrics.register_collector(_collect_metrics)
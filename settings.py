@@ -0,0 +1,335 @@
+"""
+Module: settings
+Purpose: Loads the configuration from the .env file once into an immutable,
+         typed Settings object, and validates it at startup so a bad
+         configuration fails at boot instead of during the first callout.
+         The settings can be reloaded without a restart by sending SIGHUP.
+"""
+
+import os
+import signal
+from dataclasses import dataclass
+from decouple import AutoConfig, Csv, UndefinedValueError
+
+MODULE_NAME = "Settings"
+
+_current = None
+
+
+class SettingsError(Exception):
+    """Raised when the configuration is missing required values or has invalid values."""
+    pass
+
+
+@dataclass(frozen=True)
+class Settings:
+    """
+    The configuration of the integration.
+
+    Changes to the dispatch and HTTP pool sizes, the outbox file, the sinks, the
+    incident snapshot file, the analytics folder, the JSON backend, the map data file, the redundant
+    connections and the lease only take effect after a restart, all other values are
+    picked up by a reload.
+    """
+    enable_pushover: bool
+    enable_admin: bool
+    enable_responding: bool
+    accounts_file: str
+    fsr_username: str
+    fsr_password: str
+    fsr_token_url: str
+    fsr_cable_url: str
+    pushover_token: str
+    pushover_user_key: str
+    pushover_header: str
+    pushover_recipients: tuple
+    pushover_rate: float
+    pushover_burst: int
+    pushover_quota_reserve: int
+    pushover_pager_keys: tuple
+    pushover_emergency_retry: int
+    pushover_emergency_expire: int
+    pushover_escalation_user_key: str
+    pushover_escalation_deadline: float
+    pushover_receipt_poll_interval: float
+    pushover_receipt_poll_batch: int
+    pushover_token_admin: str
+    pushover_user_key_admin: str
+    pushover_header_admin: str
+    link_to_map_str: str
+    geo_data_path: str
+    geo_station_radius: float
+    geo_nearby_radius: float
+    geo_nearby_max: int
+    geo_cache_size: int
+    token_cache_path: str
+    oauth_refresh_ahead: float
+    reconnect_min_delay: float
+    reconnect_max_delay: float
+    reconnect_auth_delay: float
+    watchdog_ping_timeout: float
+    redundant_connections: int
+    dedupe_window: float
+    lease_path: str
+    lease_ttl: float
+    responding_user_name: str
+    responding_msg: str
+    dispatch_queue_size: int
+    dispatch_workers: int
+    dispatch_max_retries: int
+    dispatch_retry_delay: float
+    dispatch_overflow: str
+    dispatch_block_timeout: float
+    sink_queue_size: int
+    sink_max_retries: int
+    sink_breaker_threshold: int
+    sink_breaker_reset: float
+    webhook_url: str
+    webhook_timeout: float
+    mqtt_host: str
+    mqtt_port: int
+    mqtt_topic: str
+    mqtt_username: str
+    mqtt_password: str
+    mqtt_timeout: float
+    outbox_path: str
+    outbox_fsync: bool
+    outbox_max_age: float
+    outbox_retry_interval: float
+    http_pool_connections: int
+    http_pool_size: int
+    http_warmup_interval: float
+    log_flush_policy: str
+    log_flush_interval: float
+    log_fsync: bool
+    error_digest_window: float
+    error_push_per_hour: float
+    error_push_burst: int
+    incident_coalesce_window: float
+    incident_snapshot_path: str
+    incident_snapshot_interval: float
+    analytics_path: str
+    analytics_flush_interval: float
+    incident_compress: bool
+    incident_retention_days: int
+    metrics_host: str
+    metrics_port: int
+    profile_path: str
+    profile_duration: float
+    profile_sample_interval: float
+    profile_functions: tuple
+    profile_tracemalloc_frames: int
+    profile_endpoints: bool
+    json_backend: str
+
+
+def get() -> Settings:
+    """
+    Get the current settings, loading them on first use.
+
+    Returns:
+        Settings: The current settings.
+
+    Raises:
+        SettingsError: If the settings have not been loaded and are invalid.
+    """
+    return _current or load()
+
+
+def load() -> Settings:
+    """
+    Read and validate the configuration, and make it the current settings.
+
+    Values are read from the environment first and then from the .env file.
+
+    Returns:
+        Settings: The new settings.
+
+    Raises:
+        SettingsError: If required values are missing or values are invalid.
+    """
+    global _current
+    _current = _read(AutoConfig(search_path=os.path.dirname(os.path.abspath(__file__))))
+    return _current
+
+
+def reload() -> Settings:
+    """
+    Reload the configuration. If the new configuration is invalid, the current
+    settings are kept and the error is logged.
+
+    Returns:
+        Settings: The settings in use after the reload.
+    """
+    import log_writer
+    try:
+        load()
+        log_writer.to_terminal(MODULE_NAME, "Settings reloaded")
+    except SettingsError as e:
+        log_writer.to_error(MODULE_NAME, "Reload settings", e, "")
+    return _current
+
+
+def install_reload_handler() -> None:
+    """
+    Reload the settings when the process receives SIGHUP. Does nothing on
+    platforms without SIGHUP (e.g. Windows).
+    """
+    if hasattr(signal, "SIGHUP"):
+        signal.signal(signal.SIGHUP, lambda signum, frame: reload())
+
+
+def _read(cfg: AutoConfig) -> Settings:
+    """
+    Build a Settings object from a decouple config, collecting all problems.
+
+    Args:
+        cfg (AutoConfig): The config to read from.
+
+    Returns:
+        Settings: The settings.
+
+    Raises:
+        SettingsError: If required values are missing or values are invalid.
+    """
+    errors = []
+
+    def value(key: str, cast=str, default=None, required: bool = False):
+        try:
+            if required:
+                return cfg(key, cast=cast)
+            return cfg(key, cast=cast, default=default)
+        except UndefinedValueError:
+            errors.append(f"{key} is missing")
+        except ValueError as e:
+            errors.append(f"{key} is invalid ({e})")
+        return default
+
+    enable_pushover = value('ENABLE_PUSHOVER', bool, False)
+    enable_admin = value('ENABLE_ADMIN', bool, False)
+    enable_responding = value('ENABLE_RESPONDING', bool, False)
+    accounts_file = value('ACCOUNTS_FILE', default="")
+
+    result = Settings(
+        enable_pushover=enable_pushover,
+        enable_admin=enable_admin,
+        enable_responding=enable_responding,
+        accounts_file=accounts_file,
+        fsr_username=value('FSR_USERNAME', required=not accounts_file),
+        fsr_password=value('FSR_PASSWORD', required=not accounts_file),
+        fsr_token_url=value('FSR_TOKEN_URL', default="https://www.fireservicerota.co.uk/oauth/token"),
+        fsr_cable_url=value('FSR_CABLE_URL', default="wss://www.fireservicerota.co.uk/cable"),
+        pushover_token=value('PUSHOVER_TOKEN', required=enable_pushover),
+        pushover_user_key=value('PUSHOVER_USER_KEY', required=enable_pushover),
+        pushover_header=value('PUSHOVER_HEADER', required=enable_pushover),
+        pushover_recipients=value('PUSHOVER_RECIPIENTS', Csv(post_process=tuple), ""),
+        pushover_rate=value('PUSHOVER_RATE', float, 5.0),
+        pushover_burst=value('PUSHOVER_BURST', int, 20),
+        pushover_quota_reserve=value('PUSHOVER_QUOTA_RESERVE', int, 500),
+        pushover_pager_keys=value('PUSHOVER_PAGER_KEYS', Csv(post_process=tuple), ""),
+        pushover_emergency_retry=value('PUSHOVER_EMERGENCY_RETRY', int, 60),
+        pushover_emergency_expire=value('PUSHOVER_EMERGENCY_EXPIRE', int, 3600),
+        pushover_escalation_user_key=value('PUSHOVER_ESCALATION_USER_KEY', default=""),
+        pushover_escalation_deadline=value('PUSHOVER_ESCALATION_DEADLINE', float, 120.0),
+        pushover_receipt_poll_interval=value('PUSHOVER_RECEIPT_POLL_INTERVAL', float, 10.0),
+        pushover_receipt_poll_batch=value('PUSHOVER_RECEIPT_POLL_BATCH', int, 10),
+        pushover_token_admin=value('PUSHOVER_TOKEN_ADMIN', required=enable_admin),
+        pushover_user_key_admin=value('PUSHOVER_USER_KEY_ADMIN', required=enable_admin),
+        pushover_header_admin=value('PUSHOVER_HEADER_ADMIN', required=enable_admin),
+        link_to_map_str=value('LINK_TO_MAP_STR', default="Link til kort"),
+        geo_data_path=value('GEO_DATA_PATH', default=""),
+        geo_station_radius=value('GEO_STATION_RADIUS', float, 50.0),
+        geo_nearby_radius=value('GEO_NEARBY_RADIUS', float, 250.0),
+        geo_nearby_max=value('GEO_NEARBY_MAX', int, 3),
+        geo_cache_size=value('GEO_CACHE_SIZE', int, 1024),
+        token_cache_path=value('TOKEN_CACHE_PATH', default=".fsr_token.json"),
+        oauth_refresh_ahead=value('OAUTH_REFRESH_AHEAD', float, 300.0),
+        reconnect_min_delay=value('RECONNECT_MIN_DELAY', float, 0.25),
+        reconnect_max_delay=value('RECONNECT_MAX_DELAY', float, 60.0),
+        reconnect_auth_delay=value('RECONNECT_AUTH_DELAY', float, 5.0),
+        watchdog_ping_timeout=value('WATCHDOG_PING_TIMEOUT', float, 30.0),
+        redundant_connections=value('REDUNDANT_CONNECTIONS', int, 1),
+        dedupe_window=value('DEDUPE_WINDOW', float, 300.0),
+        lease_path=value('LEASE_PATH', default=""),
+        lease_ttl=value('LEASE_TTL', float, 5.0),
+        responding_user_name=value('RESPONDING_USER_NAME', required=enable_responding),
+        responding_msg=value('RESPONDING_MSG', required=enable_responding),
+        dispatch_queue_size=value('DISPATCH_QUEUE_SIZE', int, 100),
+        dispatch_workers=value('DISPATCH_WORKERS', int, 2),
+        dispatch_max_retries=value('DISPATCH_MAX_RETRIES', int, 3),
+        dispatch_retry_delay=value('DISPATCH_RETRY_DELAY', float, 0.5),
+        dispatch_overflow=value('DISPATCH_OVERFLOW', default="drop_oldest"),
+        dispatch_block_timeout=value('DISPATCH_BLOCK_TIMEOUT', float, 1.0),
+        outbox_path=value('OUTBOX_PATH', default="outbox.sqlite"),
+        outbox_fsync=value('OUTBOX_FSYNC', bool, False),
+        outbox_max_age=value('OUTBOX_MAX_AGE', float, 3600.0),
+        outbox_retry_interval=value('OUTBOX_RETRY_INTERVAL', float, 60.0),
+        sink_queue_size=value('SINK_QUEUE_SIZE', int, 100),
+        sink_max_retries=value('SINK_MAX_RETRIES', int, 2),
+        sink_breaker_threshold=value('SINK_BREAKER_THRESHOLD', int, 5),
+        sink_breaker_reset=value('SINK_BREAKER_RESET', float, 60.0),
+        webhook_url=value('WEBHOOK_URL', default=""),
+        webhook_timeout=value('WEBHOOK_TIMEOUT', float, 5.0),
+        mqtt_host=value('MQTT_HOST', default=""),
+        mqtt_port=value('MQTT_PORT', int, 1883),
+        mqtt_topic=value('MQTT_TOPIC', default="fsr"),
+        mqtt_username=value('MQTT_USERNAME', default=""),
+        mqtt_password=value('MQTT_PASSWORD', default=""),
+        mqtt_timeout=value('MQTT_TIMEOUT', float, 5.0),
+        http_pool_connections=value('HTTP_POOL_CONNECTIONS', int, 4),
+        http_pool_size=value('HTTP_POOL_SIZE', int, 4),
+        http_warmup_interval=value('HTTP_WARMUP_INTERVAL', float, 45.0),
+        log_flush_policy=value('LOG_FLUSH_POLICY', default="batch"),
+        log_flush_interval=value('LOG_FLUSH_INTERVAL', float, 1.0),
+        log_fsync=value('LOG_FSYNC', bool, False),
+        error_digest_window=value('ERROR_DIGEST_WINDOW', float, 300.0),
+        error_push_per_hour=value('ERROR_PUSH_PER_HOUR', float, 12.0),
+        error_push_burst=value('ERROR_PUSH_BURST', int, 5),
+        incident_coalesce_window=value('INCIDENT_COALESCE_WINDOW', float, 2.0),
+        incident_snapshot_path=value('INCIDENT_SNAPSHOT_PATH', default="incidents.json"),
+        incident_snapshot_interval=value('INCIDENT_SNAPSHOT_INTERVAL', float, 30.0),
+        analytics_path=value('ANALYTICS_PATH', default="Analytics"),
+        analytics_flush_interval=value('ANALYTICS_FLUSH_INTERVAL', float, 60.0),
+        incident_compress=value('INCIDENT_COMPRESS', bool, True),
+        incident_retention_days=value('INCIDENT_RETENTION_DAYS', int, 0),
+        metrics_host=value('METRICS_HOST', default="127.0.0.1"),
+        metrics_port=value('METRICS_PORT', int, 0),
+        profile_path=value('PROFILE_PATH', default="Profiles"),
+        profile_duration=value('PROFILE_DURATION', float, 30.0),
+        profile_sample_interval=value('PROFILE_SAMPLE_INTERVAL', float, 0.005),
+        profile_functions=value('PROFILE_FUNCTIONS', Csv(post_process=tuple),
+                                "on_message,_handle_message,handle_incident,_handle_http_post"),
+        profile_tracemalloc_frames=value('PROFILE_TRACEMALLOC_FRAMES', int, 10),
+        profile_endpoints=value('PROFILE_ENDPOINTS', bool, False),
+        json_backend=value('JSON_BACKEND', default="auto"),
+    )
+
+    if not result.fsr_token_url.startswith(("http://", "https://")):
+        errors.append("FSR_TOKEN_URL must be an http:// or https:// URL")
+    if not result.fsr_cable_url.startswith(("ws://", "wss://")):
+        errors.append("FSR_CABLE_URL must be a ws:// or wss:// URL")
+    if result.dispatch_overflow not in ("drop_oldest", "drop_newest", "block"):
+        errors.append("DISPATCH_OVERFLOW must be drop_oldest, drop_newest or block")
+    if result.pushover_rate <= 0 or result.pushover_burst < 1:
+        errors.append("PUSHOVER_RATE must be above 0 and PUSHOVER_BURST at least 1")
+    if result.pushover_emergency_retry < 30 or not 0 < result.pushover_emergency_expire <= 10800:
+        errors.append("PUSHOVER_EMERGENCY_RETRY must be at least 30 and PUSHOVER_EMERGENCY_EXPIRE between 1 and 10800")
+    if result.pushover_escalation_deadline <= 0:
+        errors.append("PUSHOVER_ESCALATION_DEADLINE must be above 0")
+    if result.pushover_receipt_poll_interval < 5 or result.pushover_receipt_poll_batch < 1:
+        errors.append("PUSHOVER_RECEIPT_POLL_INTERVAL must be at least 5 and PUSHOVER_RECEIPT_POLL_BATCH at least 1")
+    if result.log_flush_policy not in ("batch", "interval"):
+        errors.append("LOG_FLUSH_POLICY must be batch or interval")
+    if result.error_digest_window <= 0 or result.error_push_per_hour <= 0 or result.error_push_burst < 1:
+        errors.append("ERROR_DIGEST_WINDOW and ERROR_PUSH_PER_HOUR must be above 0 and ERROR_PUSH_BURST at least 1")
+    if result.redundant_connections < 1 or result.lease_ttl <= 0:
+        errors.append("REDUNDANT_CONNECTIONS must be at least 1 and LEASE_TTL above 0")
+    if result.profile_duration <= 0 or result.profile_sample_interval < 0.001:
+        errors.append("PROFILE_DURATION must be above 0 and PROFILE_SAMPLE_INTERVAL at least 0.001")
+    if result.profile_tracemalloc_frames < 1:
+        errors.append("PROFILE_TRACEMALLOC_FRAMES must be at least 1")
+    if result.json_backend not in ("auto", "orjson", "json"):
+        errors.append("JSON_BACKEND must be auto, orjson or json")
+    if errors:
+        raise SettingsError("; ".join(errors))
+    return result
@@ -0,0 +1,533 @@
+"""
+Module: sinks
+Purpose: Publishes incident events to every configured destination: Pushover,
+         a generic webhook (e.g. Home Assistant) and an MQTT broker. Every
+         destination has its own queue, worker, timeout, retry budget and
+         circuit breaker, so a slow or dead destination never delays the
+         others, and Pushover alerts always go out first.
+
+Events are dicts with:
+    event (str): "new_incident", "responders", "responding" or "responses".
+    account (str): The name of the account the incident belongs to.
+    incident_id: The FSR incident id.
+    text (str): The notification text.
+    incident (dict): The FSR incident message, for "new_incident" and "responding".
+    responders (int): The number of acknowledged responders, for "responders"
+        and "responses".
+    changes (dict): The new status by user name of the responses that changed,
+        for "responses". Changes within INCIDENT_COALESCE_WINDOW are merged.
+"""
+
+import json
+import queue
+import socket
+import struct
+import threading
+import time
+import log_writer
+import metrics
+import request_handler
+import session_pool
+import settings
+
+MODULE_NAME = "Sinks"
+SINK_HISTOGRAM = "fsr_sink_latency_seconds"
+
+# Seconds before the first retry of a failed delivery, doubled for every retry.
+RETRY_DELAY = 0.5
+
+# Circuit breaker states.
+STATE_CLOSED = "closed"
+STATE_OPEN = "open"
+STATE_HALF_OPEN = "half_open"
+
+_sinks: list = None
+_sinks_lock = threading.Lock()
+
+
+class SinkError(Exception):
+    """Raised by a sink when an event could not be delivered."""
+    pass
+
+
+class CircuitBreaker:
+    """
+    Stops calls to a destination after repeated failures.
+
+    After threshold failures in a row the breaker opens and rejects calls for
+    reset_timeout seconds. Then one trial call is let through: if it succeeds
+    the breaker closes, if it fails the breaker opens again.
+    """
+
+    def __init__(self, threshold: int, reset_timeout: float):
+        """
+        Args:
+            threshold (int): Failures in a row before the breaker opens.
+            reset_timeout (float): Seconds to stay open before a trial call.
+        """
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.state = STATE_CLOSED
+        self.failures = 0
+        self.opened = 0
+        self._opened_at = 0.0
+        self._lock = threading.Lock()
+
+    def allow(self) -> bool:
+        """
+        Check if a call may be made now.
+
+        Returns:
+            bool: True if the call may be made.
+        """
+        with self._lock:
+            if self.state == STATE_OPEN and time.monotonic() - self._opened_at >= self.reset_timeout:
+                self.state = STATE_HALF_OPEN
+                return True
+            return self.state == STATE_CLOSED
+
+    def is_open(self) -> bool:
+        """
+        Check if calls are being rejected, without using up the trial call.
+
+        Returns:
+            bool: True if the breaker is open and not yet due for a trial call.
+        """
+        with self._lock:
+            return self.state == STATE_OPEN and time.monotonic() - self._opened_at < self.reset_timeout
+
+    def success(self) -> None:
+        """
+        Record a successful call.
+        """
+        with self._lock:
+            self.state = STATE_CLOSED
+            self.failures = 0
+
+    def failure(self) -> bool:
+        """
+        Record a failed call.
+
+        Returns:
+            bool: True if the breaker opened because of this failure.
+        """
+        with self._lock:
+            self.failures += 1
+            if self.state == STATE_HALF_OPEN or (self.state == STATE_CLOSED and self.failures >= self.threshold):
+                self.state = STATE_OPEN
+                self._opened_at = time.monotonic()
+                self.opened += 1
+                return True
+            return False
+
+
+class Sink:
+    """A destination for incident events."""
+
+    name = "sink"
+
+    def submit(self, event: dict, account) -> None:
+        """
+        Hand an event to the sink. Must never block.
+
+        Args:
+            event (dict): The event, see the module docstring.
+            account (Account): The account the event belongs to.
+        """
+        raise NotImplementedError
+
+    def start(self) -> None:
+        """
+        Start delivering events.
+        """
+        pass
+
+    def stop(self, timeout: float) -> None:
+        """
+        Stop delivering events, after the queued events have been delivered.
+
+        Args:
+            timeout (float): Maximum number of seconds to wait.
+        """
+        pass
+
+    def stats(self) -> dict:
+        """
+        Get the sink counters.
+
+        Returns:
+            dict: The counters.
+        """
+        return {}
+
+
+class PushoverSink(Sink):
+    """Sends the notification text via request_handler, which has its own dispatcher."""
+
+    name = "pushover"
+    # Response changes are only sent to the machine readable sinks.
+    events = ("new_incident", "responders", "responding")
+
+    def submit(self, event: dict, account) -> None:
+        if event.get("event") not in self.events:
+            return
+        pagers = settings.get().pushover_pager_keys if event["event"] == "new_incident" else ()
+        request_handler.push_to_pushover(
+            event["text"], "default", account.user_keys(),
+            dedupe_key=f"{account.name}/{event.get('incident_id')}/{event.get('event')}",
+            emergency_user_keys=pagers
+        )
+
+    def stats(self) -> dict:
+        return request_handler.stats()
+
+
+class QueuedSink(Sink):
+    """
+    A sink with its own bounded queue, worker thread, retry budget and circuit
+    breaker. Subclasses implement send.
+    """
+
+    def __init__(self, timeout: float, max_retries: int, queue_size: int, breaker: CircuitBreaker):
+        """
+        Args:
+            timeout (float): Seconds one delivery attempt may take.
+            max_retries (int): Retries of a failed delivery.
+            queue_size (int): Max number of events waiting to be delivered.
+            breaker (CircuitBreaker): The circuit breaker of the destination.
+        """
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.breaker = breaker
+        self.counters = {"sent": 0, "failed": 0, "retried": 0, "dropped": 0, "rejected": 0}
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._stop = threading.Event()
+        self._worker: threading.Thread = None
+        self._lock = threading.Lock()
+
+    def send(self, event: dict) -> None:
+        """
+        Deliver one event.
+
+        Args:
+            event (dict): The event.
+
+        Raises:
+            Exception: If the event could not be delivered.
+        """
+        raise NotImplementedError
+
+    def submit(self, event: dict, account) -> None:
+        if self.breaker.is_open():
+            self._count("rejected")
+            return
+        try:
+            self._queue.put_nowait(event)
+        except queue.Full:
+            self._count("dropped")
+            _to_terminal(f"{self.name} queue full - dropped event")
+
+    def start(self) -> None:
+        if self._worker and self._worker.is_alive():
+            return
+        self._stop.clear()
+        self._worker = threading.Thread(target=self._worker_loop, name=f"sink-{self.name}", daemon=True)
+        self._worker.start()
+
+    def stop(self, timeout: float) -> None:
+        deadline = time.monotonic() + timeout
+        while self._queue.unfinished_tasks and time.monotonic() < deadline:
+            time.sleep(0.05)
+        self._stop.set()
+        if self._worker:
+            self._worker.join(max(0.0, deadline - time.monotonic()))
+
+    def stats(self) -> dict:
+        with self._lock:
+            snapshot = dict(self.counters)
+        snapshot["queue_depth"] = self._queue.qsize()
+        snapshot["breaker"] = self.breaker.state
+        snapshot["breaker_opened"] = self.breaker.opened
+        return snapshot
+
+    def _worker_loop(self) -> None:
+        while not self._stop.is_set():
+            try:
+                event = self._queue.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            try:
+                self._deliver(event)
+            except Exception as e:
+                _to_error(f"Deliver to {self.name}", e, event.get("incident_id"))
+            finally:
+                self._queue.task_done()
+
+    def _deliver(self, event: dict) -> None:
+        """
+        Deliver an event, retrying with exponential backoff while the breaker allows it.
+
+        Args:
+            event (dict): The event.
+        """
+        attempts = 0
+        while True:
+            if not self.breaker.allow():
+                self._count("rejected")
+                return
+            attempts += 1
+            start = time.perf_counter()
+            try:
+                self.send(event)
+            except Exception as e:
+                if self.breaker.failure():
+                    _to_terminal(f"{self.name} failed {self.breaker.failures} times in a row - "
+                                 f"pausing it for {self.breaker.reset_timeout:.0f} s")
+                if attempts > self.max_retries or self._stop.is_set():
+                    self._count("failed")
+                    _to_error(f"Deliver to {self.name}", f"Giving up after {attempts} attempts: {e}",
+                              event.get("incident_id"))
+                    return
+                self._count("retried")
+                self._stop.wait(RETRY_DELAY * (2 ** (attempts - 1)))
+                continue
+            self.breaker.success()
+            self._count("sent")
+            metrics.observe(SINK_HISTOGRAM, time.perf_counter() - start, "Time to deliver an event, per sink",
+                            sink=self.name)
+            return
+
+    def _count(self, key: str) -> None:
+        with self._lock:
+            self.counters[key] += 1
+
+
+class WebhookSink(QueuedSink):
+    """Posts every event as JSON to a URL, e.g. a Home Assistant webhook."""
+
+    name = "webhook"
+
+    def __init__(self, url: str, **kwargs):
+        """
+        Args:
+            url (str): The URL to post to.
+            **kwargs: See QueuedSink.
+        """
+        super().__init__(**kwargs)
+        self.url = url
+
+    def send(self, event: dict) -> None:
+        response = session_pool.post(self.url, json=event, timeout=self.timeout)
+        if response.status_code >= 400:
+            raise SinkError(f"HTTP {response.status_code}")
+
+
+class MqttSink(QueuedSink):
+    """
+    Publishes every event as JSON to an MQTT broker, on topic <topic>/<event>.
+
+    Uses a minimal MQTT 3.1.1 client (connect, publish with QoS 0, disconnect),
+    so no MQTT library is needed.
+    """
+
+    name = "mqtt"
+
+    def __init__(self, host: str, port: int, topic: str, username: str, password: str, **kwargs):
+        """
+        Args:
+            host (str): The broker host.
+            port (int): The broker port.
+            topic (str): The topic prefix.
+            username (str): The user name, or "" for none.
+            password (str): The password, or "" for none.
+            **kwargs: See QueuedSink.
+        """
+        super().__init__(**kwargs)
+        self.host = host
+        self.port = port
+        self.topic = topic.rstrip("/")
+        self.username = username
+        self.password = password
+
+    def send(self, event: dict) -> None:
+        payload = json.dumps(event, ensure_ascii=False).encode("utf-8")
+        with socket.create_connection((self.host, self.port), timeout=self.timeout) as sock:
+            sock.settimeout(self.timeout)
+            sock.sendall(self._connect_packet())
+            connack = _recv_exact(sock, 4)
+            if connack[0] != 0x20 or connack[3] != 0:
+                raise SinkError(f"Broker refused the connection (return code {connack[3]})")
+            topic = _mqtt_string(f"{self.topic}/{event.get('event')}")
+            sock.sendall(b"\x30" + _remaining_length(len(topic) + len(payload)) + topic + payload)
+            sock.sendall(b"\xe0\x00")
+
+    def _connect_packet(self) -> bytes:
+        flags = 0x02
+        payload = _mqtt_string(f"fsr-{socket.gethostname()}-{threading.get_ident()}"[:23])
+        if self.username:
+            flags |= 0x80
+            payload += _mqtt_string(self.username)
+            if self.password:
+                flags |= 0x40
+                payload += _mqtt_string(self.password)
+        variable = _mqtt_string("MQTT") + bytes([4, flags]) + struct.pack("!H", 60)
+        return b"\x10" + _remaining_length(len(variable) + len(payload)) + variable + payload
+
+
+def publish(event: dict, account) -> None:
+    """
+    Publish an event to every sink. Never blocks.
+
+    Args:
+        event (dict): The event, see the module docstring.
+        account (Account): The account the event belongs to.
+    """
+    for sink in _get_sinks():
+        try:
+            sink.submit(event, account)
+        except Exception as e:
+            _to_error(f"Publish to {sink.name}", e, event.get("incident_id"))
+
+
+def start_sinks() -> None:
+    """
+    Create the sinks from the settings and start their workers.
+    """
+    _get_sinks()
+
+
+def stop_sinks(timeout: float = 10.0) -> None:
+    """
+    Stop the sink workers after their queued events have been delivered.
+
+    Args:
+        timeout (float): Maximum number of seconds to wait per sink.
+    """
+    global _sinks
+    with _sinks_lock:
+        sinks, _sinks = _sinks or [], None
+    for sink in sinks:
+        sink.stop(timeout)
+
+
+def stats() -> dict:
+    """
+    Get the counters of every sink.
+
+    Returns:
+        dict: The counters by sink name.
+    """
+    return {sink.name: sink.stats() for sink in _get_sinks()}
+
+
+def _get_sinks() -> list:
+    """
+    Get the sinks, creating and starting them from the settings on first use.
+
+    Returns:
+        list: The sinks, Pushover first.
+    """
+    global _sinks
+    if _sinks is not None:
+        return _sinks
+    with _sinks_lock:
+        if _sinks is None:
+            current = settings.get()
+
+            def options(timeout: float) -> dict:
+                return {
+                    "timeout": timeout,
+                    "max_retries": current.sink_max_retries,
+                    "queue_size": current.sink_queue_size,
+                    "breaker": CircuitBreaker(current.sink_breaker_threshold, current.sink_breaker_reset),
+                }
+
+            sinks = [PushoverSink()]
+            if current.webhook_url:
+                sinks.append(WebhookSink(current.webhook_url, **options(current.webhook_timeout)))
+            if current.mqtt_host:
+                sinks.append(MqttSink(
+                    current.mqtt_host, current.mqtt_port, current.mqtt_topic,
+                    current.mqtt_username, current.mqtt_password, **options(current.mqtt_timeout)
+                ))
+            for sink in sinks:
+                sink.start()
+            _sinks = sinks
+    return _sinks
+
+
+def _mqtt_string(value: str) -> bytes:
+    data = value.encode("utf-8")
+    return struct.pack("!H", len(data)) + data
+
+
+def _remaining_length(length: int) -> bytes:
+    out = bytearray()
+    while True:
+        byte, length = length % 128, length // 128
+        out.append(byte | 0x80 if length else byte)
+        if not length:
+            return bytes(out)
+
+
+def _recv_exact(sock: socket.socket, size: int) -> bytes:
+    data = b""
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise SinkError("Broker closed the connection")
+        data += chunk
+    return data
+
+
+def _to_terminal(msg: str) -> None:
+    """
+    Log a message to the terminal using the writer module.
+
+    Args:
+        msg (str): The message to log.
+    """
+    log_writer.to_terminal(MODULE_NAME, msg)
+
+
+def _to_error(tried_to: str, err_msg: object, obj: object) -> None:
+    """
+    Log an error using the writer module.
+
+    Args:
+        tried_to (str): Description of the operation attempted.
+        err_msg (object): The exception, or an error message.
+        obj (object): The context or data related to the error.
+    """
+    log_writer.to_error(MODULE_NAME, tried_to, err_msg, obj)
+
+
+def _collect_metrics() -> list:
+    """
+    Report the sink counters to the metrics module.
+
+    Returns:
+        list: Metric samples, see metrics.register_collector.
+    """
+    samples = []
+    sinks = _sinks or []
+    for sink in sinks:
+        if not isinstance(sink, QueuedSink):
+            continue
+        stats_now = sink.stats()
+        for result in ("sent", "failed", "retried", "dropped", "rejected"):
+            samples.append(("fsr_sink_events_total", "counter", "Events per sink by result",
+                            {"sink": sink.name, "result": result}, stats_now[result]))
+        labels = {"sink": sink.name}
+        samples.extend([
+            ("fsr_sink_queue_depth", "gauge", "Events waiting to be delivered per sink", labels,
+             stats_now["queue_depth"]),
+            ("fsr_sink_circuit_open", "gauge", "1 if the sink's circuit breaker is open", labels,
+             stats_now["breaker"] == STATE_OPEN),
+            ("fsr_sink_circuit_opened_total", "counter", "Times the sink's circuit breaker opened", labels,
+             stats_now["breaker_opened"]),
+        ])
+    return samples
+
+
+metrics.register_collector(_collect_metrics)